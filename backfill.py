@@ -0,0 +1,31 @@
+import argparse
+from datetime import date
+
+from server.database import SessionLocal
+from server.models.schema import create_schema
+from server.utils.backfill import backfill_reports
+from server.utils.store_metadata import get_store_data
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Generates store availability report of every day within a date range in a single sweep over observations.')
+  parser.add_argument('--start', type=date.fromisoformat, required=True, help='first day (YYYY-MM-DD), reported as if requested at midnight UTC after it')
+  parser.add_argument('--end', type=date.fromisoformat, required=True, help='last day (YYYY-MM-DD), inclusive')
+  parser.add_argument('--windows', help='comma separated report windows (defaults to last_hour,last_day,last_week)')
+  parser.add_argument('--engine', choices=['python', 'numpy'], default='numpy', help='downtime calculation engine')
+  parser.add_argument('--format', choices=['csv', 'csv.gz', 'parquet', 'arrow'], default='csv', help='report file format')
+  args = parser.parse_args()
+
+  if args.end < args.start:
+    parser.error('--end is before --start')
+
+  windows = [window.strip() for window in args.windows.split(',')] if args.windows else None
+
+  create_schema()
+
+  db = SessionLocal()
+
+  try:
+    report_ids = backfill_reports(db, get_store_data(), args.start, args.end, windows, args.engine, args.format)
+    print(f'reports generated: {report_ids}')
+  finally:
+    db.close()
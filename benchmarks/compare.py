@@ -0,0 +1,75 @@
+'''
+compares two benchmark result files, e.g.
+
+    python -m benchmarks.compare benchmarks/results/<base>.json benchmarks/results/<new>.json
+'''
+import argparse
+import json
+
+
+def load_results(path: str) -> dict:
+    with open(path) as result_file:
+        summary = json.load(result_file)
+
+    return { (result['stores'], result['engine']): result for result in summary['results'] }
+
+
+def get_metrics(result: dict) -> dict:
+    metrics = { f'phases.{phase}': seconds for phase, seconds in result['phases'].items() }
+    metrics['streamed_seconds'] = result['streamed_seconds']
+    metrics['phases_peak_rss_mb'] = result['phases_peak_rss_mb']
+    metrics['streamed_peak_rss_mb'] = result['streamed_peak_rss_mb']
+
+    # results saved before columnar benchmark was added have no columnar metrics
+    metrics.update({ f'columnar_phases.{phase}': seconds for phase, seconds in result.get('columnar_phases', {}).items() })
+
+    if 'columnar_peak_rss_mb' in result:
+        metrics['columnar_peak_rss_mb'] = result['columnar_peak_rss_mb']
+
+    return metrics
+
+
+def compare(base_path: str, new_path: str, threshold: float) -> list:
+    '''
+    prints every metric of runs found in both files, returns metrics which grew by more than `threshold` (e.g. 0.1 = 10%)
+    '''
+    base_results = load_results(base_path)
+    new_results = load_results(new_path)
+
+    regressions = []
+
+    for key in sorted(base_results.keys() & new_results.keys()):
+        base_metrics = get_metrics(base_results[key])
+        new_metrics = get_metrics(new_results[key])
+
+        print(f'stores={key[0]} engine={key[1]}')
+
+        for metric, base_value in base_metrics.items():
+            new_value = new_metrics.get(metric)
+
+            if new_value is None:
+                continue
+
+            change = (new_value - base_value) / base_value if base_value else 0
+            flag = ''
+
+            if change > threshold:
+                flag = '  <- regression'
+                regressions.append((key, metric, base_value, new_value))
+
+            print(f'  {metric:<24} {base_value:>10} -> {new_value:>10} ({change:+.1%}){flag}')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compares two benchmark result files.')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative growth reported as regression')
+    args = parser.parse_args()
+
+    regressions = compare(args.base, args.new, args.threshold)
+
+    if regressions:
+        raise SystemExit(f'{len(regressions)} regression(s) above {args.threshold:.0%}')
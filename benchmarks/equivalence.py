@@ -0,0 +1,192 @@
+'''
+checks that every report engine produces the same report csv on a synthetic sqlite fixture, e.g.
+
+    python -m benchmarks.equivalence --stores 1000 --workers 4
+
+report of `python` engine with streamed observations is the reference, `numpy` engine, columnar (not streamed) observations and
+store_id range shards calculated by parallel `workers` must match it row by row. live report must match the reference report at the latest observation,
+live status is built without every `--held-back`-th observation which is then posted, most of them older than the latest observation of their store.
+reports are generated into a copy of the fixture, so fixture itself is reused by benchmarks unchanged
+'''
+import argparse
+import csv
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from benchmarks.run import create_fixture, run_in_process
+
+
+# (engine, stream, workers), first variant is the reference
+def get_variants(workers: int) -> list:
+    return [
+        ('python', True, 1),
+        ('numpy', True, 1),
+        ('python', False, 1),
+        ('numpy', False, 1),
+        ('python', True, workers),
+        ('numpy', True, workers),
+    ]
+
+
+def generate_report(db, now: datetime, variant: tuple) -> list:
+    '''
+    generates report of a variant at `now` the way report worker does, returns its csv rows
+    '''
+    from server.models.store import Report
+    from server.utils.datetime_utils import get_report_intervals
+    from server.utils.report_writer import reports_dir
+    from server.utils.store_availability import generate_store_availability_report
+    from server.utils.store_metadata import get_store_data
+
+    engine, stream, workers = variant
+    report = Report(
+        status='Running',
+        parameters={ "now": now.isoformat(), "engine": engine, "source": 'observations', "format": 'csv' },
+        attempts=1
+    )
+    db.add(report)
+    db.commit()
+
+    generate_store_availability_report(db, get_store_data(), get_report_intervals(now), report, stream=stream, engine=engine, workers=workers)
+    db.refresh(report)
+
+    if report.status != 'Completed':
+        raise RuntimeError(f'report of engine={engine} stream={stream} workers={workers} is {report.status}')
+
+    report_path = os.path.join(reports_dir, report.report_file)
+
+    with open(report_path, newline='') as report_file:
+        rows = list(csv.reader(report_file))
+
+    os.remove(report_path)
+
+    return rows
+
+
+def generate_reports(fixture_path: str, variants: list) -> dict:
+    '''
+    generates report of every variant, returns {variant: [csv rows]}
+    '''
+    os.environ['DATABASE_URL'] = f'sqlite:///{fixture_path}'
+
+    from benchmarks.generator import default_now
+    from server.database import SessionLocal
+    from server.models.schema import create_schema
+
+    create_schema()
+
+    db = SessionLocal()
+
+    try:
+        return { variant: generate_report(db, default_now, variant) for variant in variants }
+    finally:
+        db.close()
+
+
+def generate_live_reports(fixture_path: str, reference: tuple, held_back: int) -> dict:
+    '''
+    builds live status without every `held_back`-th observation, posts them and syncs the way api does.
+    returns {'live': [csv rows], reference: [csv rows]} of live report and reference report at the latest observation
+    '''
+    os.environ['DATABASE_URL'] = f'sqlite:///{fixture_path}'
+
+    from sqlalchemy import delete, select
+
+    from server import database
+    from server.models.schema import create_schema
+    from server.models.store import RestaurantStatus
+    from server.utils import live_status
+    from server.utils.datetime_utils import epoch, get_report_bounds
+    from server.utils.store_availability import get_report_fields
+    from server.utils.store_metadata import get_store_data
+
+    create_schema()
+
+    store_data = get_store_data()
+    is_held_back = RestaurantStatus.observation_id % held_back == 0
+
+    with database.engine.begin() as connection:
+        observations = [
+            tuple(row)
+            for row in connection.execute(select(RestaurantStatus.store_id, RestaurantStatus.timestamp_utc, RestaurantStatus.status).where(is_held_back))
+        ]
+        connection.execute(delete(RestaurantStatus).where(is_held_back))
+
+    current_live_status = live_status.current_live_status = live_status.build_live_status(store_data)
+
+    for batch_start in range(0, len(observations), live_status.max_ingest_batch):
+        live_status.ingest_observations(observations[batch_start:batch_start + live_status.max_ingest_batch])
+
+    # posted observations are read again by sync, they are not applied twice
+    live_status.sync_live_status(current_live_status, store_data)
+
+    report_intervals = current_live_status.get_report_intervals()
+    reports = {
+        'live': [get_report_fields(get_report_bounds(report_intervals))] + [
+            [str(value) for value in row] for row in current_live_status.iter_report_rows(store_data, report_intervals)
+        ]
+    }
+
+    db = database.SessionLocal()
+
+    try:
+        reports[reference] = generate_report(db, epoch + timedelta(seconds=current_live_status.latest_timestamp // 1000000), reference)
+    finally:
+        db.close()
+
+    return reports
+
+
+def compare_reports(reports: dict, variants: list, max_rows: int = 5) -> list:
+    '''
+    prints rows of every variant which differ from reference report, returns variants which differ
+    '''
+    reference = reports[variants[0]]
+    mismatches = []
+
+    for variant in variants[1:]:
+        rows = reports[variant]
+        different_rows = [(expected, actual) for expected, actual in zip(reference, rows) if expected != actual]
+
+        if len(rows) != len(reference):
+            print(f'{variant}: {len(rows)} rows, reference has {len(reference)}')
+        elif different_rows:
+            print(f'{variant}: {len(different_rows)} rows differ')
+        else:
+            print(f'{variant}: {len(rows) - 1} stores match')
+            continue
+
+        for expected, actual in different_rows[:max_rows]:
+            print(f'  expected {expected}')
+            print(f'  actual   {actual}')
+
+        mismatches.append(variant)
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Checks that report engines produce identical reports on synthetic data.')
+    parser.add_argument('--stores', type=int, default=1000, help='number of generated stores')
+    parser.add_argument('--seed', type=int, default=1, help='same seed generates same stores and observations')
+    parser.add_argument('--workers', type=int, default=4, help='parallel processes of sharded report')
+    parser.add_argument('--held-back', type=int, default=20, help='every n-th observation is posted after live status is built')
+    parser.add_argument('--data-dir', default=os.path.join('benchmarks', 'data'), help='directory of sqlite fixtures, reused between runs')
+    args = parser.parse_args()
+
+    variants = get_variants(args.workers)
+    fixture_path = run_in_process(create_fixture, args.stores, args.seed, args.data_dir)
+
+    with tempfile.TemporaryDirectory() as copy_dir:
+        copy_path = os.path.join(copy_dir, os.path.basename(fixture_path))
+        shutil.copyfile(fixture_path, copy_path)
+
+        reports = run_in_process(generate_reports, copy_path, variants)
+        live_reports = run_in_process(generate_live_reports, copy_path, variants[0], args.held_back)
+
+    mismatches = compare_reports(reports, variants) + compare_reports(live_reports, [variants[0], 'live'])
+
+    if mismatches:
+        raise SystemExit(f'{len(mismatches)} of {len(variants)} reports differ from engine=python stream=True workers=1')
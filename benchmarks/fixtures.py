@@ -0,0 +1,109 @@
+import os
+import random
+from datetime import datetime
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Connection
+
+from benchmarks.generator import default_now, generate_business_hours, generate_observations, generate_store_ids, generate_timezones, get_observation_span
+from server.models.schema import create_schema
+from server.utils.loader import get_chunks
+
+
+default_data_dir = os.path.join('benchmarks', 'data')
+
+chunk_size = 100000
+
+
+def get_fixture_path(n_stores: int, seed: int, data_dir: str = default_data_dir) -> str:
+    return os.path.abspath(os.path.join(data_dir, f'stores-{n_stores}-seed-{seed}.db'))
+
+
+def get_fixture_url(fixture_path: str) -> str:
+    return f'sqlite:///{fixture_path}'
+
+
+def format_timestamp(timestamp: datetime) -> str:
+    # storage format of sqlalchemy sqlite DateTime
+    return timestamp.isoformat(sep=' ', timespec='microseconds')
+
+
+def insert_rows(connection: Connection, statement: str, rows) -> int:
+    '''
+    inserts rows through sqlite driver directly, millions of observations are too slow to insert through orm
+    '''
+    total_rows = 0
+
+    for chunk in get_chunks(iter(rows), chunk_size):
+        connection.exec_driver_sql(statement, chunk)
+        total_rows += len(chunk)
+
+    return total_rows
+
+
+def create_fixture(fixture_path: str, n_stores: int, seed: int, now: datetime = default_now) -> dict:
+    '''
+    creates sqlite database with schema of the service and synthetic stores generated from `seed`, returns number of generated rows.
+    database is written next to `fixture_path` and renamed when complete, so an interrupted run never leaves a partial fixture
+    '''
+    os.makedirs(os.path.dirname(fixture_path), exist_ok=True)
+
+    partial_path = f'{fixture_path}.partial'
+
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+
+    engine = create_engine(get_fixture_url(partial_path))
+    create_schema(engine)
+
+    rnd = random.Random(seed)
+    store_ids = generate_store_ids(rnd, n_stores)
+
+    with engine.begin() as connection:
+        timezones = insert_rows(
+            connection,
+            'INSERT INTO restaurant_timezone (store_id, timezone_str) VALUES (?, ?)',
+            generate_timezones(rnd, store_ids)
+        )
+
+        business_hours = insert_rows(
+            connection,
+            'INSERT INTO business_hours (store_id, day_of_week, start_time_local, end_time_local) VALUES (?, ?, ?, ?)',
+            (
+                (store_id, day_of_week, start_time_local.isoformat(timespec='microseconds'), end_time_local.isoformat(timespec='microseconds'))
+                for store_id, day_of_week, start_time_local, end_time_local in generate_business_hours(rnd, store_ids)
+            )
+        )
+
+        observations = insert_rows(
+            connection,
+            'INSERT INTO restaurant_status (store_id, timestamp_utc, status) VALUES (?, ?, ?)',
+            (
+                (store_id, format_timestamp(timestamp_utc), status)
+                for store_id, timestamp_utc, status in generate_observations(rnd, store_ids, *get_observation_span(now))
+            )
+        )
+
+        connection.execute(text('ANALYZE'))
+
+    engine.dispose()
+    os.replace(partial_path, fixture_path)
+
+    return {
+        "stores": n_stores,
+        "timezones": timezones,
+        "business_hours": business_hours,
+        "observations": observations
+    }
+
+
+def ensure_fixture(n_stores: int, seed: int, data_dir: str = default_data_dir) -> str:
+    '''
+    returns path of sqlite fixture, fixture is generated only once for the same number of stores and seed
+    '''
+    fixture_path = get_fixture_path(n_stores, seed, data_dir)
+
+    if not os.path.exists(fixture_path):
+        create_fixture(fixture_path, n_stores, seed)
+
+    return fixture_path
@@ -0,0 +1,118 @@
+import random
+from datetime import datetime, time, timedelta, timezone
+from typing import Iterator
+
+from server.utils.datetime_utils import get_report_intervals
+
+
+# `now` of trigger_report, so generated observations cover the same report intervals as bundled data
+default_now = datetime(2023, 1, 25, 18, 13, 22, tzinfo=timezone.utc)
+
+timezones = [
+    'America/Chicago', 'America/New_York', 'America/Denver', 'America/Los_Angeles',
+    'America/Phoenix', 'America/Boise', 'America/Anchorage', 'Pacific/Honolulu',
+    'Asia/Kolkata', 'Europe/London',
+]
+
+# probabilities of generated stores, roughly as in bundled data
+missing_timezone = 0.1
+missing_business_hours = 0.2
+missing_day = 0.1
+overnight_day = 0.1
+open_all_day = 0.05
+
+# store is polled about every `poll_interval`, a poll is skipped with `missed_poll` probability
+poll_interval = timedelta(hours=1)
+poll_jitter = timedelta(minutes=10)
+missed_poll = 0.05
+
+# active -> inactive and inactive -> active transition probabilities between two polls
+outage_start = 0.03
+outage_end = 0.3
+
+
+def get_observation_span(now: datetime) -> tuple:
+    '''
+    observations start a few polls before `last_week` starts, so state at start of every report interval is known
+    '''
+    report_intervals = get_report_intervals(now)
+
+    return report_intervals['last_week_start'] - 2 * poll_interval, now
+
+
+def generate_store_ids(rnd: random.Random, n_stores: int) -> list:
+    store_ids = set()
+
+    while len(store_ids) < n_stores:
+        store_ids.add(rnd.randrange(10**15, 2**63))
+
+    return sorted(store_ids)
+
+
+def generate_timezones(rnd: random.Random, store_ids: list) -> Iterator[tuple]:
+    '''
+    yields (store_id, timezone_str), some stores have no timezone (America/Chicago is used)
+    '''
+    for store_id in store_ids:
+        if rnd.random() >= missing_timezone:
+            yield store_id, rnd.choice(timezones)
+
+
+def generate_day_hours(rnd: random.Random) -> tuple:
+    '''
+    returns (start_time_local, end_time_local) of a single day, end before start means store closes on next day
+    '''
+    if rnd.random() < open_all_day:
+        return time(0, 0), time(23, 59, 59)
+
+    if rnd.random() < overnight_day:
+        return time(rnd.randrange(17, 23), rnd.choice([0, 30])), time(rnd.randrange(0, 4), rnd.choice([0, 30]))
+
+    start_hour = rnd.randrange(5, 13)
+    end_hour = rnd.randrange(start_hour + 6, 24)
+
+    return time(start_hour, rnd.choice([0, 15, 30, 45])), time(end_hour, rnd.choice([0, 30, 59]), rnd.choice([0, 59]))
+
+
+def generate_business_hours(rnd: random.Random, store_ids: list) -> Iterator[tuple]:
+    '''
+    yields (store_id, day_of_week, start_time_local, end_time_local). stores without business hours and missing days are open all day
+    '''
+    for store_id in store_ids:
+        if rnd.random() < missing_business_hours:
+            continue
+
+        # most stores keep the same hours every day
+        regular_hours = generate_day_hours(rnd)
+
+        for day_of_week in range(7):
+            if rnd.random() < missing_day:
+                continue
+
+            start_time_local, end_time_local = regular_hours if rnd.random() < 0.7 else generate_day_hours(rnd)
+
+            yield store_id, day_of_week, start_time_local, end_time_local
+
+
+def generate_observations(rnd: random.Random, store_ids: list, start: datetime, end: datetime) -> Iterator[tuple]:
+    '''
+    yields (store_id, timestamp_utc, status) of every store polled about once per `poll_interval` between start and end,
+    status follows short outages of a mostly active store. timestamps are naive UTC like `restaurant_status`
+    '''
+    start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    end = end.astimezone(timezone.utc).replace(tzinfo=None)
+
+    jitter_us = int(poll_jitter / timedelta(microseconds=1))
+
+    for store_id in store_ids:
+        timestamp = start + timedelta(microseconds=rnd.randrange(int(poll_interval / timedelta(microseconds=1))))
+        active = True
+
+        while timestamp < end:
+            if rnd.random() < (outage_start if active else outage_end):
+                active = not active
+
+            if rnd.random() >= missed_poll:
+                yield store_id, timestamp, 'active' if active else 'inactive'
+
+            timestamp += poll_interval + timedelta(microseconds=rnd.randrange(-jitter_us, jitter_us))
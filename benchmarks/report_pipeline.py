@@ -0,0 +1,152 @@
+import csv
+import resource
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy.orm import Session
+
+from benchmarks.generator import default_now
+from server.database import SessionLocal
+from server.utils.business_hours import get_store_schedule
+from server.utils.datetime_utils import get_report_bounds, get_report_intervals
+from server.utils.report_writer import report_fields
+from server.utils.store_availability import calculate_store_availability, calculate_store_availability_vectorized, write_store_availability_rows
+from server.utils.store_details import get_observation_query, get_restaurant_status, group_observations, stream_restaurant_status
+from server.utils.store_metadata import get_store_data
+
+
+def get_peak_rss_mb() -> float:
+    '''
+    peak resident memory of current process, ru_maxrss is in kilobytes on linux and bytes on macos
+    '''
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return round(peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+@contextmanager
+def timed(timings: dict, phase: str):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timings[phase] = round(time.perf_counter() - start, 4)
+
+
+def benchmark_phases(engine: str = 'python', now: datetime = default_now) -> dict:
+    '''
+    runs report pipeline one phase at a time (query, grouping, compute, csv_write), every phase finishes before the next starts,
+    so all observations are held in memory at once unlike the streamed report
+    '''
+    report_intervals = get_report_intervals(now)
+    report_bounds = get_report_bounds(report_intervals)
+    calculate = calculate_store_availability_vectorized if engine == 'numpy' else calculate_store_availability
+
+    timings = {}
+    db: Session = SessionLocal()
+
+    try:
+        with timed(timings, 'metadata'):
+            store_data = get_store_data()
+
+        with timed(timings, 'query'):
+            observations = db.execute(get_observation_query(report_intervals)).all()
+
+        with timed(timings, 'grouping'):
+            stores = list(group_observations(observations))
+
+        with timed(timings, 'compute'):
+            schedules = {}
+            rows = [
+                calculate(store_id, status_entries, get_store_schedule(store_id, store_data, report_intervals, schedules), report_bounds)
+                for store_id, status_entries in stores
+            ]
+
+        with timed(timings, 'csv_write'):
+            with tempfile.TemporaryFile('w', newline='') as report_file:
+                writer = csv.writer(report_file)
+                writer.writerow(report_fields)
+                writer.writerows(rows)
+    finally:
+        db.close()
+
+    return {
+        "stores": len(stores),
+        "observations": len(observations),
+        "schedules": len(schedules),
+        "phases": timings,
+        "peak_rss_mb": get_peak_rss_mb()
+    }
+
+
+def benchmark_columnar(engine: str = 'python', now: datetime = default_now) -> dict:
+    '''
+    same phases as `benchmark_phases`, but observations are loaded into `ObservationColumns` arrays while rows are fetched
+    and stores are calculated from array views, grouping is part of loading
+    '''
+    report_intervals = get_report_intervals(now)
+    report_bounds = get_report_bounds(report_intervals)
+    calculate = calculate_store_availability_vectorized if engine == 'numpy' else calculate_store_availability
+
+    timings = {}
+    db: Session = SessionLocal()
+
+    try:
+        with timed(timings, 'metadata'):
+            store_data = get_store_data()
+
+        with timed(timings, 'query'):
+            observations = get_restaurant_status(db, report_intervals, columnar=True)
+
+        with timed(timings, 'compute'):
+            schedules = {}
+            rows = [
+                calculate(store_id, status_entries, get_store_schedule(store_id, store_data, report_intervals, schedules), report_bounds)
+                for store_id, status_entries in observations.items()
+            ]
+
+        with timed(timings, 'csv_write'):
+            with tempfile.TemporaryFile('w', newline='') as report_file:
+                writer = csv.writer(report_file)
+                writer.writerow(report_fields)
+                writer.writerows(rows)
+    finally:
+        db.close()
+
+    return {
+        "stores": len(observations),
+        "observations": observations.observations,
+        "observations_mb": round(observations.nbytes / (1024 * 1024), 1),
+        "phases": timings,
+        "peak_rss_mb": get_peak_rss_mb()
+    }
+
+
+def benchmark_streamed(engine: str = 'python', now: datetime = default_now) -> dict:
+    '''
+    runs report pipeline the way `generate_store_availability_report` does, observations are streamed and rows written per store
+    '''
+    report_intervals = get_report_intervals(now)
+
+    timings = {}
+    db: Session = SessionLocal()
+
+    try:
+        with timed(timings, 'total'):
+            with tempfile.TemporaryFile('w', newline='') as report_file:
+                writer = csv.writer(report_file)
+                writer.writerow(report_fields)
+
+                stores = write_store_availability_rows(writer, stream_restaurant_status(db, report_intervals), get_store_data(), report_intervals, engine)
+    finally:
+        db.close()
+
+    return {
+        "stores": stores,
+        "seconds": timings['total'],
+        "peak_rss_mb": get_peak_rss_mb()
+    }
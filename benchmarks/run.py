@@ -0,0 +1,119 @@
+'''
+benchmarks report pipeline on synthetic sqlite fixtures and saves timings as json, e.g.
+
+    python -m benchmarks.run --stores 1000 14000 100000 --engines python numpy
+
+every fixture and benchmark runs in its own spawned process, so peak RSS belongs to a single run and
+`server` modules are imported with DATABASE_URL pointing to the fixture
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+
+default_stores = [1000, 14000, 100000]
+default_engines = ['python', 'numpy']
+default_results_dir = os.path.join('benchmarks', 'results')
+
+
+def create_fixture(n_stores: int, seed: int, data_dir: str) -> str:
+    # fixture is written with its own engine, server models only need a database to import against
+    os.environ['DATABASE_URL'] = 'sqlite://'
+
+    from benchmarks.fixtures import ensure_fixture
+
+    return ensure_fixture(n_stores, seed, data_dir)
+
+
+def run_benchmark(fixture_path: str, benchmark: str, engine: str) -> dict:
+    os.environ['DATABASE_URL'] = f'sqlite:///{fixture_path}'
+
+    from benchmarks import report_pipeline
+
+    if benchmark == 'streamed':
+        return report_pipeline.benchmark_streamed(engine)
+
+    if benchmark == 'columnar':
+        return report_pipeline.benchmark_columnar(engine)
+
+    return report_pipeline.benchmark_phases(engine)
+
+
+def run_in_process(function, *args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(stores: list, engines: list, seed: int, data_dir: str) -> dict:
+    results = []
+
+    for n_stores in stores:
+        start = time.perf_counter()
+        fixture_path = run_in_process(create_fixture, n_stores, seed, data_dir)
+        print(f'fixture {fixture_path} ready in {time.perf_counter() - start:.1f}s')
+
+        for engine in engines:
+            phases = run_in_process(run_benchmark, fixture_path, 'phases', engine)
+            streamed = run_in_process(run_benchmark, fixture_path, 'streamed', engine)
+            columnar = run_in_process(run_benchmark, fixture_path, 'columnar', engine)
+
+            result = {
+                "stores": n_stores,
+                "engine": engine,
+                "observations": phases['observations'],
+                "schedules": phases['schedules'],
+                "phases": phases['phases'],
+                "phases_peak_rss_mb": phases['peak_rss_mb'],
+                "streamed_seconds": streamed['seconds'],
+                "streamed_peak_rss_mb": streamed['peak_rss_mb'],
+                "columnar_phases": columnar['phases'],
+                "columnar_peak_rss_mb": columnar['peak_rss_mb']
+            }
+            results.append(result)
+
+            print(json.dumps(result))
+
+    return {
+        "commit": get_commit(),
+        "created_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "results": results
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks store availability report pipeline on synthetic data.')
+    parser.add_argument('--stores', type=int, nargs='+', default=default_stores, help='number of generated stores, one fixture per value')
+    parser.add_argument('--engines', nargs='+', default=default_engines, choices=default_engines)
+    parser.add_argument('--seed', type=int, default=1, help='same seed generates same stores and observations')
+    parser.add_argument('--data-dir', default=os.path.join('benchmarks', 'data'), help='directory of sqlite fixtures, reused between runs')
+    parser.add_argument('--output', help='json file of results, defaults to benchmarks/results/<commit>-<time>.json')
+    args = parser.parse_args()
+
+    summary = run(args.stores, args.engines, args.seed, args.data_dir)
+
+    output = args.output or os.path.join(
+        default_results_dir,
+        f"{(summary['commit'] or 'local')[:7]}-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, 'w') as output_file:
+        json.dump(summary, output_file, indent=2)
+
+    print(f'results saved to {output}')
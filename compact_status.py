@@ -0,0 +1,24 @@
+import argparse
+from datetime import timedelta
+
+from server.database import SessionLocal
+from server.models.schema import create_schema
+from server.utils.status_intervals import observation_retention, compact_status_intervals, prune_observations
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Collapses new observations into runs of identical status in store_status_intervals table.')
+  parser.add_argument('--prune', action='store_true', help='delete compacted observations older than retention before the latest observation')
+  parser.add_argument('--retention-days', type=float, default=observation_retention.total_seconds() / 86400, help='days of raw observations kept by --prune (defaults to OBSERVATION_RETENTION_DAYS or 15)')
+  args = parser.parse_args()
+
+  create_schema()
+
+  db = SessionLocal()
+
+  try:
+    print(f'status intervals compacted for stores: {compact_status_intervals(db)}')
+
+    if args.prune:
+      print(f'observations pruned: {prune_observations(db, timedelta(days=args.retention_days))}')
+  finally:
+    db.close()
@@ -0,0 +1,67 @@
+import argparse
+import os
+
+from server.database import engine, SessionLocal
+from server.models.schema import create_schema
+from server.utils.loader import default_chunk_size, load_business_hours, load_observations, load_timezones
+
+data_dir = os.path.join('server', 'static', 'store')
+
+default_files = {
+  'observations': os.path.join(data_dir, 'store status.csv'),
+  'business_hours': os.path.join(data_dir, 'Menu hours.csv'),
+  'timezones': os.path.join(data_dir, 'bq-results-20230125-202210-1674678181880.csv'),
+}
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Loads store observations, business hours and timezones csv files into database in a single transaction.')
+  parser.add_argument('--observations', help='store status csv (store_id, status, timestamp_utc), appended and deduplicated on (store_id, timestamp_utc)')
+  parser.add_argument('--business-hours', help='business hours csv (store_id, day, start_time_local, end_time_local), replaces existing business hours')
+  parser.add_argument('--timezones', help='timezones csv (store_id, timezone_str), replaces existing timezones')
+  parser.add_argument('--chunk-size', type=int, default=default_chunk_size, help='rows sent to database at once')
+  parser.add_argument('--skip-rollup', action='store_true', help='do not refresh hourly uptime rollup after loading observations')
+  parser.add_argument('--skip-compaction', action='store_true', help='do not compact loaded observations into status intervals')
+  args = parser.parse_args()
+
+  files = {
+    'observations': args.observations,
+    'business_hours': args.business_hours,
+    'timezones': args.timezones,
+  }
+
+  # load all bundled data sources when none is given
+  if not any(files.values()):
+    files = default_files
+
+  create_schema()
+
+  with engine.begin() as connection:
+    if files['timezones']:
+      print(f"timezones loaded: {load_timezones(connection, files['timezones'], args.chunk_size)}")
+
+    if files['business_hours']:
+      print(f"business hours loaded: {load_business_hours(connection, files['business_hours'], args.chunk_size)}")
+
+    if files['observations']:
+      print(f"observations loaded: {load_observations(connection, files['observations'], args.chunk_size)}")
+
+  if files['observations'] and not args.skip_rollup:
+    from server.utils.hourly_uptime import refresh_hourly_uptime
+    from server.utils.store_metadata import get_store_data
+
+    db = SessionLocal()
+
+    try:
+      print(f'hourly uptime refreshed for stores: {refresh_hourly_uptime(db, get_store_data())}')
+    finally:
+      db.close()
+
+  if files['observations'] and not args.skip_compaction:
+    from server.utils.status_intervals import compact_status_intervals
+
+    db = SessionLocal()
+
+    try:
+      print(f'status intervals compacted for stores: {compact_status_intervals(db)}')
+    finally:
+      db.close()
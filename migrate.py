@@ -0,0 +1,19 @@
+import argparse
+
+from server.database import engine
+from server.models.schema import create_schema
+from server.utils.partitions import create_observation_index, partition_restaurant_status
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Migrates existing restaurant_status table to current schema.')
+  parser.add_argument('--partition', action='store_true', help='move observations into a table range partitioned by week of timestamp_utc (postgresql only)')
+  args = parser.parse_args()
+
+  create_schema()
+
+  with engine.begin() as connection:
+    create_observation_index(connection)
+    print('restaurant_status (store_id, timestamp_utc) index created')
+
+    if args.partition:
+      print(f'observations moved into weekly partitions: {partition_restaurant_status(connection)}')
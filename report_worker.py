@@ -0,0 +1,22 @@
+import argparse
+
+from server.models.schema import create_schema
+from server.utils.report_queue import report_queue_workers, report_max_concurrency, start_report_workers, stop_report_workers
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Generates queued store availability reports.')
+  parser.add_argument('--workers', type=int, default=max(report_queue_workers, 1), help='number of worker processes')
+  parser.add_argument('--max-concurrency', type=int, default=report_max_concurrency, help='max reports generated at the same time by all workers')
+  args = parser.parse_args()
+
+  # worker processes import models without touching database
+  create_schema()
+
+  processes = start_report_workers(args.workers, args.max_concurrency)
+
+  try:
+    for process in processes:
+      process.join()
+  except KeyboardInterrupt:
+    stop_report_workers(processes)
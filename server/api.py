@@ -1,20 +1,33 @@
-from fastapi import FastAPI, Depends, status, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Depends, Query, Request, status, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from server.database import get_db
-from server.schemas.response import HealthResponse, ReportBase
-from server.models.store import Report
+from server.database import close_async_db, get_async_db
+from server.schemas.request import ObservationsRequest, StoreAvailabilityRequest
+from server.schemas.response import HealthResponse, ReportBase, ReportEngine, ReportFormat, ReportRows, ReportRowSort, ReportSource, SortOrder, StoreAvailability
+from server.models.schema import create_schema
 
-from server.utils.store_availability import generate_store_availability_report
-from server.utils.store_details import get_store_data
-from server.utils.report import get_report_by_id
-from server.utils.datetime_utils import get_report_intervals
+from server.utils.report_queue import start_report_workers, stop_report_workers
+from server.utils.store_details import get_last_observation_id
+from server.utils.store_metadata import StoreMetadata, get_store_data, refresh_store_metadata, start_metadata_refresher
+from server.utils.report import get_report_by_id, get_report_cache_key, create_report
+from server.utils.report_download import get_report_file_response
+from server.utils.report_rows import max_page_size, get_report_rows
+from server.utils.datetime_utils import default_report_windows, get_report_bounds, get_report_intervals
+from server.utils.hourly_uptime import is_hour_aligned
+from server.utils.metrics import metrics_enabled, clear_metrics_dir, observe, render_metrics
+from server.utils.availability_query import max_batch_stores, calculate_stores_availability, get_window_observations, to_naive_utc
+from server.utils.store_availability import get_report_fields, get_window_unit
+from server.utils import live_status
 
 from datetime import datetime, timezone
+from typing import List, Optional
 
+import time
 import traceback
 
 app = FastAPI(
@@ -35,41 +48,145 @@ app.add_middleware(
 
 app.mount("/static", StaticFiles(directory="server/static"), name="static")
 
+# report worker processes started with the api
+report_worker_processes = []
+
+# stops background reload of store metadata
+metadata_refresher = []
+
+# stops background sync of live store status
+live_status_sync = []
+
+
+if metrics_enabled:
+    @app.middleware("http")
+    async def record_request_duration(request: Request, call_next):
+        started = time.perf_counter()
+        response = await call_next(request)
+
+        # route path (e.g. /reports/{report_id}/download) instead of requested url, so label values stay bounded
+        route = request.scope.get('route')
+        observe(
+            'api_request_duration_seconds',
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route else 'unmatched',
+            status=response.status_code
+        )
+
+        return response
+
+
+@app.on_event("startup")
+def start_workers() -> None:
+    create_schema()
+    # counters of previous run are not carried over
+    clear_metrics_dir()
+    # first request does not wait for metadata, it is memory mapped from snapshot when dataset did not change since it was taken
+    refresh_store_metadata()
+    report_worker_processes.extend(start_report_workers())
+    metadata_refresher.append(start_metadata_refresher())
+    live_status_sync.append(live_status.start_live_status())
+
+
+@app.on_event("shutdown")
+def stop_workers() -> None:
+    stop_report_workers(report_worker_processes)
+    report_worker_processes.clear()
+
+    for stop_event in metadata_refresher:
+        stop_event.set()
+
+    metadata_refresher.clear()
+
+    for stop_event in live_status_sync:
+        live_status.stop_live_status(stop_event)
+
+    live_status_sync.clear()
+
+
+@app.on_event("shutdown")
+async def close_db() -> None:
+    await close_async_db()
+
 
 @app.get("/", status_code=status.HTTP_200_OK, tags=["Health check"])
 async def health() -> HealthResponse:
     return HealthResponse(status="Ok")
 
 
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Health check"])
+async def metrics() -> PlainTextResponse:
+    """
+    report duration, report phase and api latency histograms along with stores, observations and intervals counters of api and report workers,
+    in prometheus text format
+    """
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
 @app.post("/trigger_report", status_code=status.HTTP_201_CREATED, tags=["Store availability report"])
-async def trigger_report(background_tasks: BackgroundTasks, store_data: dict = Depends(get_store_data), db: Session = Depends(get_db)) -> dict:
+async def trigger_report(engine: ReportEngine = ReportEngine.PYTHON, source: ReportSource = ReportSource.OBSERVATIONS, report_format: ReportFormat = Query(ReportFormat.CSV, alias='format'), windows: Optional[str] = None, priority: int = 0, incremental: bool = False, delta: bool = False, store_data: StoreMetadata = Depends(get_store_data), db: AsyncSession = Depends(get_async_db)) -> dict:
     """
-    generates store availability report in background and returns report_id
+    queues store availability report and returns report_id, report worker processes pick queued reports with higher `priority` first.
+    `engine` chooses how downtime is calculated (python loop or numpy arrays), `source` chooses between raw observations, hourly uptime rollup and compacted status intervals.
+    hourly uptime rollup counts downtime crossing the report span edges, which raw observations clip at the span, so stores with such downtime differ.
+    `format` chooses report file format (csv, csv.gz, parquet or arrow).
+    `windows` is comma separated list of report windows, e.g. `last_15m,last_4h,last_30d,each_day_7` (defaults to `last_hour,last_day,last_week`).
+    `incremental` reuses rows of the latest completed report with the same windows and recalculates only stores with changed observations,
+    `delta` (implies `incremental`) also writes rows of recalculated stores into a delta file at `report_delta_url`.
+    report_id of queued, running or completed report is returned for identical requests
     """
     try:
-        # generate report_id
-        report = Report(status='Running')
-        db.add(report)
-        db.commit()
-        db.refresh(report)
-
         # now value is hard coded with max timestamp among all the given observations as given data is static. 
         # TODO: Replace now with `datetime.utcnow()` in future
         now = datetime(2023, 1, 25, 18, 13, 22, 0, tzinfo=timezone.utc)
 
+        report_windows = [window.strip() for window in windows.split(',')] if windows else default_report_windows
+
         # get time range(e.g. last_hour, last_day, last_week) for which report needs to be generated
-        report_intervals = get_report_intervals(now)
+        try:
+            report_intervals = get_report_intervals(now, report_windows)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
 
-        # generate report in background
-        background_tasks.add_task(
-            generate_store_availability_report, 
-            db,
-            store_data,
+        if source == ReportSource.HOURLY_UPTIME and not is_hour_aligned(report_intervals):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="hourly_uptime source only supports windows starting and ending on an hour."
+            )
+
+        incremental = incremental or delta
+
+        if incremental and source != ReportSource.OBSERVATIONS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="incremental reports are only calculated from observations source."
+            )
+
+        # identical requests (same report_intervals and data) are answered with the existing report
+        cache_key = get_report_cache_key(
             report_intervals,
-            report
+            await get_last_observation_id(db),
+            store_data.versions,
+            source.value,
+            report_format.value,
+            delta
+        )
+
+        # generate report_id, report is generated by report worker
+        report, _ = await create_report(
+            db,
+            cache_key,
+            parameters={ "now": now.isoformat(), "engine": engine.value, "source": source.value, "format": report_format.value, "windows": report_windows, "incremental": incremental, "delta": delta },
+            priority=priority
         )
 
         return { "report_id": report.report_id }
+    except HTTPException:
+        raise
     except Exception as e:
         print(e)
         print(traceback.format_exc())
@@ -80,9 +197,10 @@ async def trigger_report(background_tasks: BackgroundTasks, store_data: dict = D
     
 
 @app.get("/get_report", status_code=status.HTTP_200_OK, tags=["Store availability report"])
-async def get_report(report_id: int, db: Session = Depends(get_db)):
+async def get_report(report_id: int, request: Request, db: AsyncSession = Depends(get_async_db)) -> ReportBase:
     """
-    returns store availability report
+    returns store availability report, `stores_processed` / `stores_total` show progress of running report.
+    `report_csv_url` of completed report points to `/reports/{report_id}/download` of this api
     """
     try:
         if not report_id:
@@ -91,7 +209,7 @@ async def get_report(report_id: int, db: Session = Depends(get_db)):
                 detail="report_id is required."
             )
 
-        report = get_report_by_id(db, report_id)
+        report = await get_report_by_id(db, report_id)
 
         if not report:
             raise HTTPException(
@@ -99,11 +217,260 @@ async def get_report(report_id: int, db: Session = Depends(get_db)):
                 detail=f'No report found with report_id: {report_id}'
             )
 
-        return report
+        response = ReportBase.from_orm(report)
+
+        # reports store download path relative to api, url is completed with host of the request
+        if response.report_csv_url and response.report_csv_url.startswith('/'):
+            response.report_csv_url = f"{str(request.base_url).rstrip('/')}{response.report_csv_url}"
+
+        if response.report_delta_url and response.report_delta_url.startswith('/'):
+            response.report_delta_url = f"{str(request.base_url).rstrip('/')}{response.report_delta_url}"
+
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         print(e)
         print(traceback.format_exc())
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
             detail="Error while getting report."
-        )
\ No newline at end of file
+        )
+
+
+@app.get("/reports/{report_id}/download", status_code=status.HTTP_200_OK, tags=["Store availability report"])
+async def download_report(report_id: int, request: Request, delta: bool = False, db: AsyncSession = Depends(get_async_db)):
+    """
+    streams report file of a completed report, supports `Range` requests and negotiates gzip csv through `Accept` / `Accept-Encoding`.
+    `delta` streams rows of stores recalculated by incremental report instead
+    """
+    try:
+        report = await get_report_by_id(db, report_id)
+
+        if not report:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f'No report found with report_id: {report_id}'
+            )
+
+        if report.status != 'Completed' or not report.report_file:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f'Report {report_id} is {report.status}.'
+            )
+
+        if delta and not report.delta_file:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f'Report {report_id} has no delta file.'
+            )
+
+        return get_report_file_response(report, request.headers, report.delta_file if delta else None)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
+            detail="Error while downloading report."
+        )
+
+
+@app.get("/get_report/{report_id}/rows", status_code=status.HTTP_200_OK, tags=["Store availability report"])
+async def get_report_rows_page(
+    report_id: int,
+    window: Optional[str] = None,
+    min_uptime: Optional[int] = None,
+    max_uptime: Optional[int] = None,
+    min_downtime: Optional[int] = None,
+    max_downtime: Optional[int] = None,
+    sort: ReportRowSort = ReportRowSort.STORE_ID,
+    order: SortOrder = SortOrder.ASC,
+    limit: int = Query(100, ge=1, le=max_page_size),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
+) -> ReportRows:
+    """
+    returns a page of stores of a completed report with uptime and downtime of every window (in report units).
+    `min_*` / `max_*` filter and `sort` orders stores by values of `window` (first report window by default), e.g. worst 100 stores of last day are
+    `window=last_day&sort=downtime&order=desc&limit=100`. `next_cursor` of a page is passed as `cursor` to get the next one
+    """
+    try:
+        report = await get_report_by_id(db, report_id)
+
+        if not report:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f'No report found with report_id: {report_id}'
+            )
+
+        if report.status != 'Completed':
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f'Report {report_id} is {report.status}.'
+            )
+
+        parameters = report.parameters or {}
+        report_intervals = get_report_intervals(datetime.fromisoformat(parameters["now"]), parameters.get("windows") or default_report_windows)
+        units = { name: get_window_unit(start, end)[0] for name, (start, end) in get_report_bounds(report_intervals).items() }
+
+        window = window or next(iter(units))
+
+        if window not in units:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Report {report_id} has no window {window}, windows: {", ".join(units)}'
+            )
+
+        filters = {
+            (column, operator): value
+            for column, operator, value in (
+                ('uptime', '>=', min_uptime),
+                ('uptime', '<=', max_uptime),
+                ('downtime', '>=', min_downtime),
+                ('downtime', '<=', max_downtime)
+            )
+            if value is not None
+        }
+
+        try:
+            rows, next_cursor = await get_report_rows(db, report_id, list(units), window, filters, sort.value, order.value, limit, cursor)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Invalid cursor: {cursor}'
+            )
+
+        return ReportRows(report_id=report_id, window=window, units=units, rows=rows, next_cursor=next_cursor)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
+            detail="Error while getting report rows."
+        )
+
+
+@app.post("/observations", status_code=status.HTTP_201_CREATED, tags=["Live store status"])
+async def post_observations(observations_request: ObservationsRequest) -> dict:
+    """
+    appends a batch of `{"store_id", "timestamp_utc", "status"}` observations to `restaurant_status` and applies them to live store status.
+    observations already loaded for (store_id, timestamp_utc) are not inserted again, live status of stores which received observations
+    older than their latest one is rebuilt from stored observations
+    """
+    try:
+        observations = observations_request.observations
+
+        if not observations or len(observations) > live_status.max_ingest_batch:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"observations must have between 1 and {live_status.max_ingest_batch} observations."
+            )
+
+        return await run_in_threadpool(
+            live_status.ingest_observations,
+            [(observation.store_id, observation.timestamp_utc, observation.status) for observation in observations]
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
+            detail="Error while storing observations."
+        )
+
+
+@app.get("/live_report", status_code=status.HTTP_200_OK, tags=["Live store status"])
+async def get_live_report(store_data: StoreMetadata = Depends(get_store_data)) -> StreamingResponse:
+    """
+    streams report csv (same columns as default report) of last hour, day and week before the latest observation,
+    calculated from live store status instead of observations
+    """
+    current_live_status = live_status.current_live_status
+
+    if current_live_status is None or current_live_status.latest_timestamp is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Live store status is not loaded yet."
+        )
+
+    report_intervals = current_live_status.get_report_intervals()
+    fields = get_report_fields(get_report_bounds(report_intervals))
+
+    # rows are calculated in threadpool, event loop keeps serving other requests
+    rows = await run_in_threadpool(lambda: list(current_live_status.iter_report_rows(store_data, report_intervals)))
+
+    def iter_csv():
+        yield ','.join(fields) + '\r\n'
+
+        for row in rows:
+            yield ','.join(map(str, row)) + '\r\n'
+
+    return StreamingResponse(iter_csv(), media_type='text/csv', headers={ "Content-Disposition": 'attachment; filename="live-report.csv"' })
+
+
+async def get_availability(db: AsyncSession, store_data: StoreMetadata, store_ids: list, start: datetime, end: datetime) -> list:
+    start, end = to_naive_utc(start), to_naive_utc(end)
+
+    if end <= start:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="end must be after start."
+        )
+
+    observations = await get_window_observations(db, store_ids, start, end)
+
+    # schedules and downtime are calculated outside of event loop
+    return await run_in_threadpool(calculate_stores_availability, observations, store_data, start, end)
+
+
+@app.get("/stores/{store_id}/availability", status_code=status.HTTP_200_OK, tags=["Store availability"])
+async def get_store_availability(store_id: int, start: datetime, end: datetime, store_data: StoreMetadata = Depends(get_store_data), db: AsyncSession = Depends(get_async_db)) -> StoreAvailability:
+    """
+    returns uptime and downtime (in minutes, within business hours) of a store between `start` and `end` (UTC when timezone is not given)
+    """
+    try:
+        availability = await get_availability(db, store_data, [store_id], start, end)
+
+        return availability[0]
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
+            detail="Error while calculating store availability."
+        )
+
+
+@app.post("/stores/availability", status_code=status.HTTP_200_OK, tags=["Store availability"])
+async def get_stores_availability(availability_request: StoreAvailabilityRequest, store_data: StoreMetadata = Depends(get_store_data), db: AsyncSession = Depends(get_async_db)) -> List[StoreAvailability]:
+    """
+    returns uptime and downtime of every store in `store_ids` between `start` and `end`
+    """
+    try:
+        # duplicates are answered once, order of store_ids is kept
+        store_ids = list(dict.fromkeys(availability_request.store_ids))
+
+        if not store_ids or len(store_ids) > max_batch_stores:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"store_ids must have between 1 and {max_batch_stores} stores."
+            )
+
+        return await get_availability(db, store_data, store_ids, availability_request.start, availability_request.end)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
+            detail="Error while calculating stores availability."
+        )
@@ -1,6 +1,8 @@
 import os
+from functools import lru_cache
 
-from sqlalchemy import URL, create_engine
+from sqlalchemy import URL, create_engine, event, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -17,11 +19,40 @@ url_object = URL.create(
     database=pg_database,
 )
 
+# any sqlalchemy url (e.g. sqlite database used by benchmarks) replaces postgres settings
+database_url = os.environ.get('DATABASE_URL')
+
 engine = create_engine(
-    url_object
+    database_url or url_object
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+@event.listens_for(engine, 'connect')
+def enable_sqlite_wal(dbapi_connection, connection_record) -> None:
+    '''
+    report rows, checkpoints and heartbeats are written through their own connections while report session streams observations.
+    sqlite in its default rollback journal mode lets an open read cursor block every other writer ("database is locked"), in WAL mode readers
+    and a writer run side by side. in-memory databases have no WAL, they keep blocking
+    '''
+    if engine.dialect.name == 'sqlite':
+        dbapi_connection.execute('PRAGMA journal_mode=WAL')
+
+# async drivers of api requests, report generation keeps using sync engine above
+async_drivers = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+# connections kept open by every api process, requests wait at most `pool_timeout` seconds for a connection
+async_pool_options = {
+    "pool_size": int(os.environ.get('DB_POOL_SIZE', 10)),
+    "max_overflow": int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    "pool_timeout": float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    # connections closed by database (e.g. idle timeout) are replaced before a request uses them
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+}
+
 Base = declarative_base()
 
 def get_db():
@@ -30,3 +61,28 @@ def get_db():
         yield db
     finally:
         db.close()
+
+@lru_cache(maxsize=None)
+def get_async_sessionmaker() -> async_sessionmaker:
+    '''
+    async engine is created on first api request, so scripts and worker processes never load async drivers
+    '''
+    async_url = make_url(database_url or url_object)
+    async_url = async_url.set(drivername=async_drivers[async_url.get_backend_name()])
+
+    # sqlite uses a single connection pool, its pool can't be sized
+    pool_options = async_pool_options if async_url.get_backend_name() != 'sqlite' else {}
+
+    async_engine = create_async_engine(async_url, **pool_options)
+
+    # loaded reports are returned after commit, attributes must not expire
+    return async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
+
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
+
+async def close_async_db() -> None:
+    if get_async_sessionmaker.cache_info().currsize:
+        await get_async_sessionmaker().kw['bind'].dispose()
+        get_async_sessionmaker.cache_clear()
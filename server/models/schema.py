@@ -0,0 +1,26 @@
+import uuid
+from datetime import datetime
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+
+from server.database import Base, engine
+# registers tables of every model on Base
+from server.models import status_intervals, store, uptime
+from server.models.store import DatabaseIdentity
+
+
+def create_schema(bind=engine) -> None:
+    '''
+    creates missing tables and indexes of all models and random id of database. called once by entry points (api startup, report_worker.py and scripts)
+    instead of on import, so importing models (e.g. in every report worker process) does not connect to database
+    '''
+    Base.metadata.create_all(bind)
+
+    try:
+        with bind.begin() as connection:
+            if connection.execute(select(DatabaseIdentity.id)).first() is None:
+                connection.execute(insert(DatabaseIdentity).values(id=1, database_id=str(uuid.uuid4()), created_at=datetime.utcnow()))
+    except IntegrityError:
+        # written by another process creating schema at the same time
+        pass
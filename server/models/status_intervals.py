@@ -0,0 +1,26 @@
+from sqlalchemy import Column, BigInteger, Integer, String, DateTime, PrimaryKeyConstraint
+
+from server.database import Base
+
+
+class StoreStatusInterval(Base):
+    __tablename__ = "store_status_intervals"
+
+    store_id = Column(BigInteger, nullable=False)
+    status = Column(String(8), nullable=False)
+    # first and last observation of a run of observations with the same status
+    first_seen = Column(DateTime(timezone=False), nullable=False)
+    last_seen = Column(DateTime(timezone=False), nullable=False)
+    observations = Column(Integer, nullable=False, default=1)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('store_id', 'first_seen'),
+    )
+
+class StatusIntervalCompaction(Base):
+    __tablename__ = "store_status_intervals_compaction"
+
+    compaction_id = Column(Integer, primary_key=True, autoincrement='auto')
+    # observations up to this id are included in store_status_intervals
+    last_observation_id = Column(BigInteger, nullable=False)
+    compacted_at = Column(DateTime(timezone=False), nullable=False)
@@ -1,24 +1,29 @@
-from sqlalchemy import Column, SmallInteger, BigInteger, Integer, String, DateTime
+from sqlalchemy import Column, SmallInteger, BigInteger, Integer, String, DateTime, Time, JSON, Index, PrimaryKeyConstraint
 
-from server.database import Base, engine
+from server.database import Base
 
 
 class RestaurantStatus(Base):
     __tablename__ = "restaurant_status"
 
-    observation_id = Column(BigInteger, primary_key=True, autoincrement='auto')
+    # sqlite only autoincrements INTEGER primary keys
+    observation_id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement='auto')
     store_id = Column(BigInteger, nullable=False)
     timestamp_utc = Column(DateTime(timezone=False), nullable=False)
     status = Column(String(8), nullable=False)
 
+# observations are always read by store in timestamp order, index gives that order without sorting.
+# on tables created before this index, it is added by `python migrate.py`
+observation_index = Index('ix_restaurant_status_store_id_timestamp_utc', RestaurantStatus.store_id, RestaurantStatus.timestamp_utc)
+
 class BusinessHours(Base):
     __tablename__ = "business_hours"
 
     id = Column(Integer, primary_key=True, autoincrement='auto')
     store_id = Column(BigInteger, nullable=False)
     day_of_week = Column(SmallInteger, nullable=False)
-    start_time_local = Column(DateTime(timezone=False), nullable=False)
-    end_time_local = Column(DateTime(timezone=False), nullable=False)
+    start_time_local = Column(Time(timezone=False), nullable=False)
+    end_time_local = Column(Time(timezone=False), nullable=False)
 
 class RestaurantTimezone(Base):
     __tablename__ = "restaurant_timezone"
@@ -30,7 +35,87 @@ class Report(Base):
     __tablename__ = "reports"
 
     report_id = Column(Integer, primary_key=True, autoincrement='auto')
-    status = Column(String(10), default='Running')
+    status = Column(String(10), default='Queued')
     report_csv_url = Column(String(2048))
+    # report file name within reports directory and its format (csv, csv.gz, parquet, arrow)
+    report_file = Column(String(256))
+    report_format = Column(String(16))
+    # queued reports with higher priority are picked first
+    priority = Column(Integer, nullable=False, default=0)
+    # report request (e.g. now, engine, source) which worker generates report from
+    parameters = Column(JSON)
+    stores_processed = Column(Integer, nullable=False, default=0)
+    stores_total = Column(Integer)
+    # identical report requests (same intervals and data) share one report, cleared when report fails so it can be retried
+    cache_key = Column(String(64), unique=True, nullable=True)
+    # progress of report written so far, next attempt resumes from it instead of starting over.
+    # {"store_id": last written store, "offset": bytes of partial file, "stores": stores written} or {"store_id_ranges": [...], "completed_shards": {index: stores}}
+    checkpoint = Column(JSON)
+    # number of times report was claimed by a worker, failed report is queued again until it reaches `REPORT_MAX_ATTEMPTS`
+    attempts = Column(Integer, nullable=False, default=0)
+    # updated by worker while it generates report, `Running` report with stale heartbeat belongs to a crashed worker and is queued again
+    heartbeat_at = Column(DateTime(timezone=False))
+    # watermark of completed report, max observation_id and metadata versions it was calculated from. incremental reports reuse rows of
+    # a report with the same metadata versions and recalculate only stores with observations after its observation_id
+    last_observation_id = Column(BigInteger)
+    metadata_versions = Column(JSON)
+    # rows of stores recalculated by incremental report, downloaded from `/reports/{report_id}/download?delta=true`
+    delta_file = Column(String(256))
+    report_delta_url = Column(String(2048))
+
+class ReportRow(Base):
+    __tablename__ = "report_rows"
+
+    report_id = Column(Integer, nullable=False)
+    store_id = Column(BigInteger, nullable=False)
+    # report window (e.g. last_hour, last_day), one row per store and window so reports with any windows share the table
+    report_window = Column(String(32), nullable=False)
+    # same values as report file, minutes for windows shorter than a day and hours otherwise
+    uptime = Column(Integer, nullable=False)
+    downtime = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('report_id', 'store_id', 'report_window'),
+    )
+
+# stores of a window sorted by downtime / uptime (e.g. worst 100 stores) are read from index without sorting
+report_rows_downtime_index = Index('ix_report_rows_report_id_window_downtime', ReportRow.report_id, ReportRow.report_window, ReportRow.downtime, ReportRow.store_id)
+report_rows_uptime_index = Index('ix_report_rows_report_id_window_uptime', ReportRow.report_id, ReportRow.report_window, ReportRow.uptime, ReportRow.store_id)
+
+class ReportShard(Base):
+    __tablename__ = "report_shards"
+
+    report_id = Column(Integer, nullable=False)
+    shard_index = Column(Integer, nullable=False)
+    # stores of shard, first and last store_id inclusive
+    first_store_id = Column(BigInteger, nullable=False)
+    last_store_id = Column(BigInteger, nullable=False)
+    # Queued, Running (leased by a worker) or Completed
+    status = Column(String(10), nullable=False, default='Queued')
+    # worker holding shard and until when, `Running` shard with expired lease is claimed again by worker of any replica
+    lease_owner = Column(String(128))
+    lease_expires_at = Column(DateTime(timezone=False))
+    # number of times shard was claimed, identifies a claim along with lease_owner
+    attempts = Column(Integer, nullable=False, default=0)
+    # stores written by completed shard
+    stores = Column(Integer)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('report_id', 'shard_index'),
+    )
+
+class DatasetVersion(Base):
+    __tablename__ = "dataset_versions"
+
+    # e.g. business_hours, timezones
+    name = Column(String(64), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=False))
+
+class DatabaseIdentity(Base):
+    __tablename__ = "database_identity"
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+    # single row written by `create_schema`, tells databases apart when they share dataset versions (e.g. cached metadata snapshots)
+    id = Column(Integer, primary_key=True)
+    database_id = Column(String(36), nullable=False)
+    created_at = Column(DateTime(timezone=False))
@@ -0,0 +1,25 @@
+from sqlalchemy import Column, BigInteger, Integer, DateTime, PrimaryKeyConstraint
+
+from server.database import Base
+
+
+class StoreHourlyUptime(Base):
+    __tablename__ = "store_hourly_uptime"
+
+    store_id = Column(BigInteger, nullable=False)
+    hour_utc = Column(DateTime(timezone=False), nullable=False)
+    # business hours within the hour, in microseconds so sums match calculations on raw observations
+    active_microseconds = Column(BigInteger, nullable=False, default=0)
+    inactive_microseconds = Column(BigInteger, nullable=False, default=0)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('store_id', 'hour_utc'),
+    )
+
+class HourlyUptimeRefresh(Base):
+    __tablename__ = "store_hourly_uptime_refresh"
+
+    refresh_id = Column(Integer, primary_key=True, autoincrement='auto')
+    # observations up to this id are included in store_hourly_uptime
+    last_observation_id = Column(BigInteger, nullable=False)
+    refreshed_at = Column(DateTime(timezone=False), nullable=False)
@@ -0,0 +1,17 @@
+from typing import List, Literal
+from pydantic import BaseModel
+
+from datetime import datetime
+
+class StoreAvailabilityRequest(BaseModel):
+    store_ids: List[int]
+    start: datetime
+    end: datetime
+
+class Observation(BaseModel):
+    store_id: int
+    timestamp_utc: datetime
+    status: Literal['active', 'inactive']
+
+class ObservationsRequest(BaseModel):
+    observations: List[Observation]
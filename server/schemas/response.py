@@ -1,25 +1,83 @@
 from enum import Enum
+from typing import Dict, List, Optional
 from pydantic import BaseModel
 
 from datetime import datetime
 
 class ReportStatus(Enum):
+    QUEUED='Queued',
     RUNNING='Running',
     COMPLETED='Completed',
     FAILED='Failed'
 
 
+class ReportEngine(str, Enum):
+    PYTHON='python'
+    NUMPY='numpy'
+
+
+class ReportSource(str, Enum):
+    OBSERVATIONS='observations'
+    HOURLY_UPTIME='hourly_uptime'
+    STATUS_INTERVALS='status_intervals'
+
+
+class ReportFormat(str, Enum):
+    CSV='csv'
+    CSV_GZIP='csv.gz'
+    PARQUET='parquet'
+    ARROW='arrow'
+
+
+class ReportRowSort(str, Enum):
+    STORE_ID='store_id'
+    UPTIME='uptime'
+    DOWNTIME='downtime'
+
+
+class SortOrder(str, Enum):
+    ASC='asc'
+    DESC='desc'
+
+
 class HealthResponse(BaseModel):
     status: str
 
 class ReportBase(BaseModel):
     report_id: int
     status: str
-    report_csv_url: str
+    report_csv_url: Optional[str]
+    report_delta_url: Optional[str]
+    report_format: Optional[str]
+    priority: int
+    stores_processed: int
+    stores_total: Optional[int]
 
     class Config:
         orm_mode = True
 
+class ReportRowBase(BaseModel):
+    store_id: int
+    uptime: Dict[str, int]
+    downtime: Dict[str, int]
+
+class ReportRows(BaseModel):
+    report_id: int
+    window: str
+    # unit of every window, minutes or hours
+    units: Dict[str, str]
+    rows: List[ReportRowBase]
+    next_cursor: Optional[str]
+
+class StoreAvailability(BaseModel):
+    store_id: int
+    start: datetime
+    end: datetime
+    observations: int
+    business_hours_minutes: float
+    uptime_minutes: Optional[float]
+    downtime_minutes: Optional[float]
+
 class RestaurantStatusBase(BaseModel):
     observation_id: int
     store_id: int
@@ -0,0 +1,148 @@
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+
+import numpy as np
+from sqlalchemy import asc, desc, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from server.models.store import RestaurantStatus
+from server.utils.business_hours import StoreSchedule, compile_store_schedule
+from server.utils.datetime_utils import to_epoch_microseconds
+from server.utils.store_metadata import StoreMetadata, get_business_hours
+from server.utils import store_availability_vectorized as vectorized
+
+
+# largest number of stores of a single batch availability request
+max_batch_stores = 500
+
+# compiled schedules of recently queried stores, stores with same business hours and timezone share an entry
+schedule_cache_size = 4096
+
+microseconds_in_min = 60 * 1000000
+
+
+def to_naive_utc(timestamp: datetime) -> datetime:
+    '''
+    naive timestamps are treated as UTC, `restaurant_status.timestamp_utc` is stored without timezone
+    '''
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return timestamp
+
+
+@lru_cache(maxsize=schedule_cache_size)
+def get_cached_schedule(schedule_key: tuple, span_start: date, span_end: date) -> StoreSchedule:
+    store_timezone, opens, closes = schedule_key
+
+    return compile_store_schedule(
+        get_business_hours(opens, closes),
+        store_timezone,
+        datetime.combine(span_start, time(), tzinfo=timezone.utc),
+        datetime.combine(span_end, time(), tzinfo=timezone.utc)
+    )
+
+
+def get_window_schedule(store_id: int, store_data: StoreMetadata, start: datetime, end: datetime) -> StoreSchedule:
+    '''
+    schedule covers whole UTC days around the window, so queries of nearby windows reuse the same compiled schedule
+    '''
+    return get_cached_schedule(store_data.get_schedule_key(store_id), start.date(), end.date() + timedelta(days=1))
+
+
+async def get_adjacent_observations(db: AsyncSession, store_ids: list, timestamp: datetime, before: bool) -> list:
+    '''
+    returns last observation of every store before timestamp (or first one at / after it), one index lookup per store
+    '''
+    adjacent_observations = [
+        select(
+            RestaurantStatus.store_id,
+            RestaurantStatus.timestamp_utc,
+            RestaurantStatus.status
+        ).where(
+            RestaurantStatus.store_id == store_id,
+            RestaurantStatus.timestamp_utc < timestamp if before else RestaurantStatus.timestamp_utc >= timestamp
+        ).order_by(
+            desc(RestaurantStatus.timestamp_utc) if before else asc(RestaurantStatus.timestamp_utc)
+        ).limit(1).subquery()
+        for store_id in store_ids
+    ]
+
+    return (await db.execute(union_all(*[select(*adjacent.c) for adjacent in adjacent_observations]))).all()
+
+
+async def get_window_observations(db: AsyncSession, store_ids: list, start: datetime, end: datetime) -> dict:
+    '''
+    returns observations of stores within [start, end) along with the last observation before start, which decides state at start of window,
+    and the first observation after end, which ends downtime of the last one like in reports. all are read through (store_id, timestamp_utc) index,
+    format {store_id: [(timestamp_utc, status), ...]}
+    '''
+    observations = { store_id: [] for store_id in store_ids }
+
+    for store_id, timestamp_utc, status in await get_adjacent_observations(db, store_ids, start, before=True):
+        observations[store_id].append((timestamp_utc, status))
+
+    window_rows = await db.execute(
+        select(
+            RestaurantStatus.store_id,
+            RestaurantStatus.timestamp_utc,
+            RestaurantStatus.status
+        ).where(
+            RestaurantStatus.store_id.in_(store_ids),
+            RestaurantStatus.timestamp_utc >= start,
+            RestaurantStatus.timestamp_utc < end
+        ).order_by(
+            asc(RestaurantStatus.store_id),
+            asc(RestaurantStatus.timestamp_utc)
+        )
+    )
+
+    for store_id, timestamp_utc, status in window_rows:
+        observations[store_id].append((timestamp_utc, status))
+
+    for store_id, timestamp_utc, status in await get_adjacent_observations(db, store_ids, end, before=False):
+        observations[store_id].append((timestamp_utc, status))
+
+    return observations
+
+
+def calculate_window_availability(store_id: int, status_entries: list, store_data: StoreMetadata, start: datetime, end: datetime) -> dict:
+    '''
+    uptime and downtime (in minutes) of a store within [start, end), calculated like report intervals.
+    store without any observation around the window has no uptime or downtime
+    '''
+    schedule = get_window_schedule(store_id, store_data, start, end)
+    window_bounds = { "window": (to_epoch_microseconds(start), to_epoch_microseconds(end)) }
+
+    business_hours = int(schedule.get_open_time(*window_bounds["window"]))
+    availability = {
+        "store_id": store_id,
+        "start": start,
+        "end": end,
+        "observations": len(status_entries),
+        "business_hours_minutes": round(business_hours / microseconds_in_min, 2),
+        "uptime_minutes": None,
+        "downtime_minutes": None
+    }
+
+    if not status_entries:
+        return availability
+
+    timestamps, statuses = vectorized.get_observation_arrays(status_entries)
+    total_uptime, total_downtime = vectorized.calculate_store_availability(timestamps, statuses, schedule, window_bounds)
+
+    availability["uptime_minutes"] = round(total_uptime["window"] / microseconds_in_min, 2)
+    availability["downtime_minutes"] = round(total_downtime["window"] / microseconds_in_min, 2)
+
+    # observations right before and after window are not part of it
+    window_start, window_end = window_bounds["window"]
+    availability["observations"] = int(np.count_nonzero((timestamps >= window_start) & (timestamps < window_end)))
+
+    return availability
+
+
+def calculate_stores_availability(observations: dict, store_data: StoreMetadata, start: datetime, end: datetime) -> list:
+    return [
+        calculate_window_availability(store_id, status_entries, store_data, start, end)
+        for store_id, status_entries in observations.items()
+    ]
@@ -0,0 +1,232 @@
+import os
+import traceback
+import uuid
+from contextlib import closing
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from server.models.store import Report
+from server.utils.business_hours import StoreSchedule, get_report_span, get_store_schedule
+from server.utils.datetime_utils import default_report_windows, get_report_bounds, get_report_intervals, get_report_windows, to_epoch_microseconds
+from server.utils.incremental_report import get_observation_watermark
+from server.utils.report import get_report_cache_key
+from server.utils.report_checkpoint import start_heartbeat
+from server.utils.report_rows import ReportRowsWriter, delete_report_rows
+from server.utils.report_writer import reports_dir, get_report_filename, open_report_writer
+from server.utils.store_availability import format_report_row, get_downtime_intervals, get_report_fields
+from server.utils.store_details import stream_restaurant_status
+from server.utils.store_metadata import StoreMetadata
+from server.utils import store_availability_vectorized as vectorized
+
+
+def get_backfill_now(day: date) -> datetime:
+    '''
+    report of a day is generated as if it was requested at midnight (UTC) after it, so `last_day` is that day and `last_hour` its last hour
+    '''
+    return datetime.combine(day + timedelta(days=1), time(), tzinfo=timezone.utc)
+
+
+def create_backfill_reports(db: Session, store_data: StoreMetadata, start: date, end: date, windows: list, engine: str, report_format: str) -> list:
+    '''
+    creates `Running` report of every day from start to end (inclusive), returns [(report, report_intervals), ...] in day order.
+    days which already have a report of the same observations and metadata (same cache key as `/trigger_report`) are skipped
+    '''
+    last_observation_id = get_observation_watermark(db)
+    reports = []
+
+    for day in range((end - start).days + 1):
+        now = get_backfill_now(start + timedelta(days=day))
+        report_intervals = get_report_intervals(now, windows)
+        cache_key = get_report_cache_key(report_intervals, last_observation_id, store_data.versions, 'observations', report_format)
+
+        if db.execute(select(Report.report_id).where(Report.cache_key == cache_key)).first():
+            continue
+
+        report = Report(
+            status='Running',
+            cache_key=cache_key,
+            # parameters of a queued report, report worker generates it on its own when backfill fails
+            parameters={ "now": now.isoformat(), "engine": engine, "source": 'observations', "format": report_format, "windows": windows, "backfill": True },
+            report_file=get_report_filename(f"report-{str(uuid.uuid4())}", report_format),
+            attempts=1,
+            heartbeat_at=datetime.utcnow(),
+            # watermark of completed report, backfilled days are bases of incremental reports like any other report
+            last_observation_id=last_observation_id,
+            metadata_versions=store_data.versions
+        )
+        db.add(report)
+        reports.append((report, report_intervals))
+
+    db.commit()
+
+    return reports
+
+
+def get_days_downtime_until(downtime_start: np.ndarray, downtime_end: np.ndarray, schedule: StoreSchedule, first_timestamps: np.ndarray, last_timestamps: np.ndarray, boundaries: np.ndarray) -> np.ndarray:
+    '''
+    returns business hours of downtime (in microseconds) before `boundaries` (days x boundaries) of every day, as report of the day calculates it from
+    its own observations [first_timestamps, last_timestamps]. downtime intervals of all days are looked up once, only the interval running into first
+    observation of a day and the one ongoing at its last observation differ from intervals of the day: downtime before first observation is not counted
+    and downtime ongoing at last observation is extrapolated till end of its business hours instead of lasting until next observation
+    '''
+    downtime_until = vectorized.get_downtime_until(downtime_start, downtime_end, schedule, boundaries.ravel()).reshape(boundaries.shape)
+
+    if not len(downtime_start):
+        return downtime_until
+
+    first = first_timestamps[:, None]
+    last = last_timestamps[:, None]
+    extrapolated_end = schedule.get_close_time(last_timestamps)[:, None]
+
+    head = np.searchsorted(downtime_start, first_timestamps, side='left') - 1
+    tail = np.searchsorted(downtime_start, last_timestamps, side='right') - 1
+
+    is_head = (head >= 0) & (downtime_end[np.maximum(head, 0)] >= first_timestamps)
+    is_tail = (tail >= 0) & (downtime_end[np.maximum(tail, 0)] > last_timestamps)
+
+    # interval running into first observation can also be ongoing at last one, it is corrected once
+    for interval, is_edge in ((head, is_head), (tail, is_tail & ~(is_head & (head == tail)))):
+        start = downtime_start[np.maximum(interval, 0)][:, None]
+        end = downtime_end[np.maximum(interval, 0)][:, None]
+
+        day_start = np.maximum(start, first)
+        day_end = np.where((start <= last) & (last < end), extrapolated_end, end)
+
+        correction = schedule.get_open_time(day_start, np.minimum(day_end, boundaries)) - schedule.get_open_time(start, np.minimum(end, boundaries))
+        downtime_until += np.where(is_edge[:, None], correction, 0)
+
+    return downtime_until
+
+
+def write_backfill_rows(db: Session, store_data: StoreMetadata, reports: list, writers: list, engine: str = 'numpy') -> list:
+    '''
+    reads observations of all days once in (store_id, timestamp_utc) order. downtime intervals of a store are found once from observations of all days
+    (by `python` loop or `numpy` arrays), downtime and business hours before window boundaries of every day are then looked up in one batch, so windows
+    which overlap between days (e.g. last_week of consecutive days) are not walked again for every day. edges of every day's span are corrected
+    by `get_days_downtime_until`, so each day is identical to its own report. returns number of stores written into every day's writer
+    '''
+    days = [(get_report_span(report_intervals), get_report_bounds(report_intervals)) for _, report_intervals in reports]
+
+    # one schedule of every store covers all days
+    span_intervals = {
+        "span_start": min(span_start for (span_start, _), _ in days),
+        "span_end": max(span_end for (_, span_end), _ in days),
+    }
+    day_spans = np.array([[to_epoch_microseconds(start), to_epoch_microseconds(end)] for (start, end), _ in days], dtype=np.int64)
+
+    # every day has the same windows, (days x windows x [start, end])
+    windows = list(days[0][1])
+    window_bounds = np.array([[report_bounds[window] for window in windows] for _, report_bounds in days], dtype=np.int64)
+
+    schedules = {}
+    total_stores = [0] * len(days)
+
+    stores = stream_restaurant_status(db, span_intervals)
+
+    with closing(stores):
+        for store_id, status_entries in stores:
+            timestamps, statuses = vectorized.get_observation_arrays(status_entries)
+            schedule = get_store_schedule(store_id, store_data, span_intervals, schedules)
+
+            # observations within [span start, span end] of every day, days without observations get no row
+            first = np.searchsorted(timestamps, day_spans[:, 0], side='left')
+            last = np.searchsorted(timestamps, day_spans[:, 1], side='right')
+            day_indexes = np.flatnonzero(first < last)
+
+            if not len(day_indexes):
+                continue
+
+            if engine == 'numpy':
+                downtime_start, downtime_end = vectorized.get_downtime_intervals(timestamps, statuses, schedule)
+            else:
+                downtime_start, downtime_end = np.array(get_downtime_intervals(status_entries, schedule), dtype=np.int64).reshape(-1, 2).T
+
+            bounds = window_bounds[day_indexes]
+
+            downtime_until = get_days_downtime_until(
+                downtime_start,
+                downtime_end,
+                schedule,
+                timestamps[first[day_indexes]],
+                timestamps[last[day_indexes] - 1],
+                bounds.reshape(len(day_indexes), -1)
+            ).reshape(bounds.shape)
+            open_time = schedule.get_open_time_until(bounds)
+
+            total_downtime = (downtime_until[..., 1] - downtime_until[..., 0]).tolist()
+            total_uptime = (np.maximum(open_time[..., 1] - open_time[..., 0], 0) - downtime_until[..., 1] + downtime_until[..., 0]).tolist()
+
+            for row, index in enumerate(day_indexes.tolist()):
+                report_bounds = days[index][1]
+
+                writers[index].writerow(format_report_row(store_id, dict(zip(windows, total_uptime[row])), dict(zip(windows, total_downtime[row])), report_bounds))
+                total_stores[index] += 1
+
+    return total_stores
+
+
+def backfill_reports(db: Session, store_data: StoreMetadata, start: date, end: date, windows: Optional[list] = None, engine: str = 'numpy', report_format: str = 'csv') -> list:
+    '''
+    generates report of every day from start to end (inclusive) in a single sweep over observations instead of one report (and observations query) per day,
+    each report is identical to a report requested at midnight after its day and is downloaded or paged like any other report.
+    when backfill fails, its reports are queued and generated one by one by report workers. returns ids of generated reports
+    '''
+    windows = windows or default_report_windows
+    reports = create_backfill_reports(db, store_data, start, end, windows, engine, report_format)
+
+    if not reports:
+        return []
+
+    report_ids = [report.report_id for report, _ in reports]
+    writers = []
+
+    # reports are not taken over by report workers while backfill is running
+    stop_heartbeat = start_heartbeat(report_ids)
+
+    try:
+        for report, report_intervals in reports:
+            writer = open_report_writer(os.path.join(reports_dir, report.report_file), report_format, get_report_fields(get_report_bounds(report_intervals)))
+            writers.append(ReportRowsWriter(writer, report.report_id, get_report_windows(report_intervals)))
+
+        total_stores = write_backfill_rows(db, store_data, reports, writers, engine)
+
+        for writer in writers:
+            writer.close()
+
+        writers = []
+
+        for (report, _), stores in zip(reports, total_stores):
+            report.status = 'Completed'
+            report.report_csv_url = f'/reports/{report.report_id}/download'
+            report.report_format = report_format
+            report.stores_processed = stores
+            report.stores_total = stores
+
+        db.commit()
+
+        return report_ids
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+
+        db.rollback()
+
+        for writer in writers:
+            writer.abort()
+
+        for report, _ in reports:
+            delete_report_rows(report.report_id)
+            report.status = 'Queued'
+
+            if os.path.exists(os.path.join(reports_dir, report.report_file)):
+                os.remove(os.path.join(reports_dir, report.report_file))
+
+        db.commit()
+
+        return []
+    finally:
+        stop_heartbeat.set()
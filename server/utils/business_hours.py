@@ -0,0 +1,139 @@
+from datetime import datetime, time, timedelta
+
+import numpy as np
+from dateutil import tz
+
+from server.utils.datetime_utils import get_timezone, to_epoch_microseconds
+
+
+default_timezone = 'America/Chicago'
+
+
+class StoreSchedule:
+    '''
+    business hours of a store compiled into sorted, non overlapping UTC open intervals [opens[i], closes[i]) in epoch microseconds,
+    so business hours overlap of any time range becomes a binary search instead of timezone and day of week calculations
+    '''
+
+    def __init__(self, opens: np.ndarray, closes: np.ndarray):
+        self.opens = opens
+        self.closes = closes
+
+        # open time before start of every interval
+        durations = closes - opens
+        self.open_before = np.cumsum(durations) - durations
+
+    def get_open_time_until(self, timestamps):
+        '''
+        returns business hours (in microseconds) between start of schedule and timestamps
+        '''
+        index = np.searchsorted(self.opens, timestamps, side='right') - 1
+        interval = np.maximum(index, 0)
+
+        open_time = self.open_before[interval] + np.clip(
+            timestamps - self.opens[interval],
+            0,
+            self.closes[interval] - self.opens[interval]
+        )
+
+        return np.where(index >= 0, open_time, 0)
+
+    def get_open_time(self, start, end):
+        '''
+        returns business hours (in microseconds) within [start, end)
+        '''
+        return np.maximum(self.get_open_time_until(end) - self.get_open_time_until(start), 0)
+
+    def get_close_time(self, timestamps):
+        '''
+        returns end of business hours interval containing timestamps, timestamps outside of business hours are returned as is
+        '''
+        index = np.searchsorted(self.opens, timestamps, side='right') - 1
+        interval = np.maximum(index, 0)
+
+        is_open = (index >= 0) & (timestamps < self.closes[interval])
+
+        return np.where(is_open, self.closes[interval], timestamps)
+
+
+def get_report_span(report_intervals: dict) -> tuple:
+    return min(report_intervals.values()), max(report_intervals.values())
+
+
+def compile_store_schedule(store_business_hours: dict, store_timezone: str, span_start: datetime, span_end: datetime) -> StoreSchedule:
+    '''
+    builds UTC open intervals of a store between span_start and span_end from its local business hours.
+    every local day is converted with its own utc offset, so schedule stays correct across DST changes
+    '''
+    # unknown timezones are treated as UTC
+    target_tz = get_timezone(store_timezone) or tz.UTC
+
+    span_start_us = to_epoch_microseconds(span_start)
+    span_end_us = to_epoch_microseconds(span_end)
+
+    # overnight business hours of previous local day may still be running at span start
+    local_day = span_start.astimezone(target_tz).date() - timedelta(days=1)
+    last_local_day = span_end.astimezone(target_tz).date()
+
+    intervals = []
+
+    while local_day <= last_local_day:
+        start_time_local, end_time_local = store_business_hours.get(local_day.weekday(), (None, None))
+
+        if start_time_local and end_time_local:
+            open_local = datetime.combine(local_day, start_time_local, tzinfo=target_tz)
+            close_local = datetime.combine(local_day, end_time_local, tzinfo=target_tz)
+
+            # business hours like 20:00 - 03:00 end on next day
+            if end_time_local < start_time_local:
+                close_local = datetime.combine(local_day + timedelta(days=1), end_time_local, tzinfo=target_tz)
+        else:
+            # store is open all day when business_hours is not available
+            open_local = datetime.combine(local_day, time(), tzinfo=target_tz)
+            close_local = datetime.combine(local_day + timedelta(days=1), time(), tzinfo=target_tz)
+
+        intervals.append((
+            max(to_epoch_microseconds(open_local), span_start_us),
+            min(to_epoch_microseconds(close_local), span_end_us)
+        ))
+
+        local_day += timedelta(days=1)
+
+    opens = []
+    closes = []
+
+    # merge overlapping intervals (e.g. overnight hours running into next day's hours) and drop empty ones.
+    # back to back days are kept apart, so business hours of a store open all day still end at local midnight
+    for open_us, close_us in sorted(intervals):
+        if close_us <= open_us:
+            continue
+
+        if closes and open_us < closes[-1]:
+            closes[-1] = max(closes[-1], close_us)
+        else:
+            opens.append(open_us)
+            closes.append(close_us)
+
+    # store which never opens within span gets a single empty interval
+    if not opens:
+        opens.append(span_start_us)
+        closes.append(span_start_us)
+
+    return StoreSchedule(np.array(opens, dtype=np.int64), np.array(closes, dtype=np.int64))
+
+
+def get_store_schedule(store_id: int, store_data, report_intervals: dict, schedules: dict) -> StoreSchedule:
+    '''
+    returns compiled schedule of a store, stores sharing business hours and timezone share one schedule within `schedules`.
+    `store_data` is `StoreMetadata` snapshot
+    '''
+    schedule_key = store_data.get_schedule_key(store_id)
+
+    if schedule_key not in schedules:
+        schedules[schedule_key] = compile_store_schedule(
+            store_data.get_business_hours(store_id),
+            store_data.get_timezone(store_id),
+            *get_report_span(report_intervals)
+        )
+
+    return schedules[schedule_key]
@@ -1,27 +1,108 @@
-from datetime import datetime, timedelta
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import Optional
+
 from dateutil import tz
 
-def get_report_intervals(now: datetime) -> dict:
-    last_hour_start = now - timedelta(hours=1, minutes=now.minute, seconds=now.second)
-    last_hour_end = last_hour_start + timedelta(hours=1)
+epoch = datetime(1970, 1, 1)
+one_microsecond = timedelta(microseconds=1)
+
+# windows of a report when request does not choose them
+default_report_windows = ['last_hour', 'last_day', 'last_week']
+
+# largest number of windows (after `each_day_<n>` is expanded) of a single report
+max_report_windows = 64
+
+window_units = {
+    'm': timedelta(minutes=1),
+    'h': timedelta(hours=1),
+    'd': timedelta(days=1),
+    'w': timedelta(weeks=1),
+}
+
+rolling_window_pattern = re.compile(r'^last_(\d+)([mhdw])$')
+daily_windows_pattern = re.compile(r'^each_day_(\d+)$')
+
+def get_report_intervals(now: datetime, windows: Optional[list] = None) -> dict:
+    '''
+    returns start and end of every report window, windows are
+    `last_hour`, `last_day`, `last_week`: previous whole hour, day and week (e.g. 17:00 - 18:00 at 18:13),
+    `last_<n><m|h|d|w>`: n minutes, hours, days or weeks until now (e.g. last_15m, last_4h, last_30d),
+    `each_day_<n>`: each of n previous whole days, named day_1 (same as last_day) to day_<n>.
+    format {"<window>_start": datetime, "<window>_end": datetime, ...} in windows order, raises ValueError for unknown window
+    '''
+    today_start = now - timedelta(hours=now.hour, minutes=now.minute, seconds=now.second)
+
+    aligned_windows = {
+        "last_hour": (now - timedelta(hours=1, minutes=now.minute, seconds=now.second), timedelta(hours=1)),
+        "last_day": (today_start - timedelta(days=1), timedelta(days=1)),
+        "last_week": (today_start - timedelta(weeks=1, days=now.weekday()), timedelta(weeks=1)),
+    }
+
+    report_intervals = {}
+
+    for window in windows or default_report_windows:
+        window = window.strip()
+        rolling_window = rolling_window_pattern.match(window)
+        daily_windows = daily_windows_pattern.match(window)
+
+        if window in aligned_windows:
+            start, length = aligned_windows[window]
+            spans = [(window, start, start + length)]
+        elif rolling_window and int(rolling_window.group(1)) > 0:
+            spans = [(window, now - int(rolling_window.group(1)) * window_units[rolling_window.group(2)], now)]
+        elif daily_windows and 0 < int(daily_windows.group(1)) <= max_report_windows:
+            spans = [
+                (f'day_{day}', today_start - timedelta(days=day), today_start - timedelta(days=day - 1))
+                for day in range(1, int(daily_windows.group(1)) + 1)
+            ]
+        else:
+            raise ValueError(f'unknown report window: {window}')
 
-    last_day_start = now - timedelta(days=1, hours=now.hour, minutes=now.minute, seconds=now.second)
-    last_day_end = last_day_start + timedelta(days=1)
-    
-    last_week_start = now - timedelta(weeks=1, days=now.weekday(), hours=now.hour, minutes=now.minute, seconds=now.second)
-    last_week_end = last_week_start + timedelta(weeks=1)
+        for name, start, end in spans:
+            report_intervals[f'{name}_start'] = start
+            report_intervals[f'{name}_end'] = end
 
+    if len(report_intervals) > 2 * max_report_windows:
+        raise ValueError(f'report can have at most {max_report_windows} windows')
+
+    return report_intervals
+
+def get_report_windows(report_intervals: dict) -> list:
+    return [key[:-len('_start')] for key in report_intervals if key.endswith('_start')]
+
+def get_report_bounds(report_intervals: dict) -> dict:
+    '''
+    converts report_intervals into epoch microseconds (start, end) of every interval
+    format {"last_hour": (start, end), "last_day": (start, end), "last_week": (start, end)}
+    '''
     return {
-        "last_hour_start": last_hour_start,
-        "last_hour_end": last_hour_end,
-        "last_day_start": last_day_start,
-        "last_day_end": last_day_end,
-        "last_week_start": last_week_start,
-        "last_week_end": last_week_end
+        interval: (
+            to_epoch_microseconds(report_intervals[f'{interval}_start']),
+            to_epoch_microseconds(report_intervals[f'{interval}_end'])
+        )
+        for interval in get_report_windows(report_intervals)
     }
 
+def to_epoch_microseconds(timestamp: datetime) -> int:
+    '''
+    naive timestamps are treated as UTC
+    '''
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return (timestamp - epoch) // one_microsecond
+
+@lru_cache(maxsize=None)
+def get_timezone(timezone: str):
+    '''
+    resolves timezone once per distinct timezone string
+    '''
+    return tz.gettz(timezone)
+
 def convert_utc_to_local(timestamp: datetime, timezone: str) -> datetime:
-    target_tz = tz.gettz(timezone)
+    target_tz = get_timezone(timezone)
 
     return timestamp.astimezone(target_tz)
 
@@ -32,7 +113,7 @@ def convert_local_to_utc(local_time: datetime.time, timezone: str) -> datetime.t
     # Combine the local_time and dummy_date to create a datetime object
     local_datetime = datetime.combine(dummy_date, local_time)
 
-    local_timezone = tz.gettz(timezone)
+    local_timezone = get_timezone(timezone)
 
     local_datetime_with_tz = local_datetime.replace(tzinfo=local_timezone)
     utc_datetime = local_datetime_with_tz.astimezone(tz.UTC)
@@ -41,7 +122,3 @@ def convert_local_to_utc(local_time: datetime.time, timezone: str) -> datetime.t
     utc_time = utc_datetime.time()
 
     return utc_time
-
-
-
-
@@ -0,0 +1,277 @@
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterator, Tuple
+
+import numpy as np
+from sqlalchemy import and_, asc, case, delete, false, func, insert, select
+from sqlalchemy.orm import Session
+
+from server.models.store import RestaurantStatus
+from server.models.uptime import StoreHourlyUptime, HourlyUptimeRefresh
+from server.utils.business_hours import compile_store_schedule
+from server.utils.datetime_utils import get_report_bounds, to_epoch_microseconds
+from server.utils.store_metadata import StoreMetadata
+from server.utils import store_availability_vectorized as vectorized
+
+
+microseconds_in_hour = 60 * 60 * 1000000
+
+# schedule of refreshed store has to cover extrapolated downtime (till end of business hours) of its last observation
+schedule_margin = timedelta(days=2)
+
+# stores refreshed together, keeps `IN (...)` lists within database parameter limits
+store_chunk_size = 500
+insert_batch_size = 10000
+
+# postgres advisory lock key which serializes rollup refreshes (report queue claims use 8100)
+hourly_uptime_lock_id = 8101
+
+
+def floor_hour(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def lock_hourly_uptime(db: Session) -> None:
+    '''
+    serializes refreshes of reports and `load_data.py` of every replica until transaction of `db` ends, a refresh waiting for the lock
+    reads watermark moved by the previous one and refreshes only what is left, instead of inserting the same rollup rows again
+    '''
+    if db.bind.dialect.name == 'postgresql':
+        db.execute(select(func.pg_advisory_xact_lock(hourly_uptime_lock_id)))
+    else:
+        # sqlite has a single writer, a write matching no row takes its lock before watermark is read
+        db.execute(delete(HourlyUptimeRefresh).where(false()))
+
+
+def get_last_refreshed_observation_id(db: Session) -> int:
+    return db.execute(select(func.max(HourlyUptimeRefresh.last_observation_id))).scalar() or 0
+
+
+def get_refresh_start(db: Session, last_observation_id: int, max_observation_id: int) -> dict:
+    '''
+    returns hour from which rollup of every store with new observations has to be recomputed, format {store_id: hour_utc}.
+    new observations also change downtime of the observation right before them (it was extrapolated till end of business hours),
+    so recomputation starts at hour of that observation
+    '''
+    new_observations = select(
+            RestaurantStatus.store_id,
+            func.min(RestaurantStatus.timestamp_utc).label('first_timestamp_utc')
+        ).where(
+            RestaurantStatus.observation_id > last_observation_id,
+            RestaurantStatus.observation_id <= max_observation_id
+        ).group_by(
+            RestaurantStatus.store_id
+        ).subquery()
+
+    previous_timestamp = select(
+            func.max(RestaurantStatus.timestamp_utc)
+        ).where(
+            RestaurantStatus.store_id == new_observations.c.store_id,
+            RestaurantStatus.timestamp_utc < new_observations.c.first_timestamp_utc
+        ).scalar_subquery()
+
+    rows = db.execute(select(new_observations.c.store_id, new_observations.c.first_timestamp_utc, previous_timestamp))
+
+    return { store_id: floor_hour(previous or first) for store_id, first, previous in rows }
+
+
+def get_last_observations_before(db: Session, store_ids: list, timestamp: datetime, max_observation_id: int) -> dict:
+    '''
+    returns last observation of every store before timestamp, format {store_id: (timestamp_utc, status)}
+    '''
+    last_observations = select(
+            RestaurantStatus.store_id,
+            func.max(RestaurantStatus.timestamp_utc).label('timestamp_utc')
+        ).where(
+            RestaurantStatus.store_id.in_(store_ids),
+            RestaurantStatus.timestamp_utc < timestamp,
+            RestaurantStatus.observation_id <= max_observation_id
+        ).group_by(
+            RestaurantStatus.store_id
+        ).subquery()
+
+    rows = db.execute(
+        select(
+            RestaurantStatus.store_id,
+            RestaurantStatus.timestamp_utc,
+            RestaurantStatus.status
+        ).join(
+            last_observations,
+            and_(
+                RestaurantStatus.store_id == last_observations.c.store_id,
+                RestaurantStatus.timestamp_utc == last_observations.c.timestamp_utc
+            )
+        )
+    )
+
+    return { store_id: (timestamp_utc, status) for store_id, timestamp_utc, status in rows }
+
+
+def calculate_hourly_uptime(store_id: int, status_entries: list, refresh_start: datetime, schedule) -> list:
+    '''
+    returns rollup rows of a store from refresh_start till extrapolated end of its last observation.
+    status_entries are sorted by timestamp_utc and may start with last observation before refresh_start
+    '''
+    timestamps, statuses = vectorized.get_observation_arrays(status_entries)
+    downtime_start, downtime_end = vectorized.get_downtime_intervals(timestamps, statuses, schedule)
+
+    # downtime carried in from observation before refresh_start is counted from refresh_start
+    refresh_start_us = to_epoch_microseconds(refresh_start)
+    downtime_start = np.maximum(downtime_start, refresh_start_us)
+
+    refresh_end_us = max(int(timestamps[-1]), int(downtime_end.max()) if len(downtime_end) else 0)
+    hours = -(-(refresh_end_us - refresh_start_us) // microseconds_in_hour)
+    hour_bounds = refresh_start_us + np.arange(max(hours, 1) + 1, dtype=np.int64) * microseconds_in_hour
+
+    inactive = np.diff(vectorized.get_downtime_until(downtime_start, downtime_end, schedule, hour_bounds))
+    active = np.diff(schedule.get_open_time_until(hour_bounds)) - inactive
+
+    return [
+        {
+            'store_id': store_id,
+            'hour_utc': refresh_start + timedelta(hours=hour),
+            'active_microseconds': int(active[hour]),
+            'inactive_microseconds': int(inactive[hour])
+        }
+        for hour in range(len(active))
+    ]
+
+
+def refresh_stores(db: Session, store_data: StoreMetadata, store_ids: list, refresh_start: datetime, max_observation_id: int) -> None:
+    '''
+    replaces rollup rows of given stores from refresh_start onwards
+    '''
+    previous_observations = get_last_observations_before(db, store_ids, refresh_start, max_observation_id)
+
+    db.execute(
+        delete(StoreHourlyUptime).where(
+            StoreHourlyUptime.store_id.in_(store_ids),
+            StoreHourlyUptime.hour_utc >= refresh_start
+        )
+    )
+
+    observations = db.execute(
+        select(
+            RestaurantStatus.store_id,
+            RestaurantStatus.timestamp_utc,
+            RestaurantStatus.status
+        ).where(
+            RestaurantStatus.store_id.in_(store_ids),
+            RestaurantStatus.timestamp_utc >= refresh_start,
+            RestaurantStatus.observation_id <= max_observation_id
+        ).order_by(
+            asc(RestaurantStatus.store_id),
+            asc(RestaurantStatus.timestamp_utc)
+        )
+    ).all()
+
+    rows = []
+
+    for store_id, store_observations in groupby(observations, key=itemgetter(0)):
+        status_entries = [(timestamp_utc, status) for _, timestamp_utc, status in store_observations]
+
+        if store_id in previous_observations:
+            status_entries.insert(0, previous_observations[store_id])
+
+        schedule = compile_store_schedule(
+            store_data.get_business_hours(store_id),
+            store_data.get_timezone(store_id),
+            refresh_start.replace(tzinfo=timezone.utc),
+            status_entries[-1][0].replace(tzinfo=timezone.utc) + schedule_margin
+        )
+
+        rows.extend(calculate_hourly_uptime(store_id, status_entries, refresh_start, schedule))
+
+        if len(rows) >= insert_batch_size:
+            db.execute(insert(StoreHourlyUptime), rows)
+            rows = []
+
+    if rows:
+        db.execute(insert(StoreHourlyUptime), rows)
+
+
+def refresh_hourly_uptime(db: Session, store_data: StoreMetadata) -> int:
+    '''
+    recomputes `store_hourly_uptime` only for hours touched by observations which arrived since last refresh, returns number of refreshed stores
+    '''
+    lock_hourly_uptime(db)
+
+    last_observation_id = get_last_refreshed_observation_id(db)
+    max_observation_id = db.execute(select(func.max(RestaurantStatus.observation_id))).scalar()
+
+    if max_observation_id is None or max_observation_id <= last_observation_id:
+        # releases the lock
+        db.commit()
+        return 0
+
+    refresh_start = get_refresh_start(db, last_observation_id, max_observation_id)
+
+    # stores sharing refresh start hour (usually all of them when observations arrive hourly) are refreshed together
+    stores_by_refresh_start = {}
+
+    for store_id, hour_utc in refresh_start.items():
+        stores_by_refresh_start.setdefault(hour_utc, []).append(store_id)
+
+    for hour_utc, store_ids in sorted(stores_by_refresh_start.items()):
+        store_ids.sort()
+
+        for index in range(0, len(store_ids), store_chunk_size):
+            refresh_stores(db, store_data, store_ids[index:index + store_chunk_size], hour_utc, max_observation_id)
+
+    db.add(HourlyUptimeRefresh(last_observation_id=max_observation_id, refreshed_at=datetime.utcnow()))
+    db.commit()
+
+    return len(refresh_start)
+
+
+def is_hour_aligned(report_intervals: dict) -> bool:
+    '''
+    rollup rows cover whole hours, so only windows starting and ending on an hour can be summed from them
+    '''
+    return all(
+        value.minute == 0 and value.second == 0 and value.microsecond == 0
+        for value in report_intervals.values()
+    )
+
+
+def get_hourly_downtime(db: Session, report_intervals: dict) -> Iterator[Tuple[int, dict]]:
+    '''
+    sums rollup rows (at most one per hour) of every store within report_intervals.
+    yields (store_id, {"last_hour": downtime, "last_day": downtime, "last_week": downtime, ...}) in store_id order, downtime is in microseconds
+    '''
+    report_intervals = { key: value.astimezone(timezone.utc).replace(tzinfo=None) for key, value in report_intervals.items() }
+    intervals = list(get_report_bounds(report_intervals))
+
+    downtime_columns = [
+        func.sum(
+            case(
+                (
+                    and_(
+                        StoreHourlyUptime.hour_utc >= report_intervals[f'{interval}_start'],
+                        StoreHourlyUptime.hour_utc < report_intervals[f'{interval}_end']
+                    ),
+                    StoreHourlyUptime.inactive_microseconds
+                ),
+                else_=0
+            )
+        ).label(interval)
+        for interval in intervals
+    ]
+
+    rows = db.execute(
+        select(
+            StoreHourlyUptime.store_id,
+            *downtime_columns
+        ).where(
+            StoreHourlyUptime.hour_utc >= min(report_intervals.values()),
+            StoreHourlyUptime.hour_utc < max(report_intervals.values())
+        ).group_by(
+            StoreHourlyUptime.store_id
+        ).order_by(
+            asc(StoreHourlyUptime.store_id)
+        )
+    )
+
+    for row in rows:
+        yield row.store_id, { interval: int(row._mapping[interval] or 0) for interval in intervals }
@@ -0,0 +1,292 @@
+from contextlib import nullcontext
+from datetime import datetime
+from typing import Iterator, Optional, Tuple
+
+from sqlalchemy import and_, asc, desc, func, or_, select, union_all
+from sqlalchemy.orm import Session, aliased
+
+from server.models.store import Report, ReportRow, RestaurantStatus
+from server.utils.business_hours import get_report_span, get_store_schedule
+from server.utils.datetime_utils import get_report_bounds, get_report_intervals, get_report_windows
+from server.utils.metrics import ReportTimer
+from server.utils.store_details import get_observation_query, get_store_ids, group_observations
+from server.utils.store_metadata import StoreMetadata
+
+
+# completed reports looked at when searching for a base report
+base_report_candidates = 20
+
+# changed stores read together, keeps `IN (...)` lists within database parameter limits
+store_chunk_size = 500
+
+
+def get_observation_watermark(db: Session) -> int:
+    '''
+    max observation_id before report reads observations, observations arriving while report is generated are picked up by the next one
+    '''
+    return db.execute(select(func.max(RestaurantStatus.observation_id))).scalar() or 0
+
+
+def find_base_report(db: Session, report: Report, report_intervals: dict, store_data: StoreMetadata) -> Optional[Report]:
+    '''
+    latest completed report of raw observations with the same windows, an observation watermark and the same metadata versions as `store_data`,
+    requested at or before `report`. its rows are reused by incremental report, None when there is no such report
+    '''
+    windows = get_report_windows(report_intervals)
+    now = datetime.fromisoformat((report.parameters or {})['now'])
+
+    candidates = db.execute(
+        select(Report).where(
+            Report.status == 'Completed',
+            Report.report_id != report.report_id,
+            Report.last_observation_id != None
+        ).order_by(
+            desc(Report.report_id)
+        ).limit(base_report_candidates)
+    ).scalars().all()
+
+    for candidate in candidates:
+        parameters = candidate.parameters or {}
+
+        if (
+            parameters.get('source', 'observations') == 'observations'
+            and candidate.metadata_versions == store_data.versions
+            and get_report_windows(get_report_intervals(datetime.fromisoformat(parameters['now']), parameters.get('windows'))) == windows
+            and datetime.fromisoformat(parameters['now']) <= now
+        ):
+            return candidate
+
+    return None
+
+
+def get_base_intervals(base: Report) -> dict:
+    parameters = base.parameters or {}
+
+    return get_report_intervals(datetime.fromisoformat(parameters['now']), parameters.get('windows'))
+
+
+def get_changed_store_ids(db: Session, base_intervals: dict, report_intervals: dict, reused_end: datetime, base_observation_id: int, max_observation_id: int) -> set:
+    '''
+    stores whose reused windows (ending at or before `reused_end`) may differ from base report: observations added since base watermark and observations
+    which entered or left report span (it moved with `now`) are changes. window only depends on observations within it, the last one before it
+    and the first one after it, so changes after `reused_end` only matter when they come first after it (e.g. store without observations since midnight
+    keeps `last_day` until one arrives). deleted observations are not tracked, full report is needed after observations are deleted
+    '''
+    span_start, span_end = get_report_span(report_intervals)
+    base_start, base_end = get_report_span(base_intervals)
+
+    changes = [
+        and_(
+            RestaurantStatus.observation_id > base_observation_id,
+            RestaurantStatus.observation_id <= max_observation_id,
+            RestaurantStatus.timestamp_utc >= span_start,
+            RestaurantStatus.timestamp_utc <= span_end
+        )
+    ]
+
+    # observations which entered or left the span
+    if base_start != span_start:
+        changes.append(and_(RestaurantStatus.timestamp_utc >= min(base_start, span_start), RestaurantStatus.timestamp_utc < max(base_start, span_start)))
+
+    if base_end != span_end:
+        changes.append(and_(RestaurantStatus.timestamp_utc > min(base_end, span_end), RestaurantStatus.timestamp_utc <= max(base_end, span_end)))
+
+    changed = or_(*changes)
+
+    first_after_reused = aliased(RestaurantStatus)
+
+    first_timestamp_after_reused = select(
+            func.min(first_after_reused.timestamp_utc)
+        ).where(
+            first_after_reused.store_id == RestaurantStatus.store_id,
+            first_after_reused.timestamp_utc > reused_end,
+            first_after_reused.timestamp_utc <= span_end
+        ).scalar_subquery()
+
+    query = select(
+            RestaurantStatus.store_id
+        ).where(
+            changed,
+            or_(
+                RestaurantStatus.timestamp_utc <= reused_end,
+                RestaurantStatus.timestamp_utc == first_timestamp_after_reused
+            )
+        ).distinct()
+
+    return set(db.execute(query).scalars().all())
+
+
+def get_base_rows(db: Session, report_id: int) -> dict:
+    '''
+    rows of base report, format {store_id: {window: (uptime, downtime)}}
+    '''
+    rows = db.execute(
+        select(
+            ReportRow.store_id,
+            ReportRow.report_window,
+            ReportRow.uptime,
+            ReportRow.downtime
+        ).where(
+            ReportRow.report_id == report_id
+        )
+    )
+
+    base_rows = {}
+
+    for store_id, report_window, uptime, downtime in rows:
+        base_rows.setdefault(store_id, {})[report_window] = (uptime, downtime)
+
+    return base_rows
+
+
+def stream_changed_stores(db: Session, report_intervals: dict, store_ids: list, batch_size: int = 10000) -> Iterator[Tuple[int, list]]:
+    '''
+    yields all observations within report span of given stores as (store_id, [(timestamp_utc, status), ...]) in store_id order
+    '''
+    for index in range(0, len(store_ids), store_chunk_size):
+        query = get_observation_query(report_intervals).where(
+            RestaurantStatus.store_id.in_(store_ids[index:index + store_chunk_size])
+        ).execution_options(stream_results=True, yield_per=batch_size)
+
+        observations = db.execute(query)
+
+        try:
+            yield from group_observations(observations)
+        finally:
+            observations.close()
+
+
+def stream_window_observations(db: Session, base_report_id: int, window: str, report_intervals: dict, windows_start: datetime, windows_end: datetime, batch_size: int = 10000) -> Iterator[Tuple[int, list]]:
+    '''
+    yields observations of stores of base report which windows within [windows_start, windows_end] depend on: last observation before windows_start,
+    observations within them and first observation after windows_end (both within report span), in store_id order.
+    downtime running into windows is clipped at their start and the observation after them either ends or extends (by business hours) downtime of the last
+    observation within them, so these give the same windows as all observations of report span. every store is a few index lookups instead of its whole span
+    '''
+    span_start, span_end = get_report_span(report_intervals)
+
+    # every store of base report once
+    stores = select(ReportRow.store_id).where(ReportRow.report_id == base_report_id, ReportRow.report_window == window).subquery()
+
+    previous_timestamp = select(
+            func.max(RestaurantStatus.timestamp_utc)
+        ).where(
+            RestaurantStatus.store_id == stores.c.store_id,
+            RestaurantStatus.timestamp_utc >= span_start,
+            RestaurantStatus.timestamp_utc < windows_start
+        ).scalar_subquery()
+
+    next_timestamp = select(
+            func.min(RestaurantStatus.timestamp_utc)
+        ).where(
+            RestaurantStatus.store_id == stores.c.store_id,
+            RestaurantStatus.timestamp_utc > windows_end,
+            RestaurantStatus.timestamp_utc <= span_end
+        ).scalar_subquery()
+
+    edges = select(stores.c.store_id, previous_timestamp.label('previous_timestamp'), next_timestamp.label('next_timestamp')).subquery()
+
+    columns = (RestaurantStatus.store_id, RestaurantStatus.timestamp_utc, RestaurantStatus.status)
+
+    observations = union_all(
+        select(*columns).join(edges, and_(RestaurantStatus.store_id == edges.c.store_id, RestaurantStatus.timestamp_utc == edges.c.previous_timestamp)),
+        select(*columns).join(edges, and_(RestaurantStatus.store_id == edges.c.store_id, RestaurantStatus.timestamp_utc == edges.c.next_timestamp)),
+        select(*columns).join(
+            stores,
+            and_(
+                RestaurantStatus.store_id == stores.c.store_id,
+                RestaurantStatus.timestamp_utc >= windows_start,
+                RestaurantStatus.timestamp_utc <= windows_end
+            )
+        )
+    ).subquery()
+
+    query = select(observations).order_by(asc(observations.c.store_id), asc(observations.c.timestamp_utc)).execution_options(stream_results=True, yield_per=batch_size)
+
+    result = db.execute(query)
+
+    try:
+        yield from group_observations(result)
+    finally:
+        result.close()
+
+
+def write_incremental_report(writer, delta_writer, db: Session, base: Report, store_data: StoreMetadata, report_intervals: dict, max_observation_id: int, calculate, timer: Optional[ReportTimer] = None) -> int:
+    '''
+    writes report from rows of `base` report: stores whose reused windows changed (`get_changed_store_ids`) are calculated from all their observations,
+    windows with the same bounds as in base report are copied for other stores and windows which moved with `now` (e.g. last_hour) are calculated
+    from the few observations around them (`stream_window_observations`). rows of changed stores are written into `delta_writer` as well (when given).
+    `calculate` is `calculate_store_availability` of report engine, returns number of stores written
+    '''
+    windows = get_report_windows(report_intervals)
+    report_bounds = get_report_bounds(report_intervals)
+    base_intervals = get_base_intervals(base)
+    base_bounds = get_report_bounds(base_intervals)
+
+    moved_windows = [window for window in windows if base_bounds.get(window) != report_bounds[window]]
+    moved_bounds = { window: report_bounds[window] for window in moved_windows }
+    reused_windows = [window for window in windows if window not in moved_bounds]
+
+    with timer.timed('query') if timer else nullcontext():
+        store_ids = get_store_ids(db, report_intervals)
+        base_rows = get_base_rows(db, base.report_id)
+        changed = set()
+
+        # without reused windows every store is calculated from observations around moved windows
+        if reused_windows:
+            reused_end = max(report_intervals[f'{window}_end'] for window in reused_windows)
+            changed = get_changed_store_ids(db, base_intervals, report_intervals, reused_end, base.last_observation_id, max_observation_id)
+
+    # stores which were not in base report have observations which entered the span
+    changed.update(store_id for store_id in store_ids if store_id not in base_rows)
+    changed_store_ids = sorted(store_id for store_id in store_ids if store_id in changed)
+
+    schedules = {}
+    rows = {}
+
+    for store_id, status_entries in stream_changed_stores(db, report_intervals, changed_store_ids):
+        schedule = get_store_schedule(store_id, store_data, report_intervals, schedules)
+        rows[store_id] = calculate(store_id, status_entries, schedule, report_bounds)
+
+    # values of moved windows of unchanged stores
+    moved_values = {}
+
+    if moved_windows:
+        windows_start = min(report_intervals[f'{window}_start'] for window in moved_windows)
+        windows_end = max(report_intervals[f'{window}_end'] for window in moved_windows)
+
+        for store_id, status_entries in stream_window_observations(db, base.report_id, windows[0], report_intervals, windows_start, windows_end):
+            if store_id in changed:
+                continue
+
+            schedule = get_store_schedule(store_id, store_data, report_intervals, schedules)
+            row = calculate(store_id, status_entries, schedule, moved_bounds)
+
+            moved_values[store_id] = {
+                window: (row[1 + index], row[1 + len(moved_windows) + index])
+                for index, window in enumerate(moved_windows)
+            }
+
+    total_stores = 0
+
+    for store_id in store_ids:
+        if store_id in rows:
+            row = rows[store_id]
+
+            if delta_writer:
+                delta_writer.writerow(row)
+        else:
+            values = dict(base_rows[store_id], **moved_values.get(store_id, {}))
+            row = (
+                store_id,
+                *(values[window][0] for window in windows),
+                *(values[window][1] for window in windows)
+            )
+
+        writer.writerow(row)
+        total_stores += 1
+
+    if timer:
+        timer.add_count('changed_stores', len(changed_store_ids))
+
+    return total_stores
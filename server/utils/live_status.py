@@ -0,0 +1,561 @@
+import json
+import os
+import tempfile
+import threading
+import traceback
+from datetime import timedelta
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+from sqlalchemy import asc, func, select
+
+from server import database
+from server.models.store import RestaurantStatus
+from server.utils.availability_query import get_cached_schedule, to_naive_utc
+from server.utils.business_hours import StoreSchedule
+from server.utils.datetime_utils import epoch, default_report_windows, get_report_bounds, get_report_intervals, to_epoch_microseconds
+from server.utils.loader import append_observations
+from server.utils.store_availability import format_report_row
+from server.utils.store_metadata import StoreMetadata, get_store_data
+
+
+# state is written here periodically and when api stops, api started again resumes from it
+live_status_snapshot_path = os.environ.get('LIVE_STATUS_SNAPSHOT', os.path.join(tempfile.gettempdir(), 'store-monitoring-live-status.json'))
+
+# how often observations loaded by other means (e.g. `load_data.py`) are applied and state is snapshotted
+live_status_sync_seconds = float(os.environ.get('LIVE_STATUS_SYNC_SECONDS', 60))
+
+# largest number of observations of a single `POST /observations` request
+max_ingest_batch = 10000
+
+# observations replayed when state is built without snapshot, covers `last_week` of latest observation
+replay_horizon = timedelta(days=15)
+
+# stores rebuilt with a single query when late observations arrive
+rebuild_chunk_size = 1000
+
+microseconds_in_hour = 3600 * 1000000
+microseconds_in_day = 24 * microseconds_in_hour
+microseconds_in_week = 7 * microseconds_in_day
+
+# format {bucket: (length, offset from epoch, buckets kept before the latest one)}, weeks start on monday (1970-01-01 was thursday) like `last_week`
+bucket_kinds = {
+    'hour': (microseconds_in_hour, 0, 48),
+    'day': (microseconds_in_day, 0, 8),
+    'week': (microseconds_in_week, 4 * microseconds_in_day, 2),
+}
+
+# live report windows, every window is exactly one bucket
+live_windows = { 'last_hour': 'hour', 'last_day': 'day', 'last_week': 'week' }
+
+
+def get_bucket_start(timestamp: int, bucket: str) -> int:
+    length, offset, _ = bucket_kinds[bucket]
+
+    return (timestamp - offset) // length * length + offset
+
+
+def to_date(timestamp: int):
+    return (epoch + timedelta(microseconds=timestamp)).date()
+
+
+def get_schedule(store_id: int, store_data: StoreMetadata, start: int, end: int) -> StoreSchedule:
+    '''
+    compiled schedule covering whole UTC days of [start, end], shared with availability queries
+    '''
+    return get_cached_schedule(store_data.get_schedule_key(store_id), to_date(start), to_date(end) + timedelta(days=2))
+
+
+class StoreState:
+    '''
+    status of a store after its latest observation, start of downtime which has not ended yet (None while store is up),
+    business hours downtime (in microseconds) of ended downtime per hour, day and week bucket, format {bucket: {bucket_start: downtime}},
+    first observation of every week along with start of downtime running into it, format {week_start: (timestamp, downtime_start)}
+    and first observation after the latest hour along with the latest observation and downtime start before it, format (timestamp, last_timestamp, downtime_start)
+    '''
+    __slots__ = ('status', 'last_timestamp', 'downtime_start', 'downtime', 'first_seen', 'hour_seen')
+
+    def __init__(
+        self,
+        status: Optional[str] = None,
+        last_timestamp: Optional[int] = None,
+        downtime_start: Optional[int] = None,
+        downtime: Optional[dict] = None,
+        first_seen: Optional[dict] = None,
+        hour_seen: Optional[tuple] = None
+    ):
+        self.status = status
+        self.last_timestamp = last_timestamp
+        self.downtime_start = downtime_start
+        self.downtime = downtime or { bucket: {} for bucket in bucket_kinds }
+        self.first_seen = first_seen or {}
+        self.hour_seen = hour_seen
+
+    def apply(self, store_id: int, store_data: StoreMetadata, timestamp: int, status: str) -> None:
+        '''
+        applies observation newer than the latest one of store
+        '''
+        week_start = get_bucket_start(timestamp, 'week')
+
+        # reports start downtime running into their span at first observation within it, spans of live windows start on a week
+        if week_start not in self.first_seen:
+            length, _, kept = bucket_kinds['week']
+            self.first_seen[week_start] = (timestamp, self.downtime_start)
+
+            for expired in [key for key in self.first_seen if key < week_start - kept * length]:
+                del self.first_seen[expired]
+
+        # reports read observations up to end of their span (inclusive), spans of live windows end on an hour
+        if self.last_timestamp is None or get_bucket_start(timestamp - 1, 'hour') > get_bucket_start(self.last_timestamp - 1, 'hour'):
+            self.hour_seen = (timestamp, self.last_timestamp, self.downtime_start)
+
+        # downtime ended
+        if self.downtime_start is not None and status == 'active':
+            self.add_downtime(get_schedule(store_id, store_data, self.downtime_start, timestamp), self.downtime_start, timestamp)
+            self.downtime_start = None
+
+        # downtime started
+        if self.downtime_start is None and status == 'inactive':
+            self.downtime_start = timestamp
+
+        self.status = status
+        self.last_timestamp = timestamp
+
+    def get_first_seen(self, span_start: int) -> tuple:
+        '''
+        (timestamp, downtime_start) of first observation since `span_start` (start of a week), downtime_start is start of downtime running into it.
+        (None, None) when store has no observation since then
+        '''
+        weeks = [week_start for week_start in self.first_seen if week_start >= span_start]
+
+        return self.first_seen[min(weeks)] if weeks else (None, None)
+
+    def get_last_seen(self, span_end: int) -> tuple:
+        '''
+        (timestamp, downtime_start) of the latest observation until `span_end` (end of an hour), downtime_start is start of downtime running at it.
+        (None, None) when store has no observation until then
+        '''
+        if self.last_timestamp <= span_end:
+            return self.last_timestamp, self.downtime_start
+
+        first_timestamp, last_timestamp, downtime_start = self.hour_seen
+
+        if first_timestamp <= span_end or last_timestamp is None:
+            return None, None
+
+        return last_timestamp, downtime_start
+
+    def add_downtime(self, schedule: StoreSchedule, start: int, end: int) -> None:
+        '''
+        adds business hours of downtime [start, end) to every bucket it overlaps, buckets older than `bucket_kinds` keeps are dropped
+        '''
+        spans = {}
+
+        for bucket, (length, _, kept) in bucket_kinds.items():
+            oldest_kept = get_bucket_start(end, bucket) - kept * length
+            bucket_start = max(get_bucket_start(start, bucket), oldest_kept)
+
+            spans[bucket] = []
+
+            while bucket_start < end:
+                spans[bucket].append((bucket_start, max(bucket_start, start), min(bucket_start + length, end)))
+                bucket_start += length
+
+            for expired in [key for key in self.downtime[bucket] if key < oldest_kept]:
+                del self.downtime[bucket][expired]
+
+        # business hours until every bucket boundary within downtime, calculated in one batch
+        boundaries = sorted({ timestamp for bucket_spans in spans.values() for _, span_start, span_end in bucket_spans for timestamp in (span_start, span_end) })
+        open_time = dict(zip(boundaries, schedule.get_open_time_until(np.array(boundaries, dtype=np.int64)).tolist()))
+
+        for bucket, bucket_spans in spans.items():
+            for bucket_start, span_start, span_end in bucket_spans:
+                downtime = open_time[span_end] - open_time[span_start]
+
+                if downtime > 0:
+                    self.downtime[bucket][bucket_start] = self.downtime[bucket].get(bucket_start, 0) + downtime
+
+    def to_list(self) -> list:
+        return [
+            self.status,
+            self.last_timestamp,
+            self.downtime_start,
+            { bucket: list(downtime.items()) for bucket, downtime in self.downtime.items() },
+            [[week_start, *first_seen] for week_start, first_seen in self.first_seen.items()],
+            self.hour_seen
+        ]
+
+    @classmethod
+    def from_list(cls, values: list) -> 'StoreState':
+        status, last_timestamp, downtime_start, downtime, first_seen, hour_seen = values
+
+        return cls(
+            status,
+            last_timestamp,
+            downtime_start,
+            { bucket: dict(map(tuple, downtime.get(bucket, []))) for bucket in bucket_kinds },
+            { week_start: (timestamp, carried_downtime_start) for week_start, timestamp, carried_downtime_start in first_seen },
+            tuple(hour_seen) if hour_seen is not None else None
+        )
+
+
+class LiveStatus:
+    '''
+    per store state updated by every observation in timestamp order, with the same `inactive -> ... -> active` downtime, report span
+    and last `inactive` extrapolation rules as reports, so live report is a pass over stores instead of their observations.
+    `watermark` is observation_id up to which `restaurant_status` rows were applied, `versions` are metadata versions downtime was calculated with.
+    `ingested` are timestamps of observations applied when `POST /observations` received them, format {store_id: {timestamp}}, sync skips them
+    when it reads them from `restaurant_status`. `stale_stores` received late observations and are rebuilt by `rebuild_stale_stores`
+    '''
+
+    def __init__(self, versions: dict, watermark: int = 0, stores: Optional[dict] = None, ingested: Optional[dict] = None):
+        self.versions = versions
+        self.watermark = watermark
+        self.stores = stores or {}
+        self.ingested = ingested or {}
+        self.stale_stores = set()
+        self.latest_timestamp = max((state.last_timestamp for state in self.stores.values()), default=None)
+        self.lock = threading.Lock()
+
+    def apply(self, store_data: StoreMetadata, observations: Iterable[tuple], ingested: bool = False) -> int:
+        '''
+        applies (store_id, timestamp_utc, status) rows sorted by (store_id, timestamp_utc), returns number of applied observations.
+        `ingested` rows are received by `POST /observations` before sync reads them. observations at or before the latest applied observation
+        of their store are skipped when they were already applied, otherwise they arrived late and their store is marked stale
+        '''
+        applied = 0
+
+        with self.lock:
+            for store_id, timestamp_utc, status in observations:
+                timestamp = to_epoch_microseconds(timestamp_utc)
+                state = self.stores.get(store_id)
+
+                if state is None:
+                    state = self.stores[store_id] = StoreState()
+                elif timestamp <= state.last_timestamp:
+                    ingested_timestamps = self.ingested.get(store_id, set())
+
+                    if timestamp not in ingested_timestamps:
+                        self.stale_stores.add(store_id)
+                    elif not ingested:
+                        # sync read observation applied when it was received, it is not read again
+                        ingested_timestamps.discard(timestamp)
+
+                        if not ingested_timestamps:
+                            del self.ingested[store_id]
+
+                    continue
+
+                state.apply(store_id, store_data, timestamp, status)
+
+                if ingested:
+                    self.ingested.setdefault(store_id, set()).add(timestamp)
+
+                if self.latest_timestamp is None or timestamp > self.latest_timestamp:
+                    self.latest_timestamp = timestamp
+
+                applied += 1
+
+        return applied
+
+    def get_report_intervals(self) -> dict:
+        '''
+        default report windows of latest applied observation, whole seconds like `now` of reports so windows start on bucket boundaries
+        '''
+        return get_report_intervals(epoch + timedelta(seconds=self.latest_timestamp // 1000000), default_report_windows)
+
+    def iter_report_rows(self, store_data: StoreMetadata, report_intervals: dict) -> Iterator[tuple]:
+        '''
+        yields report rows of stores with an observation since start of report windows in store_id order. stores are copied under lock
+        and calculated after it is released, so observations keep being applied while report is written
+        '''
+        report_bounds = get_report_bounds(report_intervals)
+        span_start = min(start for start, _ in report_bounds.values())
+        span_end = max(end for _, end in report_bounds.values())
+
+        with self.lock:
+            stores = [
+                (
+                    store_id,
+                    *state.get_last_seen(span_end),
+                    state.downtime_start,
+                    *state.get_first_seen(span_start),
+                    [state.downtime[live_windows[window]].get(start, 0) for window, (start, _) in report_bounds.items()]
+                )
+                for store_id, state in sorted(self.stores.items())
+                if state.last_timestamp >= span_start
+            ]
+
+        # reports only read observations within span, so state of every store is taken at its first and last observation within span
+        for store_id, last_timestamp, downtime_start, current_downtime_start, first_timestamp, carried_downtime_start, bucket_downtime in stores:
+            if last_timestamp is None or last_timestamp < span_start:
+                continue
+
+            schedule = get_schedule(store_id, store_data, span_start, span_end)
+
+            # downtime running into span ended and was added to buckets from its start, reports start it at first observation of span
+            clipped_downtime = carried_downtime_start is not None and carried_downtime_start != downtime_start
+
+            # downtime running at last observation of span ended after span and was added to buckets
+            ended_downtime = downtime_start is not None and downtime_start != current_downtime_start
+
+            # last observation of span is `inactive`, downtime is extrapolated till end of its business hours
+            downtime_end = int(schedule.get_close_time(last_timestamp)) if downtime_start is not None else None
+            extrapolated_start = max(downtime_start, first_timestamp) if downtime_start is not None else None
+
+            total_uptime = {}
+            total_downtime = {}
+
+            for (window, (start, end)), downtime in zip(report_bounds.items(), bucket_downtime):
+                if clipped_downtime and start < first_timestamp:
+                    downtime -= int(schedule.get_open_time(start, min(first_timestamp, end)))
+
+                if ended_downtime and downtime_start < end:
+                    downtime -= int(schedule.get_open_time(max(downtime_start, start), end))
+
+                if downtime_end is not None and max(extrapolated_start, start) < min(downtime_end, end):
+                    downtime += int(schedule.get_open_time(max(extrapolated_start, start), min(downtime_end, end)))
+
+                total_downtime[window] = downtime
+                total_uptime[window] = int(schedule.get_open_time(start, end)) - downtime
+
+            yield format_report_row(store_id, total_uptime, total_downtime, report_bounds)
+
+    def dump(self, path: str = live_status_snapshot_path) -> None:
+        with self.lock:
+            snapshot = {
+                "versions": self.versions,
+                "watermark": self.watermark,
+                "stores": [[store_id, *state.to_list()] for store_id, state in self.stores.items()],
+                "ingested": [[store_id, sorted(timestamps)] for store_id, timestamps in self.ingested.items()],
+            }
+
+        # written to temporary file and renamed, so a crash never leaves a partial snapshot
+        with open(f'{path}.tmp', 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+
+        os.replace(f'{path}.tmp', path)
+
+    @classmethod
+    def load(cls, path: str = live_status_snapshot_path) -> Optional['LiveStatus']:
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+
+        stores = { store_id: StoreState.from_list(values) for store_id, *values in snapshot["stores"] }
+
+        ingested = { store_id: set(timestamps) for store_id, timestamps in snapshot["ingested"] }
+
+        return cls(snapshot["versions"], snapshot["watermark"], stores, ingested)
+
+
+def get_observations_query(*conditions):
+    return select(
+            RestaurantStatus.store_id,
+            RestaurantStatus.timestamp_utc,
+            RestaurantStatus.status
+        ).where(
+            *conditions
+        ).order_by(
+            asc(RestaurantStatus.store_id),
+            asc(RestaurantStatus.timestamp_utc)
+        ).execution_options(stream_results=True, yield_per=10000)
+
+
+def build_live_status(store_data: StoreMetadata) -> LiveStatus:
+    '''
+    replays observations of `replay_horizon` before the latest one, used when there is no usable snapshot
+    '''
+    live_status = LiveStatus(store_data.versions)
+
+    with database.engine.connect() as connection:
+        watermark, latest_timestamp = connection.execute(
+            select(func.max(RestaurantStatus.observation_id), func.max(RestaurantStatus.timestamp_utc))
+        ).one()
+
+        if watermark is None:
+            return live_status
+
+        live_status.apply(store_data, connection.execute(get_observations_query(
+            RestaurantStatus.observation_id <= watermark,
+            RestaurantStatus.timestamp_utc >= latest_timestamp - replay_horizon
+        )))
+
+    live_status.watermark = watermark
+
+    return live_status
+
+
+def rebuild_stale_stores(live_status: LiveStatus, store_data: StoreMetadata) -> int:
+    '''
+    replays observations of `replay_horizon` before the latest one of stores which received late observations, like `build_live_status`
+    does for every store. returns number of rebuilt stores
+    '''
+    with live_status.lock:
+        store_ids = sorted(live_status.stale_stores)
+
+        if not store_ids:
+            return 0
+
+        stores = {}
+        ingested = {}
+
+        with database.engine.connect() as connection:
+            for chunk_start in range(0, len(store_ids), rebuild_chunk_size):
+                rows = connection.execute(
+                    select(
+                        RestaurantStatus.observation_id,
+                        RestaurantStatus.store_id,
+                        RestaurantStatus.timestamp_utc,
+                        RestaurantStatus.status
+                    ).where(
+                        RestaurantStatus.store_id.in_(store_ids[chunk_start:chunk_start + rebuild_chunk_size]),
+                        RestaurantStatus.timestamp_utc >= epoch + timedelta(microseconds=live_status.latest_timestamp) - replay_horizon
+                    ).order_by(
+                        asc(RestaurantStatus.store_id),
+                        asc(RestaurantStatus.timestamp_utc)
+                    )
+                )
+
+                for observation_id, store_id, timestamp_utc, status in rows:
+                    state = stores.setdefault(store_id, StoreState())
+                    timestamp = to_epoch_microseconds(timestamp_utc)
+                    state.apply(store_id, store_data, timestamp, status)
+
+                    # sync reads observations after watermark, they are already applied
+                    if observation_id > live_status.watermark:
+                        ingested.setdefault(store_id, set()).add(timestamp)
+
+        for store_id in store_ids:
+            if store_id in stores:
+                live_status.stores[store_id] = stores[store_id]
+
+            if store_id in ingested:
+                live_status.ingested[store_id] = ingested[store_id]
+            else:
+                live_status.ingested.pop(store_id, None)
+
+        live_status.stale_stores.clear()
+
+    return len(store_ids)
+
+
+def sync_live_status(live_status: LiveStatus, store_data: StoreMetadata) -> int:
+    '''
+    applies observations added to `restaurant_status` after watermark (e.g. by `load_data.py`), returns number of applied observations.
+    observations of `POST /observations` are applied when they are received and skipped here, stores of late observations are rebuilt
+    '''
+    with database.engine.connect() as connection:
+        watermark = connection.execute(select(func.max(RestaurantStatus.observation_id))).scalar()
+
+        if watermark is None or watermark <= live_status.watermark:
+            return 0
+
+        applied = live_status.apply(store_data, connection.execute(get_observations_query(
+            RestaurantStatus.observation_id > live_status.watermark,
+            RestaurantStatus.observation_id <= watermark
+        )))
+
+    live_status.watermark = watermark
+    rebuild_stale_stores(live_status, store_data)
+
+    return applied
+
+
+def load_live_status(store_data: StoreMetadata) -> LiveStatus:
+    '''
+    resumes from snapshot when it was calculated with current business hours and timezones, rebuilds from observations otherwise
+    '''
+    try:
+        live_status = LiveStatus.load()
+    except (OSError, ValueError, KeyError) as e:
+        print(e)
+        live_status = None
+
+    if live_status is None or live_status.versions != store_data.versions:
+        return build_live_status(store_data)
+
+    sync_live_status(live_status, store_data)
+
+    return live_status
+
+
+current_live_status: Optional[LiveStatus] = None
+
+
+def ingest_observations(observations: list) -> dict:
+    '''
+    appends (store_id, timestamp_utc, status) observations to `restaurant_status` and applies them to live state (once it is loaded),
+    stores of observations older than their latest applied one are rebuilt. returns number of received, inserted (not loaded before),
+    applied and rebuilt stores
+    '''
+    rows = sorted({ (store_id, to_naive_utc(timestamp_utc), status) for store_id, timestamp_utc, status in observations })
+
+    with database.engine.begin() as connection:
+        inserted = append_observations(connection, iter(rows), [int, lambda value: value, str])
+
+    live_status = current_live_status
+    applied = 0
+    rebuilt = 0
+
+    if live_status is not None:
+        store_data = get_store_data()
+        applied = live_status.apply(store_data, rows, ingested=True)
+        rebuilt = rebuild_stale_stores(live_status, store_data)
+
+    return { "received": len(observations), "inserted": inserted, "applied": applied, "rebuilt": rebuilt }
+
+
+def run_live_status(stop_event: threading.Event, sync_seconds: float) -> None:
+    global current_live_status
+
+    # state of a previous start within the same process is not served while snapshot is loaded
+    current_live_status = None
+
+    try:
+        current_live_status = load_live_status(get_store_data())
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+
+    while not stop_event.wait(sync_seconds):
+        try:
+            store_data = get_store_data()
+
+            if current_live_status is None or current_live_status.versions != store_data.versions:
+                # downtime depends on business hours, state is rebuilt when they change
+                current_live_status = build_live_status(store_data)
+            else:
+                sync_live_status(current_live_status, store_data)
+
+            current_live_status.dump()
+        except Exception as e:
+            print(e)
+            print(traceback.format_exc())
+
+
+def start_live_status(sync_seconds: float = live_status_sync_seconds) -> threading.Event:
+    '''
+    loads live state in a background thread, then applies observations loaded by other means and snapshots state every `sync_seconds`.
+    returned event stops it
+    '''
+    stop_event = threading.Event()
+
+    threading.Thread(target=run_live_status, args=(stop_event, sync_seconds), name='live-status', daemon=True).start()
+
+    return stop_event
+
+
+def stop_live_status(stop_event: threading.Event) -> None:
+    '''
+    stops background sync and snapshots state, so api started again only applies observations added since
+    '''
+    stop_event.set()
+
+    if current_live_status is not None:
+        try:
+            current_live_status.dump()
+        except OSError as e:
+            print(e)
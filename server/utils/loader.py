@@ -0,0 +1,254 @@
+import csv
+import io
+from datetime import datetime, time
+from itertools import islice
+from typing import Iterator
+
+from sqlalchemy import Column, MetaData, Table, BigInteger, SmallInteger, String, DateTime, Time, delete, exists, func, insert, select, update
+from sqlalchemy.engine import Connection
+
+from server.models.store import RestaurantStatus, BusinessHours, RestaurantTimezone, DatasetVersion
+from server.utils.partitions import ensure_observation_partitions
+
+
+default_chunk_size = 100000
+
+# source csv headers differ between exports, every column accepts a few names
+column_aliases = {
+    'day_of_week': ['day_of_week', 'dayOfWeek', 'day'],
+    'timezone_str': ['timezone_str', 'timezone'],
+}
+
+staging_metadata = MetaData()
+
+restaurant_status_staging = Table(
+    'restaurant_status_staging',
+    staging_metadata,
+    Column('store_id', BigInteger, nullable=False),
+    Column('timestamp_utc', DateTime(timezone=False), nullable=False),
+    Column('status', String(8), nullable=False),
+    prefixes=['TEMPORARY'],
+)
+
+business_hours_staging = Table(
+    'business_hours_staging',
+    staging_metadata,
+    Column('store_id', BigInteger, nullable=False),
+    Column('day_of_week', SmallInteger, nullable=False),
+    Column('start_time_local', Time(timezone=False), nullable=False),
+    Column('end_time_local', Time(timezone=False), nullable=False),
+    prefixes=['TEMPORARY'],
+)
+
+restaurant_timezone_staging = Table(
+    'restaurant_timezone_staging',
+    staging_metadata,
+    Column('store_id', BigInteger, nullable=False),
+    Column('timezone_str', String(256), nullable=False),
+    prefixes=['TEMPORARY'],
+)
+
+
+def parse_timestamp(value: str) -> datetime:
+    '''
+    e.g. `2023-01-22 12:09:39.388884 UTC`, exports also have rows with fewer fraction digits (`12:09:39.38888 UTC`) or without fraction,
+    which `datetime.fromisoformat` of python 3.9 does not accept
+    '''
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f UTC')
+
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S UTC')
+
+
+def read_csv_rows(file_path: str, columns: list) -> Iterator[tuple]:
+    '''
+    yields csv rows as tuples of given columns, so rows can be copied in the same column order
+    '''
+    with open(file_path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        header = next(reader)
+
+        indexes = []
+
+        for column in columns:
+            names = column_aliases.get(column, [column])
+            index = next((header.index(name) for name in names if name in header), None)
+
+            if index is None:
+                raise ValueError(f'{file_path} has no `{column}` column, found: {header}')
+
+            indexes.append(index)
+
+        for row in reader:
+            yield tuple(row[index] for index in indexes)
+
+
+def get_chunks(rows: Iterator[tuple], chunk_size: int) -> Iterator[list]:
+    while True:
+        chunk = list(islice(rows, chunk_size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def copy_rows(connection: Connection, table: Table, rows: Iterator[tuple], converters: list, chunk_size: int) -> int:
+    '''
+    streams rows into table chunk by chunk, through `COPY FROM STDIN` on postgresql and batched inserts on other databases (e.g. sqlite).
+    returns number of copied rows
+    '''
+    columns = [column.name for column in table.columns]
+    use_copy = connection.dialect.name == 'postgresql'
+
+    if use_copy:
+        cursor = connection.connection.cursor()
+        copy_statement = f'COPY {table.name} ({", ".join(columns)}) FROM STDIN WITH (FORMAT csv)'
+
+    total_rows = 0
+
+    for chunk in get_chunks(rows, chunk_size):
+        if use_copy:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(chunk)
+            buffer.seek(0)
+
+            cursor.copy_expert(copy_statement, buffer)
+        else:
+            connection.execute(
+                insert(table),
+                [
+                    { column: converter(value) for column, converter, value in zip(columns, converters, row) }
+                    for row in chunk
+                ]
+            )
+
+        total_rows += len(chunk)
+
+    return total_rows
+
+
+def bump_dataset_version(connection: Connection, name: str) -> None:
+    '''
+    marks dataset as changed, so reports and caches built from its previous version are not reused
+    '''
+    updated = connection.execute(
+        update(DatasetVersion).where(
+            DatasetVersion.name == name
+        ).values(
+            version=DatasetVersion.version + 1,
+            updated_at=datetime.utcnow()
+        )
+    )
+
+    if not updated.rowcount:
+        connection.execute(insert(DatasetVersion).values(name=name, version=1, updated_at=datetime.utcnow()))
+
+
+def load_observations(connection: Connection, file_path: str, chunk_size: int = default_chunk_size) -> int:
+    '''
+    appends observations of csv file to `restaurant_status`, observations already loaded for (store_id, timestamp_utc) are skipped
+    returns number of new observations
+    '''
+    rows = (
+        (store_id, timestamp_utc.removesuffix(' UTC'), status)
+        for store_id, status, timestamp_utc in read_csv_rows(file_path, ['store_id', 'status', 'timestamp_utc'])
+    )
+
+    return append_observations(connection, rows, [int, parse_timestamp, str], chunk_size)
+
+
+def append_observations(connection: Connection, rows: Iterator[tuple], converters: list, chunk_size: int = default_chunk_size) -> int:
+    '''
+    appends (store_id, timestamp_utc, status) rows to `restaurant_status` through staging table, `converters` turn row values into column types
+    on databases without COPY. observations already loaded for (store_id, timestamp_utc) are skipped, returns number of new observations
+    '''
+    restaurant_status_staging.create(connection)
+
+    copy_rows(connection, restaurant_status_staging, rows, converters, chunk_size)
+
+    staging = restaurant_status_staging.c
+
+    # weekly partitions of loaded observations must exist before insert
+    ensure_observation_partitions(
+        connection,
+        *connection.execute(select(func.min(staging.timestamp_utc), func.max(staging.timestamp_utc))).one()
+    )
+
+    already_loaded = exists().where(
+        RestaurantStatus.store_id == staging.store_id,
+        RestaurantStatus.timestamp_utc == staging.timestamp_utc
+    )
+
+    result = connection.execute(
+        insert(RestaurantStatus).from_select(
+            ['store_id', 'timestamp_utc', 'status'],
+            select(
+                staging.store_id,
+                staging.timestamp_utc,
+                func.min(staging.status)
+            ).where(
+                ~already_loaded
+            ).group_by(
+                staging.store_id,
+                staging.timestamp_utc
+            ).order_by(
+                staging.store_id,
+                staging.timestamp_utc
+            )
+        )
+    )
+
+    restaurant_status_staging.drop(connection)
+
+    return result.rowcount
+
+
+def load_business_hours(connection: Connection, file_path: str, chunk_size: int = default_chunk_size) -> int:
+    '''
+    replaces `business_hours` with csv contents, returns number of loaded rows
+    '''
+    business_hours_staging.create(connection)
+
+    rows = read_csv_rows(file_path, ['store_id', 'day_of_week', 'start_time_local', 'end_time_local'])
+    copy_rows(connection, business_hours_staging, rows, [int, int, time.fromisoformat, time.fromisoformat], chunk_size)
+
+    staging = business_hours_staging.c
+
+    connection.execute(delete(BusinessHours))
+    result = connection.execute(
+        insert(BusinessHours).from_select(
+            ['store_id', 'day_of_week', 'start_time_local', 'end_time_local'],
+            select(staging.store_id, staging.day_of_week, staging.start_time_local, staging.end_time_local)
+        )
+    )
+
+    business_hours_staging.drop(connection)
+    bump_dataset_version(connection, 'business_hours')
+
+    return result.rowcount
+
+
+def load_timezones(connection: Connection, file_path: str, chunk_size: int = default_chunk_size) -> int:
+    '''
+    replaces `restaurant_timezone` with csv contents, returns number of loaded rows
+    '''
+    restaurant_timezone_staging.create(connection)
+
+    rows = read_csv_rows(file_path, ['store_id', 'timezone_str'])
+    copy_rows(connection, restaurant_timezone_staging, rows, [int, str], chunk_size)
+
+    staging = restaurant_timezone_staging.c
+
+    connection.execute(delete(RestaurantTimezone))
+    result = connection.execute(
+        insert(RestaurantTimezone).from_select(
+            ['store_id', 'timezone_str'],
+            select(staging.store_id, func.min(staging.timezone_str)).group_by(staging.store_id)
+        )
+    )
+
+    restaurant_timezone_staging.drop(connection)
+    bump_dataset_version(connection, 'timezones')
+
+    return result.rowcount
@@ -0,0 +1,245 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+
+# metrics are recorded unless disabled, disabled metrics skip all timing and counting in report loops
+metrics_enabled = os.environ.get('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no')
+
+# report worker processes write their metrics here, api process merges them into `/metrics`
+metrics_dir = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'store-monitoring-metrics'))
+
+report_duration_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+request_duration_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# name: (type, help, histogram buckets)
+metric_definitions = {
+    'report_duration_seconds': ('histogram', 'Time to generate a report.', report_duration_buckets),
+    'report_phase_seconds': ('histogram', 'Time spent in each phase (query, grouping, compute, write) of report generation.', report_duration_buckets),
+    'api_request_duration_seconds': ('histogram', 'Latency of api requests.', request_duration_buckets),
+    'report_stores_total': ('counter', 'Stores processed by reports.', None),
+    'report_observations_total': ('counter', 'Observations processed by reports.', None),
+    'report_intervals_total': ('counter', 'Store report intervals (stores x windows) calculated by reports.', None),
+    'report_changed_stores_total': ('counter', 'Stores recalculated from all their observations by incremental reports.', None),
+}
+
+# (name, labels) -> counter value, or [count of every bucket..., sum, count] of histogram
+samples = {}
+samples_lock = threading.Lock()
+
+# marks end of iterable in `ReportTimer.iter_timed`
+stop = object()
+
+
+def get_labels_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    if not metrics_enabled:
+        return
+
+    key = (name, get_labels_key(labels))
+
+    with samples_lock:
+        samples[key] = samples.get(key, 0) + value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    if not metrics_enabled:
+        return
+
+    buckets = metric_definitions[name][2]
+    key = (name, get_labels_key(labels))
+
+    with samples_lock:
+        histogram = samples.setdefault(key, [0] * (len(buckets) + 2))
+
+        for index, bucket in enumerate(buckets):
+            if value <= bucket:
+                histogram[index] += 1
+
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+class ReportTimer:
+    '''
+    accumulates seconds of every phase and counts of a single report (or report shard) in plain dicts,
+    so per store work only adds numbers and metrics are recorded once when report is finished. picklable, shards send it back to report process
+    '''
+
+    def __init__(self):
+        self.phases = {}
+        self.counts = {}
+
+        # all seconds added so far, nested timed regions (e.g. query while waiting for next store in grouping) are left out of outer phase
+        self.total_seconds = 0
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+        self.total_seconds += seconds
+
+    def add_count(self, name: str, value: int) -> None:
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def merge(self, timer: 'ReportTimer') -> None:
+        for phase, seconds in timer.phases.items():
+            self.add_time(phase, seconds)
+
+        for name, value in timer.counts.items():
+            self.add_count(name, value)
+
+    @contextmanager
+    def timed(self, phase: str):
+        start = time.perf_counter()
+        nested_seconds = self.total_seconds
+
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start - (self.total_seconds - nested_seconds))
+
+    def iter_timed(self, iterable, phase: str) -> Iterator:
+        '''
+        yields items of iterable, time spent waiting for every item is added to `phase`
+        '''
+        iterator = iter(iterable)
+
+        while True:
+            with self.timed(phase):
+                item = next(iterator, stop)
+
+            if item is stop:
+                return
+
+            yield item
+
+    def record(self) -> None:
+        for phase, seconds in self.phases.items():
+            observe('report_phase_seconds', seconds, phase=phase)
+
+        for name, value in self.counts.items():
+            inc(f'report_{name}_total', value)
+
+
+def get_report_timer() -> Optional[ReportTimer]:
+    '''
+    returns None when metrics are disabled, report loops skip timing altogether
+    '''
+    return ReportTimer() if metrics_enabled else None
+
+
+def get_metrics_path(pid: int) -> str:
+    return os.path.join(metrics_dir, f'{pid}.json')
+
+
+def dump_metrics() -> None:
+    '''
+    writes metrics of current process into `metrics_dir`, called by report workers after every report
+    '''
+    if not metrics_enabled:
+        return
+
+    with samples_lock:
+        rows = [[name, list(labels), value] for (name, labels), value in samples.items()]
+
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    # written to temporary file and renamed, so api never reads a partial file
+    path = get_metrics_path(os.getpid())
+
+    with open(f'{path}.tmp', 'w') as metrics_file:
+        json.dump(rows, metrics_file)
+
+    os.replace(f'{path}.tmp', path)
+
+
+def clear_metrics_dir() -> None:
+    '''
+    removes metrics of previous runs, called when api starts
+    '''
+    if not os.path.isdir(metrics_dir):
+        return
+
+    for filename in os.listdir(metrics_dir):
+        os.remove(os.path.join(metrics_dir, filename))
+
+
+def load_metrics() -> dict:
+    '''
+    merges metrics of current process with metrics written by other processes
+    '''
+    with samples_lock:
+        merged = { key: (list(value) if isinstance(value, list) else value) for key, value in samples.items() }
+
+    if not os.path.isdir(metrics_dir):
+        return merged
+
+    own_path = get_metrics_path(os.getpid())
+
+    for filename in os.listdir(metrics_dir):
+        path = os.path.join(metrics_dir, filename)
+
+        if not filename.endswith('.json') or path == own_path:
+            continue
+
+        try:
+            with open(path) as metrics_file:
+                rows = json.load(metrics_file)
+        except (OSError, ValueError):
+            continue
+
+        for name, labels, value in rows:
+            key = (name, tuple(tuple(label) for label in labels))
+
+            if isinstance(value, list):
+                merged[key] = [total + current for total, current in zip(merged.get(key, [0] * len(value)), value)]
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+    return merged
+
+
+def format_labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+def render_metrics() -> str:
+    '''
+    metrics of all processes in prometheus text format
+    '''
+    merged = load_metrics()
+    lines = []
+
+    for name, (metric_type, help_text, buckets) in metric_definitions.items():
+        metric_samples = sorted((labels, value) for (sample_name, labels), value in merged.items() if sample_name == name)
+
+        if not metric_samples:
+            continue
+
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+
+        for labels, value in metric_samples:
+            if metric_type == 'counter':
+                lines.append(f'{name}{format_labels(labels)} {value}')
+                continue
+
+            for bucket, bucket_count in zip(buckets, value):
+                lines.append(f'{name}_bucket{format_labels(labels, (("le", str(bucket)),))} {bucket_count}')
+
+            lines.append(f'{name}_bucket{format_labels(labels, (("le", "+Inf"),))} {value[-1]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+
+    return '\n'.join(lines) + '\n'
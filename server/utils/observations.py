@@ -0,0 +1,108 @@
+from typing import Iterable, Iterator, NamedTuple, Tuple
+
+import numpy as np
+
+from server.utils.datetime_utils import epoch, one_microsecond
+
+
+ACTIVE = 1
+INACTIVE = 0
+
+
+class StoreObservations(NamedTuple):
+    '''
+    observations of a single store, views into `ObservationColumns` arrays
+    '''
+    timestamps: np.ndarray
+    statuses: np.ndarray
+
+
+class ObservationColumns:
+    '''
+    observations sorted by (store_id, timestamp_utc) in three contiguous arrays, int64 store ids, int64 epoch microseconds and uint8 status
+    (1 = active, 0 = inactive), 17 bytes per observation instead of a tuple of datetime and str inside a list.
+    `offsets` slice arrays by store, observations of i-th store of `store_ids` are [offsets[i], offsets[i + 1])
+    '''
+
+    def __init__(self, observation_store_ids: np.ndarray, timestamps: np.ndarray, statuses: np.ndarray):
+        self.observation_store_ids = observation_store_ids
+        self.timestamps = timestamps
+        self.statuses = statuses
+
+        # first observation of every store, observations are sorted by store_id
+        starts = np.flatnonzero(np.diff(observation_store_ids)) + 1 if len(observation_store_ids) else np.empty(0, dtype=np.int64)
+
+        self.store_ids = observation_store_ids[np.concatenate(([0], starts))] if len(observation_store_ids) else observation_store_ids
+        self.offsets = np.concatenate(([0], starts, [len(observation_store_ids)])).astype(np.int64)
+
+    def __len__(self) -> int:
+        return len(self.store_ids)
+
+    def get_store(self, store_id: int) -> StoreObservations:
+        '''
+        observations of a store, empty arrays when store has no observations
+        '''
+        index = int(np.searchsorted(self.store_ids, store_id))
+
+        if index == len(self.store_ids) or self.store_ids[index] != store_id:
+            return StoreObservations(self.timestamps[:0], self.statuses[:0])
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+
+        return StoreObservations(self.timestamps[start:end], self.statuses[start:end])
+
+    def items(self) -> Iterator[Tuple[int, StoreObservations]]:
+        '''
+        yields (store_id, StoreObservations) in store_id order, arrays are views so nothing is copied
+        '''
+        offsets = self.offsets.tolist()
+
+        for index, store_id in enumerate(self.store_ids.tolist()):
+            start, end = offsets[index], offsets[index + 1]
+
+            yield store_id, StoreObservations(self.timestamps[start:end], self.statuses[start:end])
+
+    @property
+    def observations(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def nbytes(self) -> int:
+        return self.observation_store_ids.nbytes + self.timestamps.nbytes + self.statuses.nbytes + self.store_ids.nbytes + self.offsets.nbytes
+
+
+def get_observation_count(status_entries) -> int:
+    '''
+    number of observations of [(timestamp_utc, status), ...] or `StoreObservations`
+    '''
+    if isinstance(status_entries, StoreObservations):
+        return len(status_entries.timestamps)
+
+    return len(status_entries)
+
+
+def to_columns(rows: list) -> tuple:
+    '''
+    converts (store_id, timestamp_utc, status) rows into store id, epoch microseconds and status arrays.
+    `timestamp_utc` is naive, timedelta arithmetic is several times faster than numpy parsing datetime objects
+    '''
+    store_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    timestamps = np.fromiter(((row[1] - epoch) // one_microsecond for row in rows), dtype=np.int64, count=len(rows))
+    statuses = np.fromiter((row[2] == 'active' for row in rows), dtype=np.uint8, count=len(rows))
+
+    return store_ids, timestamps, statuses
+
+
+def load_observation_columns(batches: Iterable[list]) -> ObservationColumns:
+    '''
+    builds columns from batches of (store_id, timestamp_utc, status) rows sorted by (store_id, timestamp_utc),
+    every batch is converted as soon as it is fetched, so at most one batch of row objects is held at once
+    '''
+    columns = [to_columns(rows) for rows in batches if rows]
+
+    if not columns:
+        return ObservationColumns(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8))
+
+    store_ids, timestamps, statuses = (np.concatenate(column) for column in zip(*columns))
+
+    return ObservationColumns(store_ids, timestamps, statuses)
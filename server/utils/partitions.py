@@ -0,0 +1,131 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import text, func, select
+from sqlalchemy.engine import Connection
+
+from server.models.store import RestaurantStatus, observation_index
+
+
+partition_interval = timedelta(weeks=1)
+
+# weekly partitions created ahead of latest observation, so newly loaded observations rarely land in default partition
+partitions_ahead = 4
+
+
+def get_week_start(timestamp: datetime) -> datetime:
+    '''
+    partitions start on monday 00:00 UTC like `last_week` report interval, so a week of observations is read from one partition
+    '''
+    return datetime.combine(timestamp.date() - timedelta(days=timestamp.weekday()), datetime.min.time())
+
+
+def get_partition_name(week_start: datetime) -> str:
+    return f"{RestaurantStatus.__tablename__}_w{week_start.strftime('%Y%m%d')}"
+
+
+def is_partitioned(connection: Connection) -> bool:
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    return bool(connection.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table_name)"
+    ), { "table_name": RestaurantStatus.__tablename__ }).scalar())
+
+
+def create_observation_index(connection: Connection) -> None:
+    '''
+    creates (store_id, timestamp_utc) index on tables created before it was declared on the model
+    '''
+    observation_index.create(connection, checkfirst=True)
+
+
+def create_observation_partitions(connection: Connection, start: datetime, end: datetime) -> int:
+    '''
+    creates missing weekly partitions covering [start, end], returns number of weeks checked.
+    partitions must exist before their observations are inserted, otherwise observations go to default partition
+    '''
+    week_start = get_week_start(start)
+    weeks = 0
+
+    while week_start <= end:
+        week_end = week_start + partition_interval
+
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {get_partition_name(week_start)} PARTITION OF {RestaurantStatus.__tablename__} "
+            f"FOR VALUES FROM ('{week_start.isoformat()}') TO ('{week_end.isoformat()}')"
+        ))
+
+        week_start = week_end
+        weeks += 1
+
+    return weeks
+
+
+def ensure_observation_partitions(connection: Connection, start: Optional[datetime], end: Optional[datetime]) -> None:
+    '''
+    creates weekly partitions for observations within [start, end] (plus `partitions_ahead` weeks) when restaurant_status is partitioned
+    '''
+    if start is None or not is_partitioned(connection):
+        return
+
+    create_observation_partitions(connection, start, end + partitions_ahead * partition_interval)
+
+
+def partition_restaurant_status(connection: Connection) -> int:
+    '''
+    migrates existing `restaurant_status` into a table range partitioned by week of timestamp_utc, returns number of moved observations.
+    runs in the transaction of `connection`, writers are blocked until it is committed. observation_id sequence is kept,
+    so hourly uptime rollup watermark stays valid. postgres requires partition key within primary key, so it becomes (observation_id, timestamp_utc)
+    '''
+    if connection.dialect.name != 'postgresql':
+        raise ValueError('restaurant_status can only be partitioned on postgresql')
+
+    if is_partitioned(connection):
+        return 0
+
+    table_name = RestaurantStatus.__tablename__
+    old_table_name = f'{table_name}_unpartitioned'
+
+    connection.execute(text(f'LOCK TABLE {table_name} IN ACCESS EXCLUSIVE MODE'))
+
+    sequence_name = connection.execute(text("SELECT pg_get_serial_sequence(:table_name, 'observation_id')"), { "table_name": table_name }).scalar()
+    first_timestamp, last_timestamp = connection.execute(
+        select(func.min(RestaurantStatus.timestamp_utc), func.max(RestaurantStatus.timestamp_utc))
+    ).one()
+
+    connection.execute(text(f'ALTER TABLE {table_name} RENAME TO {old_table_name}'))
+    connection.execute(text(f'ALTER INDEX IF EXISTS {observation_index.name} RENAME TO {observation_index.name}_unpartitioned'))
+    connection.execute(text(f'ALTER INDEX IF EXISTS {table_name}_pkey RENAME TO {old_table_name}_pkey'))
+
+    connection.execute(text(f'''
+        CREATE TABLE {table_name} (
+            observation_id BIGINT NOT NULL DEFAULT nextval('{sequence_name}'),
+            store_id BIGINT NOT NULL,
+            timestamp_utc TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            status VARCHAR(8) NOT NULL,
+            PRIMARY KEY (observation_id, timestamp_utc)
+        ) PARTITION BY RANGE (timestamp_utc)
+    '''))
+
+    if first_timestamp is not None:
+        ensure_observation_partitions(connection, first_timestamp, last_timestamp)
+
+    # observations outside of created weeks are still accepted
+    connection.execute(text(f'CREATE TABLE {table_name}_default PARTITION OF {table_name} DEFAULT'))
+
+    # moved in index order, so partitions are physically clustered by (store_id, timestamp_utc)
+    moved = connection.execute(text(f'''
+        INSERT INTO {table_name} (observation_id, store_id, timestamp_utc, status)
+        SELECT observation_id, store_id, timestamp_utc, status FROM {old_table_name}
+        ORDER BY store_id, timestamp_utc
+    ''')).rowcount
+
+    # index on partitioned table is created on every partition
+    create_observation_index(connection)
+
+    connection.execute(text(f'ALTER SEQUENCE {sequence_name} OWNED BY {table_name}.observation_id'))
+    connection.execute(text(f'DROP TABLE {old_table_name}'))
+    connection.execute(text(f'ANALYZE {table_name}'))
+
+    return moved
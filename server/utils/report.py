@@ -1,11 +1,78 @@
+import hashlib
+import json
 
-from sqlalchemy.orm import Session
+from typing import Optional
 
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from server import database
 from server.models.store import Report
 from server.schemas.response import ReportBase
 
 
-def get_report_by_id(db: Session, report_id: int) -> ReportBase:
+async def get_report_by_id(db: AsyncSession, report_id: int) -> ReportBase:
     filter_by_id = Report.report_id == report_id
 
-    return db.query(Report).filter(filter_by_id).first()
+    return (await db.execute(select(Report).where(filter_by_id))).scalars().first()
+
+def get_report_cache_key(report_intervals: dict, last_observation_id: int, dataset_versions: dict, source: str, report_format: str = 'csv', delta: bool = False) -> str:
+    '''
+    identifies report by everything its content depends on: report intervals (and their column order), observations (by max observation_id),
+    business hours and timezones versions, source it is calculated from, file format and whether it has a delta file
+    '''
+    key = {
+        "report_intervals": [[name, value.isoformat()] for name, value in report_intervals.items()],
+        "last_observation_id": last_observation_id,
+        "dataset_versions": dataset_versions,
+        "source": source,
+        "format": report_format
+    }
+
+    # incremental report without delta file is identical to full report
+    if delta:
+        key["delta"] = True
+
+    key = json.dumps(key, sort_keys=True)
+
+    return hashlib.sha256(key.encode()).hexdigest()
+
+async def get_report_by_cache_key(db: AsyncSession, cache_key: str) -> ReportBase:
+    filter_by_cache_key = Report.cache_key == cache_key
+
+    return (await db.execute(select(Report).where(filter_by_cache_key))).scalars().first()
+
+async def create_report(db: AsyncSession, cache_key: str, parameters: dict, priority: int = 0) -> tuple:
+    '''
+    queues report and returns (report, created). queued, running or completed report with same cache_key is returned instead of creating a new one,
+    unique cache_key makes concurrent identical requests attach to the report created first
+    '''
+    report = await get_report_by_cache_key(db, cache_key)
+
+    if report:
+        return report, False
+
+    try:
+        report = Report(status='Queued', cache_key=cache_key, parameters=parameters, priority=priority)
+        db.add(report)
+        await db.commit()
+        await db.refresh(report)
+
+        return report, True
+    except IntegrityError:
+        await db.rollback()
+
+        return await get_report_by_cache_key(db, cache_key), False
+
+def update_report_progress(report_id: int, stores_processed: int, stores_total: Optional[int] = None) -> None:
+    '''
+    progress is written through its own connection, so session generating the report (and its server-side cursor) is not committed
+    '''
+    values = { "stores_processed": stores_processed }
+
+    if stores_total is not None:
+        values["stores_total"] = stores_total
+
+    with database.engine.begin() as connection:
+        connection.execute(update(Report).where(Report.report_id == report_id).values(**values))
@@ -0,0 +1,151 @@
+import os
+import threading
+import traceback
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import or_, update
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from server import database
+from server.models.store import Report
+
+
+# stores written between two checkpoints of a report
+checkpoint_interval = int(os.environ.get('REPORT_CHECKPOINT_STORES', 1000))
+
+# how often worker generating a report updates its heartbeat
+report_heartbeat_seconds = float(os.environ.get('REPORT_HEARTBEAT_SECONDS', 10))
+
+# `Running` report without heartbeat for this long belongs to a crashed worker and is queued again
+report_stale_seconds = float(os.environ.get('REPORT_STALE_SECONDS', 60))
+
+# failed report is queued again (resuming from its checkpoint) until it was attempted this many times
+report_max_attempts = int(os.environ.get('REPORT_MAX_ATTEMPTS', 3))
+
+
+def save_checkpoint(connection: Connection, report_id: int, checkpoint: dict, stores_processed: int) -> None:
+    connection.execute(
+        update(Report).where(
+            Report.report_id == report_id
+        ).values(
+            checkpoint=checkpoint,
+            stores_processed=stores_processed,
+            heartbeat_at=datetime.utcnow()
+        )
+    )
+
+
+def clear_checkpoint(db: Session, report_id: int) -> None:
+    '''
+    checkpoints are saved through their own connections, so report loaded by the session still holds the checkpoint it was loaded with
+    and assigning None to it may not be written at all. cleared within transaction of the session, e.g. along with report completion
+    '''
+    db.execute(update(Report).where(Report.report_id == report_id).values(checkpoint=None))
+
+
+def get_partial_path(file_path: str) -> str:
+    '''
+    headerless csv which rows are written into until report is completed, then converted into report file
+    '''
+    return f'{file_path}.partial'
+
+
+def open_partial_file(partial_path: str, offset: int):
+    '''
+    opens partial csv for appending after `offset` bytes, rows written after last checkpoint are cut off. zero offset starts an empty file
+    '''
+    if not offset or not os.path.exists(partial_path):
+        return open(partial_path, 'w', newline='')
+
+    with open(partial_path, 'r+b') as partial_file:
+        partial_file.truncate(offset)
+
+    return open(partial_path, 'a', newline='')
+
+
+def sync_partial_file(partial_file) -> int:
+    '''
+    writes buffered rows to disk before checkpoint points past them, returns size of partial file
+    '''
+    partial_file.flush()
+    os.fsync(partial_file.fileno())
+
+    return os.fstat(partial_file.fileno()).st_size
+
+
+def remove_partial_files(file_path: str) -> None:
+    '''
+    removes partial csv and shard files of report file
+    '''
+    directory, filename = os.path.split(file_path)
+
+    if not os.path.isdir(directory):
+        return
+
+    for name in os.listdir(directory):
+        if name.startswith(f'{filename}.part'):
+            os.remove(os.path.join(directory, name))
+
+
+def requeue_stale_reports(db: Session, stale_seconds: float = report_stale_seconds) -> list:
+    '''
+    moves `Running` reports whose worker stopped updating heartbeat (e.g. killed or restarted with the api) back to `Queued`,
+    so they are claimed again and resume from their checkpoint. returns ids of requeued reports
+    '''
+    stale_before = datetime.utcnow() - timedelta(seconds=stale_seconds)
+
+    report_ids = db.execute(
+        update(Report).where(
+            Report.status == 'Running',
+            or_(Report.heartbeat_at == None, Report.heartbeat_at < stale_before)
+        ).values(
+            status='Queued'
+        ).returning(Report.report_id)
+    ).scalars().all()
+    db.commit()
+
+    return report_ids
+
+
+def run_heartbeat(report_ids: list, stop_event: threading.Event, heartbeat_seconds: float) -> None:
+    while not stop_event.wait(heartbeat_seconds):
+        try:
+            with database.engine.begin() as connection:
+                connection.execute(
+                    update(Report).where(
+                        Report.report_id.in_(report_ids),
+                        Report.status == 'Running'
+                    ).values(
+                        heartbeat_at=datetime.utcnow()
+                    )
+                )
+        except Exception as e:
+            # report is only taken over when heartbeat stays stale for `report_stale_seconds`
+            print(e)
+            print(traceback.format_exc())
+
+
+def start_heartbeat(report_ids: list, heartbeat_seconds: float = report_heartbeat_seconds) -> threading.Event:
+    '''
+    updates heartbeat of reports every `heartbeat_seconds` in a background thread while they are generated, returned event stops it.
+    thread keeps reports alive through long phases without checkpoints (e.g. observations query, report shards or a backfill)
+    '''
+    stop_event = threading.Event()
+
+    threading.Thread(target=run_heartbeat, args=(report_ids, stop_event, heartbeat_seconds), name=f'report-heartbeat-{report_ids[0]}', daemon=True).start()
+
+    return stop_event
+
+
+def get_resume_checkpoint(report: Report, sharded: bool) -> Optional[dict]:
+    '''
+    checkpoint of previous attempt, None when report starts over. checkpoint of a sharded attempt is not resumed by a single process and the other way around
+    '''
+    checkpoint = report.checkpoint
+
+    if not checkpoint or ('store_id_ranges' in checkpoint) != sharded:
+        return None
+
+    return checkpoint
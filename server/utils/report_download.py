@@ -0,0 +1,173 @@
+import gzip
+import os
+from typing import Iterator, Optional
+
+from fastapi import HTTPException, status
+from fastapi.responses import StreamingResponse
+
+from server.models.store import Report
+from server.utils.report_writer import reports_dir, report_formats
+
+
+# bytes read from report file at once, whole file is never held in memory
+download_chunk_size = 64 * 1024
+
+
+def parse_accept(header: Optional[str]) -> list:
+    '''
+    returns media ranges (e.g. text/csv, text/*, */*) of `Accept` header, ranges with q=0 are left out. missing header accepts everything
+    '''
+    if not header:
+        return ['*/*']
+
+    media_ranges = []
+
+    for item in header.split(','):
+        media_range, *params = [part.strip() for part in item.split(';')]
+
+        if any(param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') for param in params):
+            continue
+
+        if media_range:
+            media_ranges.append(media_range.lower())
+
+    return media_ranges
+
+
+def accepts(media_ranges: list, media_type: str, explicit: bool = False) -> bool:
+    '''
+    `explicit` ignores wildcards, e.g. gzip bytes are only sent as application/gzip when client asks for it by name
+    '''
+    if media_type in media_ranges:
+        return True
+
+    if explicit:
+        return False
+
+    return '*/*' in media_ranges or f"{media_type.split('/')[0]}/*" in media_ranges
+
+
+def parse_range(header: Optional[str], file_size: int) -> Optional[tuple]:
+    '''
+    returns (start, end) byte positions (end inclusive) of a single `bytes=` range, None when whole file is sent.
+    multiple ranges are not supported and whole file is sent instead. raises 416 when range is outside of file
+    '''
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+
+    start, separator, end = header[len('bytes='):].strip().partition('-')
+
+    if not separator:
+        return None
+
+    try:
+        if not start:
+            # suffix range, last `end` bytes
+            suffix_length = int(end)
+
+            if suffix_length <= 0:
+                raise ValueError()
+
+            return max(file_size - suffix_length, 0), file_size - 1
+
+        start = int(start)
+        end = int(end) if end else file_size - 1
+    except ValueError:
+        return None
+
+    if start >= file_size or end < start:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range is outside of report.",
+            headers={ "Content-Range": f"bytes */{file_size}" }
+        )
+
+    return start, min(end, file_size - 1)
+
+
+def iter_file(file_path: str, start: int, length: int) -> Iterator[bytes]:
+    with open(file_path, 'rb') as report_file:
+        report_file.seek(start)
+
+        while length > 0:
+            chunk = report_file.read(min(download_chunk_size, length))
+
+            if not chunk:
+                return
+
+            length -= len(chunk)
+            yield chunk
+
+
+def iter_decompressed_file(file_path: str) -> Iterator[bytes]:
+    with gzip.open(file_path, 'rb') as report_file:
+        while chunk := report_file.read(download_chunk_size):
+            yield chunk
+
+
+def get_report_file_response(report: Report, headers, report_file: Optional[str] = None) -> StreamingResponse:
+    '''
+    streams report file in chunks. `Range` requests get 206 with requested bytes. gzip csv is sent as is (Content-Encoding: gzip)
+    to clients accepting gzip, as application/gzip when asked for by name and decompressed on the fly (without range support) otherwise.
+    `report_file` (e.g. delta file of report) is streamed instead of report file when given
+    '''
+    report_file = report_file or report.report_file
+    file_path = os.path.join(reports_dir, report_file)
+
+    if not os.path.exists(file_path):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f'Report file of report_id: {report.report_id} no longer exists'
+        )
+
+    _, media_type, content_encoding = report_formats[report.report_format]
+    media_ranges = parse_accept(headers.get('accept'))
+    accepts_gzip = 'gzip' in headers.get('accept-encoding', '').lower()
+
+    file_stat = os.stat(file_path)
+    etag = f'"{report.report_id}-{file_stat.st_size}-{int(file_stat.st_mtime)}"'
+
+    response_headers = {
+        "Content-Disposition": f'attachment; filename="{report_file}"',
+        "ETag": etag,
+    }
+
+    if content_encoding == 'gzip' and accepts(media_ranges, media_type) and not accepts_gzip:
+        response_headers["Accept-Ranges"] = "none"
+
+        return StreamingResponse(iter_decompressed_file(file_path), media_type=media_type, headers=response_headers)
+
+    if content_encoding == 'gzip' and accepts(media_ranges, media_type):
+        response_headers["Content-Encoding"] = "gzip"
+    elif content_encoding == 'gzip' and accepts(media_ranges, 'application/gzip', explicit=True):
+        media_type = 'application/gzip'
+    elif content_encoding or not accepts(media_ranges, media_type):
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail=f'Report is only available as {media_type}'
+        )
+
+    file_size = file_stat.st_size
+    response_headers["Accept-Ranges"] = "bytes"
+
+    # stale If-Range validator means file changed, whole file is sent instead of requested range
+    byte_range = None
+
+    if headers.get('if-range', etag) == etag:
+        byte_range = parse_range(headers.get('range'), file_size)
+
+    if byte_range is None:
+        response_headers["Content-Length"] = str(file_size)
+
+        return StreamingResponse(iter_file(file_path, 0, file_size), media_type=media_type, headers=response_headers)
+
+    start, end = byte_range
+    response_headers["Content-Length"] = str(end - start + 1)
+    response_headers["Content-Range"] = f'bytes {start}-{end}/{file_size}'
+
+    return StreamingResponse(
+        iter_file(file_path, start, end - start + 1),
+        status_code=status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=response_headers
+    )
@@ -0,0 +1,191 @@
+import os
+import time
+import traceback
+import multiprocessing
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import select, update, func
+from sqlalchemy.orm import Session
+
+from server import database
+from server.models.store import Report
+
+from server.utils.datetime_utils import get_report_intervals
+from server.utils.metrics import dump_metrics
+from server.utils.report_checkpoint import report_heartbeat_seconds, requeue_stale_reports, start_heartbeat
+from server.utils.report_shards import is_sharded_report, run_next_report_shard, run_sharded_report
+from server.utils.store_availability import generate_store_availability_report
+from server.utils.store_metadata import refresh_store_metadata
+
+
+# number of worker processes started with the api, 0 leaves queue to workers started by `report_worker.py`
+report_queue_workers = int(os.environ.get('REPORT_QUEUE_WORKERS', 1))
+
+# max reports generated at the same time by all workers (including workers of other hosts)
+report_max_concurrency = int(os.environ.get('REPORT_MAX_CONCURRENCY', 2))
+
+# seconds an idle worker waits before looking for queued reports again
+report_queue_poll_seconds = float(os.environ.get('REPORT_QUEUE_POLL_SECONDS', 1))
+
+# postgres advisory lock key which serializes report claims
+report_queue_lock_id = 8100
+
+
+def claim_next_report(db: Session, max_concurrency: int = report_max_concurrency) -> Optional[Report]:
+    '''
+    moves queued report with highest priority (oldest first) to `Running` and returns it.
+    returns None when queue is empty or `max_concurrency` reports are already running.
+    check and claim are a single conditional update, so two workers never claim the same report
+    '''
+    if db.bind.dialect.name == 'postgresql':
+        # concurrent claims would count running reports before each other's update is committed
+        db.execute(select(func.pg_advisory_xact_lock(report_queue_lock_id)))
+
+    running_reports = select(func.count()).select_from(Report).where(Report.status == 'Running').scalar_subquery()
+    next_report = (
+        select(Report.report_id)
+        .where(Report.status == 'Queued')
+        .order_by(Report.priority.desc(), Report.report_id)
+        .limit(1)
+        .scalar_subquery()
+    )
+
+    report_id = db.execute(
+        update(Report)
+        .where(Report.report_id == next_report, Report.status == 'Queued', running_reports < max_concurrency)
+        .values(status='Running', attempts=Report.attempts + 1, heartbeat_at=datetime.utcnow())
+        .returning(Report.report_id)
+    ).scalar()
+    db.commit()
+
+    if report_id is None:
+        return None
+
+    return db.get(Report, report_id)
+
+
+def run_report(db: Session, report: Report) -> None:
+    '''
+    generates claimed report from parameters it was queued with, sharded report is split into shards which workers of every replica calculate
+    '''
+    parameters = report.parameters or {}
+
+    # metadata is reloaded when it changed since previous report, report keeps this snapshot even if metadata is reloaded while it runs
+    store_data = refresh_store_metadata()
+
+    report_intervals = get_report_intervals(datetime.fromisoformat(parameters['now']), parameters.get('windows'))
+
+    # report of a crashed worker is taken over once heartbeat stops
+    stop_heartbeat = start_heartbeat([report.report_id])
+
+    try:
+        if is_sharded_report(parameters):
+            run_sharded_report(db, report, store_data)
+            return None
+
+        generate_store_availability_report(
+            db,
+            store_data,
+            report_intervals,
+            report,
+            engine=parameters.get('engine', 'python'),
+            source=parameters.get('source', 'observations'),
+            report_format=parameters.get('format', 'csv'),
+            incremental=parameters.get('incremental', False),
+            delta=parameters.get('delta', False)
+        )
+    finally:
+        stop_heartbeat.set()
+
+
+def requeue_stale_reports_safely(db: Session) -> None:
+    try:
+        report_ids = requeue_stale_reports(db)
+
+        if report_ids:
+            print(f'reports of stopped workers queued again: {report_ids}')
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+        db.rollback()
+
+
+def dump_metrics_safely() -> None:
+    # api process reads metrics of workers from `metrics_dir`
+    try:
+        dump_metrics()
+    except OSError as e:
+        print(e)
+
+
+def run_report_worker(max_concurrency: int = report_max_concurrency, poll_seconds: float = report_queue_poll_seconds) -> None:
+    '''
+    worker process loop, generates queued reports one at a time with its own session. shards of reports split by any worker are calculated
+    before next report is claimed, so reports which were started finish first.
+    `Running` reports left behind by stopped workers are queued again when worker starts and while it is idle, and resume from their checkpoint
+    '''
+    db: Session = database.SessionLocal()
+
+    requeue_stale_reports_safely(db)
+    last_requeue = time.monotonic()
+
+    try:
+        while True:
+            try:
+                if run_next_report_shard(db):
+                    dump_metrics_safely()
+                    continue
+
+                report = claim_next_report(db, max_concurrency)
+            except Exception as e:
+                print(e)
+                print(traceback.format_exc())
+                db.rollback()
+                report = None
+
+            if not report:
+                if time.monotonic() - last_requeue > report_heartbeat_seconds:
+                    requeue_stale_reports_safely(db)
+                    last_requeue = time.monotonic()
+
+                time.sleep(poll_seconds)
+                continue
+
+            try:
+                run_report(db, report)
+            except Exception as e:
+                # generate_store_availability_report marks its own failures, this covers invalid parameters
+                print(e)
+                print(traceback.format_exc())
+                db.rollback()
+                db.execute(update(Report).where(Report.report_id == report.report_id).values(status='Failed', report_csv_url='', cache_key=None))
+                db.commit()
+
+            dump_metrics_safely()
+    finally:
+        db.close()
+
+
+def start_report_workers(workers: int = report_queue_workers, max_concurrency: int = report_max_concurrency) -> list:
+    '''
+    starts `workers` report worker processes. processes are spawned instead of forked from the api process,
+    so they do not inherit its event loop, threads and connections. report generation stays out of the api process
+    '''
+    context = multiprocessing.get_context('spawn')
+    processes = []
+
+    for index in range(workers):
+        process = context.Process(target=run_report_worker, args=(max_concurrency,), name=f'report-worker-{index}')
+        process.start()
+        processes.append(process)
+
+    return processes
+
+
+def stop_report_workers(processes: list) -> None:
+    for process in processes:
+        process.terminate()
+
+    for process in processes:
+        process.join()
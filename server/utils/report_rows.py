@@ -0,0 +1,176 @@
+from typing import Callable, Optional
+
+from sqlalchemy import asc, delete, desc, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from server import database
+from server.models.store import ReportRow
+from server.utils.loader import copy_rows
+
+
+# stores buffered before their rows are inserted, every store has one row per window
+insert_batch_size = 10000
+
+# largest page of `/get_report/{report_id}/rows`
+max_page_size = 1000
+
+row_sort_columns = {
+    'store_id': ReportRow.store_id,
+    'uptime': ReportRow.uptime,
+    'downtime': ReportRow.downtime,
+}
+
+
+class ReportRowsWriter:
+    '''
+    passes report rows on to report file `writer` (None only stores them) and stores them in `report_rows` (one row per store and window) as well,
+    rows are inserted every `insert_batch_size` stores through COPY on postgresql and batched inserts otherwise.
+    each batch is inserted through its own connection, so session generating the report (and its server-side cursor) is not committed.
+    `on_flush` is called with (connection, last store_id, stores written so far) within transaction of every batch, e.g. to save checkpoint along with rows
+    '''
+
+    def __init__(self, writer, report_id: int, windows: list, batch_size: int = insert_batch_size, on_flush: Optional[Callable] = None):
+        self.writer = writer
+        self.report_id = report_id
+        self.windows = windows
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.rows = []
+        self.stores_written = 0
+
+    def writerow(self, row: tuple) -> None:
+        if self.writer:
+            self.writer.writerow(row)
+        self.rows.append(row)
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def write_csv_part(self, part_path: str) -> None:
+        # shards insert their own rows
+        self.writer.write_csv_part(part_path)
+
+    def flush(self) -> None:
+        if not self.rows:
+            return
+
+        windows = len(self.windows)
+
+        # row is (store_id, uptime of every window..., downtime of every window...)
+        report_rows = (
+            (self.report_id, row[0], window, row[1 + index], row[1 + windows + index])
+            for row in self.rows
+            for index, window in enumerate(self.windows)
+        )
+
+        with database.engine.begin() as connection:
+            copy_rows(connection, ReportRow.__table__, report_rows, [int, int, str, int, int], self.batch_size * windows)
+
+            if self.on_flush:
+                self.on_flush(connection, self.rows[-1][0], self.stores_written + len(self.rows))
+
+        self.stores_written += len(self.rows)
+        self.rows = []
+
+    def close(self) -> None:
+        self.flush()
+
+        if hasattr(self.writer, 'close'):
+            self.writer.close()
+
+    def abort(self) -> None:
+        '''
+        closes report file without inserting buffered rows, used when report failed
+        '''
+        self.rows = []
+
+        if hasattr(self.writer, 'close'):
+            self.writer.close()
+
+
+def delete_report_rows(report_id: int, store_id_range: Optional[tuple] = None) -> None:
+    '''
+    `store_id_range` (first_store_id, last_store_id) deletes rows of a single shard
+    '''
+    query = delete(ReportRow).where(ReportRow.report_id == report_id)
+
+    if store_id_range:
+        query = query.where(ReportRow.store_id >= store_id_range[0], ReportRow.store_id <= store_id_range[1])
+
+    with database.engine.begin() as connection:
+        connection.execute(query)
+
+
+def parse_cursor(cursor: Optional[str], sort: str) -> Optional[tuple]:
+    '''
+    cursor is `store_id` of last row when sorted by store_id and `value:store_id` otherwise. raises ValueError on malformed cursor
+    '''
+    if not cursor:
+        return None
+
+    values = tuple(int(value) for value in cursor.split(':'))
+
+    if len(values) != (1 if sort == 'store_id' else 2):
+        raise ValueError(f'invalid cursor: {cursor}')
+
+    return values
+
+
+async def get_report_rows(db: AsyncSession, report_id: int, windows: list, window: str, filters: dict, sort: str = 'store_id', order: str = 'asc', limit: int = 100, cursor: Optional[str] = None) -> tuple:
+    '''
+    returns a page of stores of a report along with cursor of next page (None on last page), format ([{store_id, uptime: {window: value}, downtime: {window: value}}, ...], cursor).
+    stores are filtered (`filters` format {(column, operator): value}, e.g. {('downtime', '>='): 5}) and sorted by `window` values,
+    pages continue after (value, store_id) of previous page, so every page is read straight from (report_id, report_window, value, store_id) index
+    without counting skipped rows like OFFSET does
+    '''
+    sort_column = row_sort_columns[sort]
+    key_columns = [sort_column] if sort == 'store_id' else [sort_column, ReportRow.store_id]
+    direction = desc if order == 'desc' else asc
+
+    after = parse_cursor(cursor, sort)
+
+    query = select(*key_columns).where(ReportRow.report_id == report_id, ReportRow.report_window == window)
+
+    for (column, operator), value in filters.items():
+        query = query.where(row_sort_columns[column].op(operator)(value))
+
+    if after:
+        keys = tuple_(*key_columns) if len(key_columns) > 1 else key_columns[0]
+        after = tuple_(*after) if len(after) > 1 else after[0]
+
+        query = query.where(keys < after if order == 'desc' else keys > after)
+
+    page = (await db.execute(query.order_by(*[direction(column) for column in key_columns]).limit(limit))).all()
+
+    store_ids = [row[-1] for row in page]
+    rows = { store_id: { "store_id": store_id, "uptime": {}, "downtime": {} } for store_id in store_ids }
+
+    if store_ids:
+        # every window of stores on page
+        window_rows = await db.execute(
+            select(
+                ReportRow.store_id,
+                ReportRow.report_window,
+                ReportRow.uptime,
+                ReportRow.downtime
+            ).where(
+                ReportRow.report_id == report_id,
+                ReportRow.store_id.in_(store_ids)
+            )
+        )
+
+        for store_id, report_window, uptime, downtime in window_rows:
+            rows[store_id]["uptime"][report_window] = uptime
+            rows[store_id]["downtime"][report_window] = downtime
+
+    next_cursor = None
+
+    if len(page) == limit:
+        next_cursor = ':'.join(str(value) for value in page[-1])
+
+    # windows in report column order
+    for row in rows.values():
+        row["uptime"] = { name: row["uptime"][name] for name in windows if name in row["uptime"] }
+        row["downtime"] = { name: row["downtime"][name] for name in windows if name in row["downtime"] }
+
+    return [rows[store_id] for store_id in store_ids], next_cursor
@@ -0,0 +1,447 @@
+import os
+import socket
+import threading
+import traceback
+import uuid
+from contextlib import closing
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+from typing import Optional
+
+from sqlalchemy import and_, asc, delete, func, or_, select, update
+from sqlalchemy.orm import Session
+
+from server import database
+from server.models.store import Report, ReportRow, ReportShard
+from server.utils.datetime_utils import get_report_bounds, get_report_intervals, get_report_windows
+from server.utils.incremental_report import get_observation_watermark
+from server.utils.metrics import get_report_timer
+from server.utils.report_checkpoint import report_heartbeat_seconds, report_max_attempts, report_stale_seconds, clear_checkpoint, remove_partial_files, start_heartbeat
+from server.utils.report_rows import ReportRowsWriter, delete_report_rows
+from server.utils.report_writer import reports_dir, get_report_filename, open_report_writer
+from server.utils.store_availability import get_report_fields, get_store_id_ranges, write_store_availability_rows
+from server.utils.store_details import get_store_ids, stream_restaurant_status
+from server.utils.store_metadata import StoreMetadata, refresh_store_metadata
+
+
+# number of store_id range shards a report of observations is split into, shards are claimed by report workers of every replica.
+# 1 leaves report to the worker which claimed it
+report_shards = int(os.environ.get('REPORT_SHARDS', 1))
+
+# `Running` shard whose lease was not renewed for this long belongs to a stopped worker and is claimed again
+shard_lease_seconds = float(os.environ.get('REPORT_SHARD_LEASE_SECONDS', report_stale_seconds))
+
+
+def get_worker_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def is_sharded_report(parameters: dict, shards: int = report_shards) -> bool:
+    '''
+    full reports of raw observations are sharded, incremental reports only recalculate a few stores and other sources are calculated by a single worker
+    '''
+    return shards > 1 and parameters.get('source', 'observations') == 'observations' and not parameters.get('incremental')
+
+
+def get_lease_filter(report_id: int, shard_index: int, lease_owner: str, attempts: int) -> tuple:
+    '''
+    shard as claimed by a worker, updates of a worker whose lease expired and was claimed by another one match no row
+    '''
+    return (
+        ReportShard.report_id == report_id,
+        ReportShard.shard_index == shard_index,
+        ReportShard.status == 'Running',
+        ReportShard.lease_owner == lease_owner,
+        ReportShard.attempts == attempts
+    )
+
+
+def plan_report_shards(db: Session, report: Report, store_data: StoreMetadata, shards: int = report_shards) -> int:
+    '''
+    splits stores of claimed report into `shards` store_id ranges recorded in `report_shards`, along with observation watermark and metadata versions
+    report is calculated from. shards of a previous attempt are kept, so report resumes with shards which were not completed. returns number of those
+    '''
+    pending_shards = select(func.count()).select_from(ReportShard).where(ReportShard.report_id == report.report_id, ReportShard.status != 'Completed')
+
+    if db.execute(select(ReportShard.report_id).where(ReportShard.report_id == report.report_id).limit(1)).first():
+        return db.execute(pending_shards).scalar()
+
+    parameters = report.parameters or {}
+    report_intervals = get_report_intervals(datetime.fromisoformat(parameters['now']), parameters.get('windows'))
+
+    # observations added from now on are left to the next incremental report
+    report.last_observation_id = get_observation_watermark(db)
+    store_ids = get_store_ids(db, report_intervals)
+
+    # rows and partial files of an attempt which was not sharded
+    delete_report_rows(report.report_id)
+
+    if report.report_file:
+        remove_partial_files(os.path.join(reports_dir, report.report_file))
+
+    for index, (first_store_id, last_store_id) in enumerate(get_store_id_ranges(store_ids, shards)):
+        db.add(ReportShard(report_id=report.report_id, shard_index=index, first_store_id=first_store_id, last_store_id=last_store_id, status='Queued', attempts=0))
+
+    report.report_file = report.report_file or get_report_filename(f"report-{str(uuid.uuid4())}", parameters.get('format', 'csv'))
+    report.stores_processed = 0
+    report.stores_total = len(store_ids)
+    clear_checkpoint(db, report.report_id)
+    report.metadata_versions = store_data.versions
+    db.commit()
+
+    return db.execute(pending_shards).scalar()
+
+
+def claim_report_shard(db: Session, report_id: Optional[int] = None) -> Optional[tuple]:
+    '''
+    leases queued shard or shard whose lease expired (of `report_id` or any report) to this worker, returns (report_id, shard_index, lease_owner, attempts)
+    or None when there is none. on postgresql shard is selected `FOR UPDATE SKIP LOCKED`, so concurrent workers skip each other's candidates instead of waiting.
+    sqlite has no row locks, claim is a conditional update of the status and attempts that were read and loses (returns None) when another worker claimed first
+    '''
+    now = datetime.utcnow()
+
+    query = select(
+            ReportShard.report_id,
+            ReportShard.shard_index,
+            ReportShard.status,
+            ReportShard.attempts
+        ).where(
+            or_(
+                ReportShard.status == 'Queued',
+                and_(ReportShard.status == 'Running', ReportShard.lease_expires_at < now)
+            )
+        ).order_by(
+            asc(ReportShard.report_id),
+            asc(ReportShard.shard_index)
+        ).limit(1)
+
+    if report_id is not None:
+        query = query.where(ReportShard.report_id == report_id)
+
+    if db.bind.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+
+    candidate = db.execute(query).first()
+
+    if candidate is None:
+        db.commit()
+        return None
+
+    lease_owner = get_worker_id()
+
+    claimed = db.execute(
+        update(ReportShard).where(
+            ReportShard.report_id == candidate.report_id,
+            ReportShard.shard_index == candidate.shard_index,
+            ReportShard.status == candidate.status,
+            ReportShard.attempts == candidate.attempts
+        ).values(
+            status='Running',
+            lease_owner=lease_owner,
+            lease_expires_at=now + timedelta(seconds=shard_lease_seconds),
+            attempts=ReportShard.attempts + 1
+        ).returning(ReportShard.attempts)
+    ).scalar()
+    db.commit()
+
+    if claimed is None:
+        return None
+
+    return candidate.report_id, candidate.shard_index, lease_owner, claimed
+
+
+def renew_shard_lease(connection, lease: tuple) -> bool:
+    '''
+    extends lease of shard claimed as `lease`, returns False when it was lost (expired and claimed by another worker or report failed)
+    '''
+    return connection.execute(
+        update(ReportShard).where(*get_lease_filter(*lease)).values(lease_expires_at=datetime.utcnow() + timedelta(seconds=shard_lease_seconds))
+    ).rowcount > 0
+
+
+def run_lease_renewal(lease: tuple, stop_event: threading.Event, heartbeat_seconds: float) -> None:
+    while not stop_event.wait(heartbeat_seconds):
+        try:
+            with database.engine.begin() as connection:
+                # report is locked before its shards, like completion of a shard does
+                connection.execute(update(Report).where(Report.report_id == lease[0], Report.status == 'Running').values(heartbeat_at=datetime.utcnow()))
+                renew_shard_lease(connection, lease)
+        except Exception as e:
+            # shard is only claimed again when lease stays expired for `shard_lease_seconds`
+            print(e)
+            print(traceback.format_exc())
+
+
+def start_lease_renewal(lease: tuple, heartbeat_seconds: float = report_heartbeat_seconds) -> threading.Event:
+    '''
+    renews lease of shard and heartbeat of its report every `heartbeat_seconds` in a background thread while shard is calculated, returned event stops it
+    '''
+    stop_event = threading.Event()
+
+    threading.Thread(target=run_lease_renewal, args=(lease, stop_event, heartbeat_seconds), name=f'report-shard-lease-{lease[0]}-{lease[1]}', daemon=True).start()
+
+    return stop_event
+
+
+def start_report_shard(lease: tuple, store_id_range: tuple) -> None:
+    '''
+    deletes rows of a previous attempt of shard, unless lease was lost meanwhile (rows then belong to the worker which claimed shard since)
+    '''
+    with database.engine.begin() as connection:
+        if not renew_shard_lease(connection, lease):
+            raise RuntimeError(f'lease of report {lease[0]} shard {lease[1]} was lost')
+
+        connection.execute(
+            delete(ReportRow).where(ReportRow.report_id == lease[0], ReportRow.store_id >= store_id_range[0], ReportRow.store_id <= store_id_range[1])
+        )
+
+
+def complete_report_shard(db: Session, lease: tuple, stores: int) -> bool:
+    '''
+    marks leased shard as completed and adds its stores to report progress, returns True when it was the last shard of report.
+    on postgresql report row is locked first, so completions of its shards are serialized and exactly one of them sees no shard left
+    '''
+    report_id = lease[0]
+
+    if db.bind.dialect.name == 'postgresql':
+        db.execute(select(Report.report_id).where(Report.report_id == report_id).with_for_update())
+
+    completed = db.execute(
+        update(ReportShard).where(*get_lease_filter(*lease)).values(status='Completed', stores=stores, lease_expires_at=None)
+    ).rowcount
+
+    if completed:
+        db.execute(
+            update(Report).where(
+                Report.report_id == report_id
+            ).values(
+                stores_processed=Report.stores_processed + stores,
+                heartbeat_at=datetime.utcnow()
+            )
+        )
+
+    pending_shards = db.execute(
+        select(func.count()).select_from(ReportShard).where(ReportShard.report_id == report_id, ReportShard.status != 'Completed')
+    ).scalar()
+    db.commit()
+
+    return completed > 0 and pending_shards == 0
+
+
+def fail_sharded_report(db: Session, report_id: int) -> None:
+    db.execute(
+        update(Report).where(
+            Report.report_id == report_id,
+            Report.status.in_(['Queued', 'Running'])
+        ).values(
+            status='Failed',
+            report_csv_url='',
+            # failed report must not be returned for identical requests
+            cache_key=None,
+            checkpoint=None
+        )
+    )
+    db.execute(delete(ReportShard).where(ReportShard.report_id == report_id))
+    db.commit()
+
+    delete_report_rows(report_id)
+
+
+def fail_report_shard(db: Session, lease: tuple) -> None:
+    '''
+    releases shard for another attempt, report fails once shard was attempted `report_max_attempts` times. nothing happens when lease was lost
+    '''
+    attempts = db.execute(
+        update(ReportShard).where(*get_lease_filter(*lease)).values(status='Queued', lease_owner=None, lease_expires_at=None).returning(ReportShard.attempts)
+    ).scalar()
+    db.commit()
+
+    if attempts is not None and attempts >= report_max_attempts:
+        fail_sharded_report(db, lease[0])
+
+
+def run_report_shard(db: Session, lease: tuple) -> None:
+    '''
+    calculates stores of leased shard with report parameters and inserts their rows into `report_rows`. rows are inserted in batches, each in
+    a transaction which checks the lease, so rows of a worker which lost its lease (e.g. stalled past its expiry) are rolled back.
+    worker completing the last shard assembles report file
+    '''
+    report_id, shard_index = lease[:2]
+    timer = get_report_timer()
+
+    # other replicas see the shard is being worked on and report is not queued again
+    stop_renewal = start_lease_renewal(lease)
+
+    try:
+        report = db.get(Report, report_id)
+        shard = db.get(ReportShard, (report_id, shard_index))
+        store_id_range = (shard.first_store_id, shard.last_store_id)
+        parameters = report.parameters or {}
+
+        store_data = refresh_store_metadata()
+
+        if store_data.versions != report.metadata_versions:
+            raise ValueError(f'business hours or timezones changed since report {report_id} was split into shards')
+
+        report_intervals = get_report_intervals(datetime.fromisoformat(parameters['now']), parameters.get('windows'))
+
+        start_report_shard(lease, store_id_range)
+
+        def on_flush(connection, last_store_id: int, stores_written: int) -> None:
+            if not renew_shard_lease(connection, lease):
+                raise RuntimeError(f'lease of report {report_id} shard {shard_index} was lost')
+
+        writer = ReportRowsWriter(None, report_id, get_report_windows(report_intervals), on_flush=on_flush)
+        # every shard reads observations up to report watermark, so report is a single snapshot of observations no matter when its shards run
+        stores = stream_restaurant_status(db, report_intervals, store_id_range=store_id_range, timer=timer, max_observation_id=report.last_observation_id)
+
+        # server-side cursor is closed before session is rolled back on failure
+        with closing(stores):
+            total_stores = write_store_availability_rows(writer, stores, store_data, report_intervals, parameters.get('engine', 'python'), timer=timer)
+
+        writer.flush()
+
+        last_shard = complete_report_shard(db, lease, total_stores)
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+
+        db.rollback()
+        fail_report_shard(db, lease)
+
+        return None
+    finally:
+        stop_renewal.set()
+
+        if timer:
+            timer.record()
+
+    if last_shard:
+        assemble_sharded_report(db, report_id)
+
+
+def write_report_rows_file(writer, db: Session, report_id: int, windows: list, batch_size: int = 10000) -> int:
+    '''
+    writes rows of report stored in `report_rows` into report `writer` in store_id order, returns number of stores written
+    '''
+    rows = db.execute(
+        select(
+            ReportRow.store_id,
+            ReportRow.report_window,
+            ReportRow.uptime,
+            ReportRow.downtime
+        ).where(
+            ReportRow.report_id == report_id
+        ).order_by(
+            asc(ReportRow.store_id)
+        ).execution_options(stream_results=True, yield_per=batch_size)
+    )
+
+    total_stores = 0
+
+    with closing(rows):
+        for store_id, store_rows in groupby(rows, key=itemgetter(0)):
+            values = { window: (uptime, downtime) for _, window, uptime, downtime in store_rows }
+
+            writer.writerow((
+                store_id,
+                *(values[window][0] for window in windows),
+                *(values[window][1] for window in windows)
+            ))
+            total_stores += 1
+
+    return total_stores
+
+
+def assemble_sharded_report(db: Session, report_id: int) -> None:
+    '''
+    writes report file from rows of all shards and completes report. when assembling fails, report stays `Running` with all shards completed,
+    it is queued again once its heartbeat is stale and the worker claiming it assembles it
+    '''
+    report = db.get(Report, report_id)
+    parameters = report.parameters or {}
+    report_format = parameters.get('format', 'csv')
+
+    writer = None
+    stop_heartbeat = start_heartbeat([report_id])
+
+    try:
+        report_bounds = get_report_bounds(get_report_intervals(datetime.fromisoformat(parameters['now']), parameters.get('windows')))
+
+        writer = open_report_writer(os.path.join(reports_dir, report.report_file), report_format, get_report_fields(report_bounds))
+        total_stores = write_report_rows_file(writer, db, report_id, list(report_bounds))
+
+        writer.close()
+        writer = None
+
+        report.status = 'Completed'
+        # relative to api base url, so report is not tied to a host
+        report.report_csv_url = f'/reports/{report_id}/download'
+        report.report_format = report_format
+        report.stores_processed = total_stores
+        report.stores_total = total_stores
+        clear_checkpoint(db, report_id)
+
+        db.execute(delete(ReportShard).where(ReportShard.report_id == report_id))
+        db.commit()
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+
+        db.rollback()
+    finally:
+        if writer:
+            writer.close()
+
+        stop_heartbeat.set()
+
+
+def run_next_report_shard(db: Session) -> bool:
+    '''
+    calculates a shard of any report, returns False when there was no shard to claim
+    '''
+    lease = claim_report_shard(db)
+
+    if lease is None:
+        return False
+
+    run_report_shard(db, lease)
+
+    return True
+
+
+def run_sharded_report(db: Session, report: Report, store_data: StoreMetadata, shards: int = report_shards) -> None:
+    '''
+    splits claimed report into shards (or resumes shards of its previous attempt) and calculates its shards until none is left to claim.
+    shards claimed by workers of other replicas meanwhile are completed by them, the worker completing the last one assembles report file,
+    so report stays `Running` when this returns until then
+    '''
+    try:
+        pending_shards = plan_report_shards(db, report, store_data, shards)
+    except Exception as e:
+        print(e)
+        print(traceback.format_exc())
+
+        db.rollback()
+
+        if report.attempts < report_max_attempts:
+            report.status = 'Queued'
+            db.commit()
+        else:
+            fail_sharded_report(db, report.report_id)
+
+        return None
+
+    # every shard was completed by a worker which stopped before report file was assembled, or report has no stores
+    if not pending_shards:
+        assemble_sharded_report(db, report.report_id)
+        return None
+
+    while True:
+        lease = claim_report_shard(db, report.report_id)
+
+        if lease is None:
+            return None
+
+        run_report_shard(db, lease)
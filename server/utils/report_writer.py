@@ -0,0 +1,120 @@
+import csv
+import gzip
+import os
+import shutil
+
+
+reports_dir = os.path.join(os.getcwd(), "server", "static", "reports")
+
+# columns of report with default windows
+report_fields = ['store_id', 'uptime_last_hour(in minutes)', 'uptime_last_day(in hours)', 'uptime_last_week(in hours)', 'downtime_last_hour(in minutes)', 'downtime_last_day(in hours)', 'downtime_last_week(in hours)']
+
+# format: (file extension, media type, content encoding)
+report_formats = {
+    'csv': ('csv', 'text/csv', None),
+    'csv.gz': ('csv.gz', 'text/csv', 'gzip'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet', None),
+    'arrow': ('arrow', 'application/vnd.apache.arrow.file', None),
+}
+
+# rows buffered before they are written as one parquet row group / arrow record batch
+row_group_size = 65536
+
+
+class CsvReportWriter:
+    '''
+    writes report rows (tuples in `fields` order) as csv, gzip compressed when `compress` is set
+    '''
+
+    def __init__(self, path: str, fields: list = report_fields, compress: bool = False):
+        if compress:
+            self.file = gzip.open(path, 'wt', newline='', compresslevel=6)
+        else:
+            self.file = open(path, 'w', newline='')
+
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(fields)
+
+    def writerow(self, row: tuple) -> None:
+        self.writer.writerow(row)
+
+    def write_csv_part(self, part_path: str) -> None:
+        '''
+        appends rows of a headerless csv file written by a report shard
+        '''
+        with open(part_path, 'r', newline='') as part_file:
+            shutil.copyfileobj(part_file, self.file)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ColumnarReportWriter:
+    '''
+    writes report rows as parquet or arrow ipc file, rows are buffered per column and written every `row_group_size` rows,
+    so memory stays bounded and readers can load only the columns they need
+    '''
+
+    def __init__(self, path: str, report_format: str, fields: list = report_fields):
+        # pyarrow is only needed for columnar reports
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema([(field, pa.int64()) for field in fields])
+        self.sink = None
+
+        if report_format == 'parquet':
+            self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, self.schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+
+        self.columns = [[] for _ in self.schema]
+
+    def writerow(self, row: tuple) -> None:
+        for column, value in zip(self.columns, row):
+            column.append(value)
+
+        if len(self.columns[0]) >= row_group_size:
+            self.flush()
+
+    def write_csv_part(self, part_path: str) -> None:
+        with open(part_path, 'r', newline='') as part_file:
+            for row in csv.reader(part_file):
+                self.writerow(tuple(int(value) for value in row))
+
+    def flush(self) -> None:
+        if not self.columns[0]:
+            return
+
+        batch = self.pa.RecordBatch.from_arrays(
+            [self.pa.array(column, type=self.pa.int64()) for column in self.columns],
+            schema=self.schema
+        )
+        self.writer.write_batch(batch)
+
+        self.columns = [[] for _ in self.schema]
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
+        if self.sink:
+            self.sink.close()
+
+
+def get_report_filename(name: str, report_format: str) -> str:
+    extension, _, _ = report_formats[report_format]
+
+    return f'{name}.{extension}'
+
+
+def open_report_writer(path: str, report_format: str = 'csv', fields: list = report_fields):
+    if report_format not in report_formats:
+        raise ValueError(f'unknown report format: {report_format}')
+
+    if report_format in ('csv', 'csv.gz'):
+        return CsvReportWriter(path, fields, compress=report_format == 'csv.gz')
+
+    return ColumnarReportWriter(path, report_format, fields)
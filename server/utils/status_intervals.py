@@ -0,0 +1,424 @@
+import os
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+from itertools import chain, groupby
+from operator import itemgetter
+from typing import Iterator, Optional, Tuple
+
+from sqlalchemy import and_, asc, case, delete, false, func, insert, or_, select
+from sqlalchemy.orm import Session
+
+from server.models.store import RestaurantStatus
+from server.models.status_intervals import StoreStatusInterval, StatusIntervalCompaction
+from server.utils.business_hours import get_report_span
+from server.utils.metrics import ReportTimer
+
+
+# raw observations older than this before the latest one are pruned once they are compacted, intervals are kept
+observation_retention = timedelta(days=float(os.environ.get('OBSERVATION_RETENTION_DAYS', 15)))
+
+# stores compacted together, every store adds two parameters to the delete query, so it stays within database parameter limits
+store_chunk_size = 250
+insert_batch_size = 10000
+
+# postgres advisory lock key which serializes compactions and pruning (hourly uptime refreshes use 8101)
+status_intervals_lock_id = 8102
+
+
+def lock_status_intervals(db: Session) -> None:
+    '''
+    serializes compactions of reports, `load_data.py` and `compact_status.py` of every replica (and pruning) until transaction of `db` ends,
+    a compaction waiting for the lock reads watermark moved by the previous one instead of inserting the same intervals again
+    '''
+    if db.bind.dialect.name == 'postgresql':
+        db.execute(select(func.pg_advisory_xact_lock(status_intervals_lock_id)))
+    else:
+        # sqlite has a single writer, a write matching no row takes its lock before watermark is read
+        db.execute(delete(StatusIntervalCompaction).where(false()))
+
+
+def get_last_compacted_observation_id(db: Session) -> int:
+    return db.execute(select(func.max(StatusIntervalCompaction.last_observation_id))).scalar() or 0
+
+
+def get_compaction_start(db: Session, last_observation_id: int, max_observation_id: int) -> dict:
+    '''
+    returns where intervals of every store with new observations are recomputed from, format {store_id: (first_seen, seed)}.
+    intervals from `first_seen` onwards are replaced. when new observations come after the last interval of a store, `seed` is that interval
+    ({status, first_seen, last_seen, observations}) which is extended without reading its observations again (they may be pruned already).
+    late observations rebuild intervals from raw observations starting at the interval they fall into, seed is then None.
+    observations of a store were pruned when its first interval starts before its first remaining compacted observation, intervals before
+    that observation can't be rebuilt and late observations before it are left out of compaction
+    '''
+    new_range = and_(RestaurantStatus.observation_id > last_observation_id, RestaurantStatus.observation_id <= max_observation_id)
+
+    stores = select(RestaurantStatus.store_id).where(new_range).distinct().subquery()
+
+    first_interval = select(
+            func.min(StoreStatusInterval.first_seen)
+        ).where(
+            StoreStatusInterval.store_id == stores.c.store_id
+        ).scalar_subquery()
+
+    first_compacted = select(
+            func.min(RestaurantStatus.timestamp_utc)
+        ).where(
+            RestaurantStatus.store_id == stores.c.store_id,
+            RestaurantStatus.observation_id <= last_observation_id
+        ).scalar_subquery()
+
+    # first remaining compacted observation of stores whose older observations were pruned, new stores skip the lookup
+    horizons = select(
+            stores.c.store_id,
+            case((first_interval == None, None), (first_interval < first_compacted, first_compacted), else_=None).label('horizon')
+        ).subquery()
+
+    new_observations = select(
+            RestaurantStatus.store_id,
+            func.min(RestaurantStatus.timestamp_utc).label('first_timestamp_utc')
+        ).join(
+            horizons,
+            horizons.c.store_id == RestaurantStatus.store_id
+        ).where(
+            new_range,
+            or_(horizons.c.horizon == None, RestaurantStatus.timestamp_utc >= horizons.c.horizon)
+        ).group_by(
+            RestaurantStatus.store_id
+        ).subquery()
+
+    seed_first_seen = select(
+            func.max(StoreStatusInterval.first_seen)
+        ).where(
+            StoreStatusInterval.store_id == new_observations.c.store_id,
+            StoreStatusInterval.first_seen <= new_observations.c.first_timestamp_utc
+        ).scalar_subquery()
+
+    last_first_seen = select(
+            func.max(StoreStatusInterval.first_seen)
+        ).where(
+            StoreStatusInterval.store_id == new_observations.c.store_id
+        ).scalar_subquery()
+
+    starts = select(
+            new_observations.c.store_id,
+            new_observations.c.first_timestamp_utc,
+            seed_first_seen.label('seed_first_seen'),
+            last_first_seen.label('last_first_seen')
+        ).subquery()
+
+    rows = db.execute(
+        select(
+            starts,
+            StoreStatusInterval.status,
+            StoreStatusInterval.last_seen,
+            StoreStatusInterval.observations
+        ).outerjoin(
+            StoreStatusInterval,
+            and_(
+                StoreStatusInterval.store_id == starts.c.store_id,
+                StoreStatusInterval.first_seen == starts.c.seed_first_seen
+            )
+        )
+    )
+
+    compaction_start = {}
+
+    for store_id, first_timestamp_utc, seed_first_seen, last_first_seen, status, last_seen, observations in rows:
+        if seed_first_seen is None:
+            # store is new or observations arrived before its first interval
+            compaction_start[store_id] = (first_timestamp_utc, None)
+        elif seed_first_seen == last_first_seen and first_timestamp_utc > last_seen:
+            seed = { "status": status, "first_seen": seed_first_seen, "last_seen": last_seen, "observations": observations }
+            compaction_start[store_id] = (seed_first_seen, seed)
+        else:
+            compaction_start[store_id] = (seed_first_seen, None)
+
+    return compaction_start
+
+
+def compact_observations(store_id: int, status_entries, seed: Optional[dict] = None) -> list:
+    '''
+    collapses [(timestamp_utc, status), ...] sorted by timestamp_utc into runs of identical status, format [{store_id, status, first_seen, last_seen, observations}, ...].
+    first run continues `seed` interval when it has the same status
+    '''
+    intervals = []
+    current = dict(seed, store_id=store_id) if seed else None
+
+    for timestamp_utc, status in status_entries:
+        if current and current["status"] == status:
+            current["last_seen"] = timestamp_utc
+            current["observations"] += 1
+            continue
+
+        if current:
+            intervals.append(current)
+
+        current = { "store_id": store_id, "status": status, "first_seen": timestamp_utc, "last_seen": timestamp_utc, "observations": 1 }
+
+    if current:
+        intervals.append(current)
+
+    return intervals
+
+
+def compact_stores(db: Session, compaction_start: dict, max_observation_id: int) -> None:
+    '''
+    replaces intervals of given stores ({store_id: (first_seen, seed)}) from their first_seen onwards
+    '''
+    store_ids = sorted(compaction_start)
+
+    db.execute(
+        delete(StoreStatusInterval).where(
+            or_(*(
+                and_(StoreStatusInterval.store_id == store_id, StoreStatusInterval.first_seen >= first_seen)
+                for store_id, (first_seen, _) in compaction_start.items()
+            ))
+        )
+    )
+
+    # observations after seed interval or from rebuilt interval onwards, single range for all stores is narrowed per store below
+    observations_start = min(seed["last_seen"] if seed else first_seen for first_seen, seed in compaction_start.values())
+
+    observations = db.execute(
+        select(
+            RestaurantStatus.store_id,
+            RestaurantStatus.timestamp_utc,
+            RestaurantStatus.status
+        ).where(
+            RestaurantStatus.store_id.in_(store_ids),
+            RestaurantStatus.timestamp_utc >= observations_start,
+            RestaurantStatus.observation_id <= max_observation_id
+        ).order_by(
+            asc(RestaurantStatus.store_id),
+            asc(RestaurantStatus.timestamp_utc)
+        )
+    ).all()
+
+    rows = []
+    compacted = set()
+
+    for store_id, store_observations in groupby(observations, key=itemgetter(0)):
+        first_seen, seed = compaction_start[store_id]
+
+        if seed:
+            status_entries = [(timestamp_utc, status) for _, timestamp_utc, status in store_observations if timestamp_utc > seed["last_seen"]]
+        else:
+            status_entries = [(timestamp_utc, status) for _, timestamp_utc, status in store_observations if timestamp_utc >= first_seen]
+
+        rows.extend(compact_observations(store_id, status_entries, seed))
+        compacted.add(store_id)
+
+        if len(rows) >= insert_batch_size:
+            db.execute(insert(StoreStatusInterval), rows)
+            rows = []
+
+    # seed interval was deleted above even when none of its store's observations are left to extend it
+    for store_id in store_ids:
+        first_seen, seed = compaction_start[store_id]
+
+        if seed and store_id not in compacted:
+            rows.append(dict(seed, store_id=store_id))
+
+    if rows:
+        db.execute(insert(StoreStatusInterval), rows)
+
+
+def compact_status_intervals(db: Session) -> int:
+    '''
+    collapses observations which arrived since last compaction into `store_status_intervals`, returns number of compacted stores
+    '''
+    lock_status_intervals(db)
+
+    last_observation_id = get_last_compacted_observation_id(db)
+    max_observation_id = db.execute(select(func.max(RestaurantStatus.observation_id))).scalar()
+
+    if max_observation_id is None or max_observation_id <= last_observation_id:
+        # releases the lock
+        db.commit()
+        return 0
+
+    compaction_start = get_compaction_start(db, last_observation_id, max_observation_id)
+    store_ids = sorted(compaction_start)
+
+    for index in range(0, len(store_ids), store_chunk_size):
+        chunk = store_ids[index:index + store_chunk_size]
+        compact_stores(db, { store_id: compaction_start[store_id] for store_id in chunk }, max_observation_id)
+
+    db.add(StatusIntervalCompaction(last_observation_id=max_observation_id, compacted_at=datetime.utcnow()))
+    db.commit()
+
+    return len(compaction_start)
+
+
+def prune_observations(db: Session, retention: timedelta = observation_retention) -> int:
+    '''
+    deletes compacted observations older than `retention` before the latest observation, returns number of deleted observations.
+    observations of the interval running at the cutoff are kept, so every interval either has all its observations or none of them and
+    late observations never rebuild an interval whose observations were pruned (see `get_compaction_start`).
+    reports over older windows are then only available from `status_intervals` source
+    '''
+    lock_status_intervals(db)
+
+    last_observation_id = get_last_compacted_observation_id(db)
+    latest_timestamp = db.execute(select(func.max(RestaurantStatus.timestamp_utc))).scalar()
+
+    if latest_timestamp is None or not last_observation_id:
+        db.commit()
+        return 0
+
+    cutoff = latest_timestamp - retention
+
+    # start of interval of the store running at the cutoff
+    cutoff_interval = select(
+            func.max(StoreStatusInterval.first_seen)
+        ).where(
+            StoreStatusInterval.store_id == RestaurantStatus.store_id,
+            StoreStatusInterval.first_seen <= cutoff
+        ).scalar_subquery()
+
+    deleted = db.execute(
+        delete(RestaurantStatus).where(
+            RestaurantStatus.timestamp_utc < cutoff,
+            RestaurantStatus.timestamp_utc < cutoff_interval,
+            RestaurantStatus.observation_id <= last_observation_id
+        )
+    ).rowcount
+    db.commit()
+
+    return deleted
+
+
+def get_interval_span(report_intervals: dict) -> tuple:
+    return tuple(value.astimezone(timezone.utc).replace(tzinfo=None) for value in get_report_span(report_intervals))
+
+
+def get_interval_filter(report_intervals: dict, store_id_range: Optional[tuple] = None):
+    '''
+    intervals overlapping the span of report_intervals, `store_id_range` (first_store_id, last_store_id) limits them to a range of stores
+    '''
+    span_start, span_end = get_interval_span(report_intervals)
+
+    interval_filter = and_(
+        StoreStatusInterval.last_seen >= span_start,
+        StoreStatusInterval.first_seen <= span_end
+    )
+
+    if store_id_range:
+        interval_filter = and_(
+            StoreStatusInterval.store_id >= store_id_range[0],
+            StoreStatusInterval.store_id <= store_id_range[1],
+            interval_filter
+        )
+
+    return interval_filter
+
+
+def get_interval_store_ids(db: Session, report_intervals: dict) -> list:
+    '''
+    returns sorted ids of stores having intervals within report_intervals
+    '''
+    query = select(
+            StoreStatusInterval.store_id
+        ).where(
+            get_interval_filter(report_intervals)
+        ).distinct().order_by(
+            asc(StoreStatusInterval.store_id)
+        )
+
+    return db.execute(query).scalars().all()
+
+
+def get_span_edge_observations(db: Session, report_intervals: dict, store_id_range: Optional[tuple] = None) -> dict:
+    '''
+    downtime of an `inactive` run crossing start or end of report span starts at its first observation within span and is extrapolated from its last one,
+    which interval does not keep. returns them for every such run from raw observations, format {(store_id, first_seen): (first_timestamp_utc, last_timestamp_utc)}.
+    at most two runs per store are looked up through (store_id, timestamp_utc) index, timestamps are None once observations are pruned
+    '''
+    span_start, span_end = get_interval_span(report_intervals)
+
+    # observations of the run within span
+    run_observations = and_(
+        RestaurantStatus.store_id == StoreStatusInterval.store_id,
+        RestaurantStatus.timestamp_utc >= StoreStatusInterval.first_seen,
+        RestaurantStatus.timestamp_utc <= StoreStatusInterval.last_seen,
+        RestaurantStatus.timestamp_utc >= span_start,
+        RestaurantStatus.timestamp_utc <= span_end
+    )
+
+    first_timestamp = select(func.min(RestaurantStatus.timestamp_utc)).where(run_observations).scalar_subquery()
+    last_timestamp = select(func.max(RestaurantStatus.timestamp_utc)).where(run_observations).scalar_subquery()
+
+    rows = db.execute(
+        select(
+            StoreStatusInterval.store_id,
+            StoreStatusInterval.first_seen,
+            first_timestamp,
+            last_timestamp
+        ).where(
+            get_interval_filter(report_intervals, store_id_range),
+            StoreStatusInterval.status == 'inactive',
+            or_(StoreStatusInterval.first_seen < span_start, StoreStatusInterval.last_seen > span_end)
+        )
+    )
+
+    return { (store_id, first_seen): (first, last) for store_id, first_seen, first, last in rows }
+
+
+def get_interval_observations(store_id: int, intervals, span_start: datetime, span_end: datetime, edge_observations: dict) -> list:
+    '''
+    turns (status, first_seen, last_seen) intervals of a store into [(timestamp_utc, status), ...] of the first and last observation of every interval,
+    which is all downtime calculation needs: downtime starts at first `inactive` of a run, ends at first `active` after it and the last observation is extrapolated.
+    intervals crossing span boundaries are cut at their first and last observation within span (`edge_observations`), or at span start and end without them
+    '''
+    status_entries = []
+
+    for status, first_seen, last_seen in intervals:
+        first_edge, last_edge = edge_observations.get((store_id, first_seen), (None, None))
+
+        first_seen = first_edge or max(first_seen, span_start)
+        last_seen = last_edge or min(last_seen, span_end)
+
+        status_entries.append((first_seen, status))
+
+        if last_seen != first_seen:
+            status_entries.append((last_seen, status))
+
+    return status_entries
+
+
+def stream_status_intervals(db: Session, report_intervals: dict, batch_size: int = 10000, store_id_range: Optional[tuple] = None, timer: Optional[ReportTimer] = None) -> Iterator[Tuple[int, list]]:
+    '''
+    same as `stream_restaurant_status`, but reads `store_status_intervals` instead of raw observations, every interval yields at most two observations.
+    reports are identical to raw observations as long as observations of runs crossing report span are not pruned
+    '''
+    span_start, span_end = get_interval_span(report_intervals)
+
+    with timer.timed('query') if timer else nullcontext():
+        edge_observations = get_span_edge_observations(db, report_intervals, store_id_range)
+
+    query = select(
+            StoreStatusInterval.store_id,
+            StoreStatusInterval.status,
+            StoreStatusInterval.first_seen,
+            StoreStatusInterval.last_seen
+        ).where(
+            get_interval_filter(report_intervals, store_id_range)
+        ).order_by(
+            asc(StoreStatusInterval.store_id),
+            asc(StoreStatusInterval.first_seen)
+        ).execution_options(stream_results=True, yield_per=batch_size)
+
+    if timer:
+        with timer.timed('query'):
+            intervals = db.execute(query)
+
+        rows = chain.from_iterable(timer.iter_timed(intervals.partitions(), 'query'))
+    else:
+        intervals = db.execute(query)
+        rows = intervals
+
+    try:
+        for store_id, store_intervals in groupby(rows, key=itemgetter(0)):
+            yield store_id, get_interval_observations(store_id, (row[1:] for row in store_intervals), span_start, span_end, edge_observations)
+    finally:
+        intervals.close()
@@ -1,15 +1,33 @@
 import os
+import time
 import traceback
 import uuid
 import csv
-from datetime import datetime, timezone, time
+from bisect import bisect_right
+from contextlib import closing, nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Iterator, Optional
 
+import numpy as np
 from sqlalchemy.orm import Session
 
+from server import database
 from server.models.store import Report 
 
-from server.utils.datetime_utils import convert_utc_to_local
-from server.utils.store_details import get_restaurant_status
+from server.utils.business_hours import StoreSchedule, get_store_schedule
+from server.utils.datetime_utils import get_report_bounds, get_report_windows, to_epoch_microseconds
+from server.utils.hourly_uptime import get_hourly_downtime, refresh_hourly_uptime
+from server.utils.incremental_report import find_base_report, get_observation_watermark, write_incremental_report
+from server.utils.metrics import ReportTimer, get_report_timer, observe
+from server.utils.observations import ACTIVE, INACTIVE, StoreObservations, get_observation_count
+from server.utils.report import update_report_progress
+from server.utils.report_checkpoint import checkpoint_interval, report_max_attempts, clear_checkpoint, get_partial_path, get_resume_checkpoint, open_partial_file, remove_partial_files, save_checkpoint, sync_partial_file
+from server.utils.report_rows import ReportRowsWriter, delete_report_rows
+from server.utils.report_writer import reports_dir, get_report_filename, open_report_writer
+from server.utils.status_intervals import compact_status_intervals, get_interval_store_ids, stream_status_intervals
+from server.utils.store_details import get_restaurant_status, get_store_ids, stream_restaurant_status
+from server.utils.store_metadata import StoreMetadata
+from server.utils import store_availability_vectorized as vectorized
 
 
 days_in_week = 7
@@ -19,249 +37,564 @@ seconds_in_hour = seconds_in_min * 60
 seconds_in_day = hours_in_day * seconds_in_hour
 seconds_in_week = days_in_week * hours_in_day * seconds_in_hour
 
-report_fields = ['store_id', 'uptime_last_hour(in minutes)', 'uptime_last_day(in hours)', 'uptime_last_week(in hours)', 'downtime_last_hour(in minutes)', 'downtime_last_day(in hours)', 'downtime_last_week(in hours)']
+microseconds_in_min = seconds_in_min * 1000000
+microseconds_in_hour = seconds_in_hour * 1000000
+microseconds_in_day = seconds_in_day * 1000000
 
-def get_store_running_time_by_interval(business_hours: dict, day_of_week: int) -> dict:
-    last_hour = seconds_in_hour
-    last_day = 0
-    last_week = 0
+# number of processes report is split across, 1 calculates report in calling process
+report_workers = int(os.environ.get('REPORT_WORKERS', 1))
 
-    for i in range(days_in_week):
-        start_time_local, end_time_local = business_hours.get(i, (None, None))
+# status codes of columnar observations
+status_names = { ACTIVE: 'active', INACTIVE: 'inactive' }
 
-        if start_time_local and end_time_local:
-            start_time_seconds = start_time_local.hour * seconds_in_hour + start_time_local.minute * seconds_in_min + start_time_local.second
-            end_time_seconds = end_time_local.hour * seconds_in_hour + end_time_local.minute * seconds_in_min + end_time_local.second
+# number of stores between two progress updates of a report
+progress_interval = 1000
 
-            store_running_time = (end_time_seconds - start_time_seconds)
+
+def get_store_running_time_by_interval(schedule: StoreSchedule, report_bounds: dict) -> dict:
+    '''
+    returns business hours (in microseconds) of store within every report interval
+    '''
+    return { key: int(schedule.get_open_time(start, end)) for key, (start, end) in report_bounds.items() }
+
+
+def get_window_boundaries(report_bounds: dict) -> list:
+    '''
+    sorted distinct starts and ends of report intervals, windows sharing a boundary (e.g. consecutive days) share its lookups
+    '''
+    return sorted({ boundary for bounds in report_bounds.values() for boundary in bounds })
+
+
+def get_downtime_until_boundaries(downtime_intervals: list, schedule: StoreSchedule, boundaries: list) -> tuple:
+    '''
+    single sweep over downtime intervals (sorted and non overlapping) and window boundaries (sorted), returns business hours (in microseconds)
+    of downtime before every boundary along with business hours before every boundary. downtime of any window is then difference of its two boundaries,
+    so every interval costs the same no matter how many windows report has
+    '''
+    # business hours until every boundary and downtime start / end, calculated in one batch
+    open_time = schedule.get_open_time_until(
+        np.array(boundaries + [timestamp for interval in downtime_intervals for timestamp in interval], dtype=np.int64)
+    ).tolist()
+
+    boundary_open_time = open_time[:len(boundaries)]
+    interval_open_time = open_time[len(boundaries):]
+
+    downtime_until = []
+    total_downtime = 0
+
+    for index, (downtime_start, downtime_end) in enumerate(downtime_intervals):
+        start_open_time = interval_open_time[2 * index]
+        end_open_time = interval_open_time[2 * index + 1]
+
+        # boundaries before downtime started
+        while len(downtime_until) < len(boundaries) and boundaries[len(downtime_until)] <= downtime_start:
+            downtime_until.append(total_downtime)
+
+        # boundaries within downtime get only its part before them
+        while len(downtime_until) < len(boundaries) and boundaries[len(downtime_until)] < downtime_end:
+            downtime_until.append(total_downtime + boundary_open_time[len(downtime_until)] - start_open_time)
+
+        total_downtime += end_open_time - start_open_time
+
+    downtime_until.extend([total_downtime] * (len(boundaries) - len(downtime_until)))
+
+    return downtime_until, boundary_open_time
+
+
+def iter_observations(status_entries) -> Iterator[tuple]:
+    '''
+    yields (epoch microseconds, status) of [(timestamp_utc, status), ...] or `StoreObservations` views, status is `active` / `inactive` in both
+    '''
+    if isinstance(status_entries, StoreObservations):
+        yield from zip(status_entries.timestamps.tolist(), map(status_names.__getitem__, status_entries.statuses.tolist()))
+        return
+
+    for timestamp_utc, status in status_entries:
+        yield to_epoch_microseconds(timestamp_utc), status
+
+
+def get_downtime_intervals(status_entries, schedule: StoreSchedule) -> list:
+    '''
+    returns downtime [(start, end), ...] intervals in epoch microseconds of a store from its observations (sorted by timestamp_utc)
+    '''
+    downtime_start = None
+    last_timestamp = None
+    downtime_intervals = []
+
+    # Iterate through all observations of current store, find `inactive -> ... -> active` pattern and take timestamp difference as downtime.
+    # only business hours within downtime are counted, so time when store is closed (e.g. overnight) is skipped
+    for last_timestamp, status in iter_observations(status_entries):
+        # downtime ended
+        if downtime_start is not None and status == 'active':
+            downtime_intervals.append((downtime_start, last_timestamp))
+
+            # reset downtime 
+            downtime_start = None
+
+        # downtime started, keep looking in observation for downtime end
+        if downtime_start is None and status == 'inactive':
+            downtime_start = last_timestamp
+
+    if downtime_start is not None:
+        # last observation is `inactive`, extrapolate downtime till end of its business hours
+        downtime_intervals.append((downtime_start, int(schedule.get_close_time(last_timestamp))))
+
+    return downtime_intervals
+
+
+def calculate_store_availability(store_id: int, status_entries: list, schedule: StoreSchedule, report_bounds: dict) -> tuple:
+    '''
+    calculates uptime and downtime of a single store from its observations (sorted by timestamp_utc) within every report interval and returns report row
+    '''
+    boundaries = get_window_boundaries(report_bounds)
+    downtime_until, open_time = get_downtime_until_boundaries(get_downtime_intervals(status_entries, schedule), schedule, boundaries)
+
+    boundary_index = { boundary: index for index, boundary in enumerate(boundaries) }
+
+    total_uptime = {}
+    total_downtime = {}
+
+    for key, (start, end) in report_bounds.items():
+        total_downtime[key] = downtime_until[boundary_index[end]] - downtime_until[boundary_index[start]]
+
+        # Calculate uptime based on downtime
+        total_uptime[key] = max(open_time[boundary_index[end]] - open_time[boundary_index[start]], 0) - total_downtime[key]
+
+    return format_report_row(store_id, total_uptime, total_downtime, report_bounds)
+
+
+def get_window_unit(start: int, end: int) -> tuple:
+    '''
+    windows shorter than a day are reported in minutes, longer ones in hours. returns (unit, microseconds in unit)
+    '''
+    if end - start < microseconds_in_day:
+        return 'minutes', microseconds_in_min
+
+    return 'hours', microseconds_in_hour
+
+
+def get_report_fields(report_bounds: dict) -> list:
+    '''
+    report columns, uptime of every window followed by downtime of every window
+    e.g. ['store_id', 'uptime_last_hour(in minutes)', ..., 'downtime_last_week(in hours)']
+    '''
+    return ['store_id'] + [
+        f'{column}_{key}(in {get_window_unit(start, end)[0]})'
+        for column in ('uptime', 'downtime')
+        for key, (start, end) in report_bounds.items()
+    ]
+
+
+def format_report_row(store_id: int, total_uptime: dict, total_downtime: dict, report_bounds: dict) -> tuple:
+    '''
+    uptime and downtime are in microseconds, returns row in `get_report_fields` order
+    '''
+    units = [get_window_unit(start, end)[1] for start, end in report_bounds.values()]
+
+    return (
+        store_id,
+        *(round(total_uptime[key]/unit) for key, unit in zip(report_bounds, units)),
+        *(round(total_downtime[key]/unit) for key, unit in zip(report_bounds, units))
+    )
+
+
+def calculate_store_availability_vectorized(store_id: int, status_entries: list, schedule: StoreSchedule, report_bounds: dict) -> dict:
+    '''
+    same as `calculate_store_availability`, but computed with numpy array operations instead of walking observations
+    '''
+    timestamps, statuses = vectorized.get_observation_arrays(status_entries)
+
+    total_uptime, total_downtime = vectorized.calculate_store_availability(
+        timestamps,
+        statuses,
+        schedule,
+        report_bounds
+    )
+
+    return format_report_row(store_id, total_uptime, total_downtime, report_bounds)
+
+
+def write_store_availability_rows(writer, stores, store_data: StoreMetadata, report_intervals: dict, engine: str = 'python', on_progress: Optional[Callable] = None, timer: Optional[ReportTimer] = None) -> int:
+    '''
+    calculates downtime and uptime of every store from (store_id, status_entries) pairs and writes them as report rows, returns number of stores written.
+    `on_progress` is called with number of stores written after every `progress_interval` stores.
+    `timer` gets time spent waiting for next store (`grouping`), calculating (`compute`) and writing rows (`write`) along with number of observations
+    '''
+    report_bounds = get_report_bounds(report_intervals)
+
+    # compiled business hours schedules, shared by stores with same business hours and timezone
+    schedules = {}
+
+    total_stores = 0
+
+    if timer:
+        stores = timer.iter_timed(stores, 'grouping')
+
+    # Iterate through all stores and calculate downtime and uptime
+    for store_id, status_entries in stores:
+        # below code is for debugging downtime for specific store
+        # if store_id != 6099875917665264465:
+        #     continue
+
+        if timer:
+            started = time.perf_counter()
+
+        schedule = get_store_schedule(store_id, store_data, report_intervals, schedules)
+
+        if engine == 'numpy':
+            row = calculate_store_availability_vectorized(store_id, status_entries, schedule, report_bounds)
         else:
-            # store is open all day when business_hours is not available
-            store_running_time = (hours_in_day * seconds_in_hour)
-
-        # store running time for last day
-        if i == day_of_week:
-            print(start_time_local)
-            print(end_time_local)
-            last_day = store_running_time
-
-        # store running time for last week
-        last_week += store_running_time
-
-    return {
-        "last_hour": last_hour,
-        "last_day": last_day,
-        "last_week": last_week
-    }
-
-def calculate_downtime(
-    downtime_start: datetime,
-    downtime_end: datetime,
-    business_hours: dict,
-    store_timezone: str,
-    report_intervals: dict
-) -> dict:
-    downtime = {
-        "last_hour": 0,
-        "last_day": 0,
-        "last_week": 0
-    }
-
-    # get business hours of day when downtime started. note that day_start and day_end will be our business hours when we dont'have business hours for given day
-    downtime_start_day = downtime_start.weekday()
-
-    start_time_local, end_time_local = business_hours.get(downtime_start_day, (None, None))
-
-    day_start = time()
-    day_end = time(23, 59, 59)
-
-    store_start = start_time_local if start_time_local else day_start
-    store_end = end_time_local if end_time_local else day_end
-
-    # if downtime_end is not passed, then end time of business_hours will be downtime_end. this happens when last observation status was `inactive` and we need to extrapolate downtime till day end
-    downtime_end = downtime_end if downtime_end else datetime.combine(downtime_start.date(), store_end)
-
-    downtime_start_local = convert_utc_to_local(downtime_start, store_timezone)
-    downtime_start_local = downtime_start_local.time().replace(microsecond=0)
-
-    # Check if the downtime occurred during business hours
-    if store_start <= downtime_start_local <= store_end:
-        downtime_end_day = downtime_end.weekday()
-
-        # if observations are of different days, downtime_end will be end of business hours for that day
-        if downtime_start_day != downtime_end_day:
-            downtime_end = datetime.combine(
-                downtime_start.date(),
-                store_end,
-            )
+            row = calculate_store_availability(store_id, status_entries, schedule, report_bounds)
 
-        downtime_start = downtime_start.replace(tzinfo=timezone.utc)
-        downtime_end = downtime_end.replace(tzinfo=timezone.utc)
+        if timer:
+            computed = time.perf_counter()
 
-        # calculate downtime duration in seconds
-        downtime_duration = abs(downtime_end - downtime_start).total_seconds()
+        # write store downtime and uptime calculations into csv file
+        writer.writerow(row)
+        total_stores += 1
 
-        if downtime_end >= report_intervals['last_hour_start']:
-            # update downtime end to hour end when downtime lasted more than hour
-            downtime_end = min(
-                report_intervals['last_hour_end'],
-                downtime_end
-            ) 
+        if timer:
+            timer.add_time('compute', computed - started)
+            timer.add_time('write', time.perf_counter() - computed)
+            timer.add_count('observations', get_observation_count(status_entries))
 
-            downtime_duration = abs(downtime_end - downtime_start).total_seconds()
+        if on_progress and total_stores % progress_interval == 0:
+            on_progress(total_stores)
 
-            downtime['last_hour'] = min(downtime_duration, seconds_in_hour)
-        elif downtime_end >= report_intervals['last_day_start']:
-            # update downtime start to day start when observation was taken before business hours
-            downtime_start = max(
-                datetime.combine(downtime_start.date(), store_start, tzinfo=timezone.utc),
-                downtime_start
-            )
+    return total_stores
+
+
+def write_hourly_uptime_rows(writer, db: Session, store_data: StoreMetadata, report_intervals: dict) -> int:
+    '''
+    writes report rows from `store_hourly_uptime` rollup instead of raw observations, returns number of stores written
+    '''
+    report_bounds = get_report_bounds(report_intervals)
+    schedules = {}
+
+    total_stores = 0
+
+    for store_id, total_downtime in get_hourly_downtime(db, report_intervals):
+        schedule = get_store_schedule(store_id, store_data, report_intervals, schedules)
+        store_running_time = get_store_running_time_by_interval(schedule, report_bounds)
+
+        # Calculate uptime based on downtime
+        total_uptime = { key: (store_running_time[key] - total_downtime[key]) for key in store_running_time }
+
+        writer.writerow(format_report_row(store_id, total_uptime, total_downtime, report_bounds))
+        total_stores += 1
+
+    return total_stores
+
+
+def init_report_worker() -> None:
+    # connections inherited from parent process must not be reused by forked worker, every worker opens its own
+    database.engine.dispose(close=False)
+
+
+def generate_report_shard(report_id: int, store_data: StoreMetadata, report_intervals: dict, store_id_range: tuple, shard_path: str, engine: str = 'python') -> tuple:
+    '''
+    runs in worker process, writes csv rows (without header) of stores within `store_id_range` into `shard_path` and inserts them into `report_rows`.
+    returns number of stores written and timer of the shard (None when metrics are disabled)
+    '''
+    db: Session = database.SessionLocal()
+    timer = get_report_timer()
 
-            downtime_duration = abs(downtime_end - downtime_start).total_seconds()
+    try:
+        with open(shard_path, 'w', newline='') as shard_file:
+            writer = ReportRowsWriter(csv.writer(shard_file), report_id, get_report_windows(report_intervals))
+            stores = stream_restaurant_status(db, report_intervals, store_id_range=store_id_range, timer=timer)
 
-            downtime['last_day'] = min(downtime_duration, seconds_in_day)
-        elif downtime_end >= report_intervals['last_week_start']:
-            # update downtime start to day start when observation was taken before business hours
-            downtime_start = max(
-                datetime.combine(downtime_start.date(), store_start, tzinfo=timezone.utc),
-                downtime_start
+            with closing(stores):
+                total_stores = write_store_availability_rows(writer, stores, store_data, report_intervals, engine, timer=timer)
+
+            with timer.timed('write') if timer else nullcontext():
+                writer.flush()
+
+            return total_stores, timer
+    finally:
+        db.close()
+
+
+def get_store_id_ranges(store_ids: list, shards: int) -> list:
+    '''
+    splits sorted store_ids into at most `shards` contiguous (first_store_id, last_store_id) ranges of similar size
+    '''
+    shard_size = -(-len(store_ids) // shards) if store_ids else 1
+
+    return [
+        (store_ids[index], store_ids[min(index + shard_size, len(store_ids)) - 1])
+        for index in range(0, len(store_ids), shard_size)
+    ]
+
+
+def write_sharded_report(writer, report_id: int, file_path: str, store_ids: list, store_data: StoreMetadata, report_intervals: dict, workers: int, engine: str = 'python', timer: Optional[ReportTimer] = None, checkpoint: Optional[dict] = None) -> int:
+    '''
+    splits stores into store_id ranges, calculates every range in its own process into partial csv files next to `file_path`
+    and appends them to report `writer` in store_id order. every completed range is saved in report checkpoint (along with stores processed) and its
+    partial file is kept until report is completed, so next attempt of a failed report only calculates ranges of `checkpoint` which were not completed.
+    `timer` gets phases of all ranges summed up, returns number of stores written by all attempts
+    '''
+    checkpoint = checkpoint or { "store_id_ranges": get_store_id_ranges(store_ids, workers), "completed_shards": {} }
+
+    store_id_ranges = [tuple(store_id_range) for store_id_range in checkpoint["store_id_ranges"]]
+    completed_shards = dict(checkpoint["completed_shards"])
+    shard_paths = [f'{file_path}.part{index}' for index in range(len(store_id_ranges))]
+
+    total_stores = sum(completed_shards.values())
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_report_worker) as executor:
+        shards = {}
+
+        for index, (store_id_range, shard_path) in enumerate(zip(store_id_ranges, shard_paths)):
+            if str(index) in completed_shards:
+                continue
+
+            # rows inserted by previous attempt of this range
+            delete_report_rows(report_id, store_id_range)
+
+            shards[executor.submit(generate_report_shard, report_id, store_data, report_intervals, store_id_range, shard_path, engine)] = index
+
+        failed_shards = []
+
+        for shard in as_completed(shards):
+            try:
+                shard_stores, shard_timer = shard.result()
+            except Exception as e:
+                # ranges completed after a failed one are still saved, so next attempt only calculates failed ranges
+                failed_shards.append(e)
+                continue
+
+            total_stores += shard_stores
+            completed_shards[str(shards[shard])] = shard_stores
+
+            with database.engine.begin() as connection:
+                save_checkpoint(connection, report_id, { "store_id_ranges": store_id_ranges, "completed_shards": completed_shards }, total_stores)
+
+            if timer and shard_timer:
+                timer.merge(shard_timer)
+
+    if failed_shards:
+        raise failed_shards[0]
+
+    with timer.timed('write') if timer else nullcontext():
+        for shard_path in shard_paths:
+            writer.write_csv_part(shard_path)
+
+    return total_stores
+
+
+def write_resumable_report(writer, db: Session, report_id: int, file_path: str, store_ids: list, store_data: StoreMetadata, report_intervals: dict, stream: bool = True, engine: str = 'python', timer: Optional[ReportTimer] = None, checkpoint: Optional[dict] = None, source: str = 'observations') -> int:
+    '''
+    writes rows into partial csv next to `file_path` and appends it to report `writer` once all stores are written.
+    every `checkpoint_interval` stores partial file is synced to disk and report rows are inserted in the same transaction which saves last store_id
+    and partial file offset as report checkpoint. next attempt of a failed or crashed report cuts partial file back to `checkpoint` offset
+    and continues with stores after its store_id. `status_intervals` source always streams intervals. returns number of stores written by all attempts
+    '''
+    checkpoint = checkpoint or {}
+    resumed_stores = checkpoint.get("stores", 0)
+
+    # stores written by previous attempts are skipped
+    if "store_id" in checkpoint:
+        store_ids = store_ids[bisect_right(store_ids, checkpoint["store_id"]):]
+
+    store_id_range = (store_ids[0], store_ids[-1]) if checkpoint and store_ids else None
+
+    partial_path = get_partial_path(file_path)
+
+    with open_partial_file(partial_path, checkpoint.get("offset", 0)) as partial_file:
+        def on_flush(connection, last_store_id: int, stores_written: int) -> None:
+            stores_processed = resumed_stores + stores_written
+            save_checkpoint(
+                connection,
+                report_id,
+                { "store_id": last_store_id, "offset": sync_partial_file(partial_file), "stores": stores_processed },
+                stores_processed
             )
 
-            downtime['last_week'] = min(downtime_duration, seconds_in_week)
-
-    return downtime
-
-
-def generate_store_availability_report(db: Session, store_data: dict, report_intervals: dict, report: Report) -> None:
-    # get relevant observations based on report_intervals
-    stores = get_restaurant_status(db, report_intervals)
-    business_hours = store_data['business_hours']
-    timezones = store_data['timezones']
-
-    report_file = None
-    filename = f"report-{str(uuid.uuid4())}.csv"
-    file_path = os.path.join(os.getcwd(), "server", "static", "reports", filename)
-
-    print(f'total stores: {len(stores.items())}')
-
-    try:    
-        with open(file_path, 'w', newline='') as report_file:
-            writer = csv.DictWriter(report_file, fieldnames=report_fields)
-            writer.writeheader()
-
-            # Iterate through all stores and calculate downtime and uptime
-            for store_id, status_entries in stores.items():
-                # below code is for debugging downtime for specific store
-                # if store_id != 6099875917665264465:
-                #     continue
-
-                store_business_hours = business_hours.get(store_id, {})
-                store_running_time = get_store_running_time_by_interval(
-                    store_business_hours,
-                    report_intervals['last_day_start'].weekday()
-                )
-                store_timezone = timezones.get(store_id, 'America/Chicago')
-
-                # print(store_id)
-                # print(store_running_time)
-
-                downtime_start = None
-                downtime_end = None
-                total_downtime = {
-                    "last_hour": 0,
-                    "last_day": 0,
-                    "last_week": 0
-                }
-                total_uptime = {
-                    "last_hour": 0,
-                    "last_day": 0,
-                    "last_week": 0
-                }
-
-                # Iterate through all observations of current store, find `inactive -> ... -> active` pattern and take timestamp difference as downtime
-                for index in range(len(status_entries)):
-                    curr_timestamp, curr_status = status_entries[index]
-                    pre_timestamp, pre_status = status_entries[index - 1] if (index - 1) >= 0 else (None, None)
-
-                    # when last observation of previous day is `inactive`, then extrapolate downtime with time difference of day_start and first_observation time
-                    if pre_timestamp and pre_status:
-                        curr_observation_day = curr_timestamp.weekday()
-                        pre_observation_day = pre_timestamp.weekday()
-
-                        if curr_observation_day - 1 == pre_observation_day and pre_status == 'inactive':
-                            start_time_local, end_time_local = store_business_hours.get(curr_observation_day, (None, None))
-
-                            day_start = time()
-                            start_time_local = start_time_local if start_time_local else day_start
-
-                            downtime_start = datetime.combine(curr_timestamp.date(), start_time_local)
-                            # print(f'downtime started: {downtime_start}')
-
-                    # downtime ended, calculate downtime
-                    if downtime_start and curr_status == 'active':
-                        downtime_end = curr_timestamp
-                        # print(f'downtime ended: {downtime_end}')
-
-                        downtime = calculate_downtime(
-                            downtime_start,
-                            downtime_end,
-                            store_business_hours,
-                            store_timezone,
-                            report_intervals
-                        )
-
-                        # add downtime to total_downtime by hour, day and week
-                        total_downtime = { key: (total_downtime[key] + downtime[key]) for key in total_downtime }
-
-                        # reset downtime 
-                        downtime_start = None
-
-                    # downtime started, keep looking in observation for downtime end
-                    if not downtime_start and curr_status == 'inactive':
-                        downtime_start = status_entries[index][0]
-                        # print(f'downtime started: {downtime_start}')
-                        continue
-                        
-                if downtime_start:
-                    # process last observation and extrapolate downtime till day end
-                    downtime_end = None
-                    downtime = calculate_downtime(
-                        downtime_start,
-                        downtime_end,
-                        store_business_hours,
-                        store_timezone,
-                        report_intervals
-                    )    
-
-                    # add downtime to total_downtime by hour, day and week
-                    total_downtime = { key: (total_downtime[key] + downtime[key]) for key in total_downtime }       
-
-                # Calculate uptime based on downtime
-                total_uptime = { key: (store_running_time[key] - total_downtime[key]) for key in store_running_time }
-
-                # write store downtime and uptime calculations into csv file
-                writer.writerow({
-                    'store_id': store_id,
-                    'uptime_last_hour(in minutes)': round(total_uptime['last_hour']/seconds_in_min),
-                    'uptime_last_day(in hours)': round(total_uptime['last_day']/seconds_in_hour),
-                    'uptime_last_week(in hours)': round(total_uptime['last_week']/seconds_in_hour),
-                    'downtime_last_hour(in minutes)': round(total_downtime['last_hour']/seconds_in_min),
-                    'downtime_last_day(in hours)': round(total_downtime['last_day']/seconds_in_hour),
-                    'downtime_last_week(in hours)': round(total_downtime['last_week']/seconds_in_hour)
-                })
-
-            report.status = 'Completed'
-            report.report_csv_url = f'localhost:8000/static/reports/{filename}'
-            db.commit()
+        rows_writer = ReportRowsWriter(csv.writer(partial_file), report_id, get_report_windows(report_intervals), checkpoint_interval, on_flush)
+
+        if store_ids:
+            # get relevant observations based on report_intervals
+            if source == 'status_intervals':
+                stores = stream_status_intervals(db, report_intervals, store_id_range=store_id_range, timer=timer)
+            elif stream:
+                stores = stream_restaurant_status(db, report_intervals, store_id_range=store_id_range, timer=timer)
+            else:
+                with timer.timed('query') if timer else nullcontext():
+                    stores = get_restaurant_status(db, report_intervals, columnar=True, store_id_range=store_id_range).items()
+
+            # server-side cursor is closed before report session is rolled back on failure
+            with closing(stores):
+                write_store_availability_rows(rows_writer, stores, store_data, report_intervals, engine, timer=timer)
+
+        with timer.timed('write') if timer else nullcontext():
+            rows_writer.flush()
+
+    with timer.timed('write') if timer else nullcontext():
+        writer.write_csv_part(partial_path)
+
+    return resumed_stores + rows_writer.stores_written
+
+
+def generate_store_availability_report(db: Session, store_data: StoreMetadata, report_intervals: dict, report: Report, stream: bool = True, engine: str = 'python', workers: int = report_workers, source: str = 'observations', report_format: str = 'csv', incremental: bool = False, delta: bool = False) -> None:
+    '''
+    generates store availability report as csv, gzip csv, parquet or arrow file (`report_format`). when `stream` is set, observations are read one store at a time through server-side cursor
+    and each row is written as soon as store is processed, so peak memory depends on the largest store instead of all stores.
+    otherwise all observations are loaded at once into columnar arrays and stores are read as array views.
+    `engine` chooses between per observation `python` loop and `numpy` array operations, both produce identical reports.
+    with more than one `workers`, stores are split into store_id ranges which are calculated in parallel processes.
+    `hourly_uptime` source refreshes and sums `store_hourly_uptime` rollup rows instead of walking raw observations, rollup follows observations
+    across span edges (downtime running into the span, last `inactive` observation lasting until the next one after span end), so stores whose downtime crosses them differ from raw report.
+    `status_intervals` source compacts new observations and walks runs of identical status from `store_status_intervals`, calculated by a single process.
+    report saves checkpoints while it is generated, failed report is queued again until `report_max_attempts` and its next attempt resumes from last checkpoint.
+    completed report records observation watermark and metadata versions, `incremental` report of observations reuses rows of the latest such report
+    and recalculates only what changed since (`write_incremental_report`), `delta` also writes rows of recalculated stores into a separate file.
+    phase timings and counts are recorded as metrics once report is finished
+    '''
+    writer = None
+    delta_writer = None
+    started = time.perf_counter()
+    timer = get_report_timer()
+
+    # phases are not timed when metrics are disabled
+    timed = timer.timed if timer else lambda phase: nullcontext()
+    report_status = 'Failed'
+
+    # hourly rollup is summed again from the start, it takes a fraction of observations report
+    sharded = workers > 1 and source == 'observations'
+    checkpoint = get_resume_checkpoint(report, sharded) if source != 'hourly_uptime' else None
+
+    # file name is kept by every attempt, so next attempt finds partial files of previous one
+    filename = report.report_file or get_report_filename(f"report-{str(uuid.uuid4())}", report_format)
+    file_path = os.path.join(reports_dir, filename)
+    delta_filename = None
+
+    try:
+        # observations added from now on are left to the next incremental report
+        max_observation_id = get_observation_watermark(db)
+
+        if not checkpoint:
+            # rows of an attempt which failed before its first checkpoint
+            delete_report_rows(report.report_id)
+
+        report.report_file = filename
+        report.checkpoint = checkpoint
+        db.commit()
 
-            return None
+        report_bounds = get_report_bounds(report_intervals)
+        writer = open_report_writer(file_path, report_format, get_report_fields(report_bounds))
+
+        # resumed report continues the way it started
+        base = find_base_report(db, report, report_intervals, store_data) if incremental and source == 'observations' and not checkpoint else None
+
+        if base:
+            writer = ReportRowsWriter(writer, report.report_id, list(report_bounds))
+
+            if delta:
+                delta_filename = get_report_filename(f"report-{str(uuid.uuid4())}-delta", report_format)
+                delta_writer = open_report_writer(os.path.join(reports_dir, delta_filename), report_format, get_report_fields(report_bounds))
+
+            calculate = calculate_store_availability_vectorized if engine == 'numpy' else calculate_store_availability
+
+            total_stores = write_incremental_report(writer, delta_writer, db, base, store_data, report_intervals, max_observation_id, calculate, timer)
+
+            with timed('write'):
+                if delta_writer:
+                    delta_writer.close()
+                    delta_writer = None
+        elif source == 'hourly_uptime':
+            # rows are written into report file and `report_rows` table, so they can be filtered and paged without reading the file
+            writer = ReportRowsWriter(writer, report.report_id, list(report_bounds))
+
+            with timed('rollup_refresh'):
+                refresh_hourly_uptime(db, store_data)
+
+            with timed('rollup_sum'):
+                total_stores = write_hourly_uptime_rows(writer, db, store_data, report_intervals)
+        elif source == 'status_intervals':
+            with timed('compaction'):
+                compact_status_intervals(db)
+
+            with timed('query'):
+                store_ids = get_interval_store_ids(db, report_intervals)
+
+            update_report_progress(report.report_id, report.stores_processed if checkpoint else 0, len(store_ids))
+
+            total_stores = write_resumable_report(writer, db, report.report_id, file_path, store_ids, store_data, report_intervals, True, engine, timer, checkpoint, source)
+        else:
+            with timed('query'):
+                store_ids = get_store_ids(db, report_intervals)
+
+            update_report_progress(report.report_id, report.stores_processed if checkpoint else 0, len(store_ids))
+
+            if sharded:
+                total_stores = write_sharded_report(writer, report.report_id, file_path, store_ids, store_data, report_intervals, workers, engine, timer, checkpoint)
+            else:
+                total_stores = write_resumable_report(writer, db, report.report_id, file_path, store_ids, store_data, report_intervals, stream, engine, timer, checkpoint)
+
+        with timed('write'):
+            writer.close()
+            writer = None
+
+        remove_partial_files(file_path)
+
+        if timer:
+            timer.add_count('stores', total_stores)
+            timer.add_count('intervals', total_stores * len(report_bounds))
+
+        report.status = 'Completed'
+        # relative to api base url, so report is not tied to a host
+        report.report_csv_url = f'/reports/{report.report_id}/download'
+        report.report_format = report_format
+        report.stores_processed = total_stores
+        report.stores_total = total_stores
+        clear_checkpoint(db, report.report_id)
+        report.last_observation_id = max_observation_id
+        report.metadata_versions = store_data.versions
+
+        if delta_filename:
+            report.delta_file = delta_filename
+            report.report_delta_url = f'/reports/{report.report_id}/download?delta=true'
+
+        db.commit()
+
+        report_status = 'Completed'
+
+        return None
     except Exception as e:
         print(e)
         print(traceback.format_exc())
+
+        # session may be left in a failed transaction (e.g. lost connection)
+        db.rollback()
+
+        if report.attempts < report_max_attempts:
+            # checkpoint and partial files are kept, next attempt resumes from them
+            report.status = 'Queued'
+            db.commit()
+
+            return None
+
         report.status = 'Failed'
         report.report_csv_url = ''
+        # failed report must not be returned for identical requests
+        report.cache_key = None
+        clear_checkpoint(db, report.report_id)
         db.commit()
+
+        delete_report_rows(report.report_id)
+        remove_partial_files(file_path)
     finally:
-        if report_file:
-            report_file.close()
-        
\ No newline at end of file
+        if writer:
+            # buffered report rows of failed attempt are not inserted
+            getattr(writer, 'abort', writer.close)()
+
+        if delta_writer:
+            delta_writer.close()
+
+        if delta_filename and report_status != 'Completed' and os.path.exists(os.path.join(reports_dir, delta_filename)):
+            os.remove(os.path.join(reports_dir, delta_filename))
+
+        if timer:
+            timer.record()
+            observe('report_duration_seconds', time.perf_counter() - started, status=report_status)
@@ -0,0 +1,79 @@
+import numpy as np
+
+from server.utils.business_hours import StoreSchedule
+from server.utils.observations import INACTIVE, StoreObservations
+
+
+def get_observation_arrays(status_entries) -> tuple:
+    '''
+    converts [(timestamp_utc, status), ...] into int64 epoch microseconds and uint8 status (1 = active, 0 = inactive) arrays,
+    `StoreObservations` of columnar observations are already arrays and returned as they are
+    '''
+    if isinstance(status_entries, StoreObservations):
+        return status_entries.timestamps, status_entries.statuses
+
+    timestamps = np.array([timestamp for timestamp, _ in status_entries], dtype='datetime64[us]').astype(np.int64)
+    statuses = np.fromiter((status == 'active' for _, status in status_entries), dtype=np.uint8, count=len(status_entries))
+
+    return timestamps, statuses
+
+
+def get_downtime_intervals(timestamps: np.ndarray, statuses: np.ndarray, schedule: StoreSchedule) -> tuple:
+    '''
+    every `inactive` observation is downtime until next observation, last `inactive` observation is extrapolated till end of its business hours.
+    returns downtime (start, end) arrays in epoch microseconds
+    '''
+    inactive = statuses == INACTIVE
+
+    next_timestamps = np.empty_like(timestamps)
+    next_timestamps[:-1] = timestamps[1:]
+    next_timestamps[-1:] = schedule.get_close_time(timestamps[-1:])
+
+    return timestamps[inactive], next_timestamps[inactive]
+
+
+def calculate_store_availability(
+    timestamps: np.ndarray,
+    statuses: np.ndarray,
+    schedule: StoreSchedule,
+    report_bounds: dict
+) -> tuple:
+    '''
+    calculates uptime and downtime (in microseconds) of a single store from its observation arrays (sorted by timestamp) within every report interval.
+    downtime and business hours before every window boundary are looked up in one batch, so extra windows cost a lookup instead of a pass over downtime intervals
+    '''
+    downtime_start, downtime_end = get_downtime_intervals(timestamps, statuses, schedule)
+
+    boundaries = np.unique(np.array(list(report_bounds.values()), dtype=np.int64))
+    downtime_until = get_downtime_until(downtime_start, downtime_end, schedule, boundaries).tolist()
+    open_time = schedule.get_open_time_until(boundaries).tolist()
+
+    boundary_index = { boundary: index for index, boundary in enumerate(boundaries.tolist()) }
+
+    total_downtime = {}
+    total_uptime = {}
+
+    for key, (start, end) in report_bounds.items():
+        total_downtime[key] = int(downtime_until[boundary_index[end]] - downtime_until[boundary_index[start]])
+        total_uptime[key] = int(max(open_time[boundary_index[end]] - open_time[boundary_index[start]], 0)) - total_downtime[key]
+
+    return total_uptime, total_downtime
+
+
+def get_downtime_until(downtime_start: np.ndarray, downtime_end: np.ndarray, schedule: StoreSchedule, timestamps: np.ndarray) -> np.ndarray:
+    '''
+    returns business hours of downtime (in microseconds) before every timestamp, downtime intervals must be sorted and non overlapping.
+    differences between consecutive timestamps give downtime of each period (e.g. every hour) without clipping intervals period by period
+    '''
+    if not len(downtime_start):
+        return np.zeros(len(timestamps), dtype=np.int64)
+
+    downtime = schedule.get_open_time(downtime_start, downtime_end)
+    downtime_before = np.cumsum(downtime) - downtime
+
+    index = np.searchsorted(downtime_start, timestamps, side='right') - 1
+    interval = np.maximum(index, 0)
+
+    partial_downtime = schedule.get_open_time(downtime_start[interval], np.minimum(downtime_end[interval], timestamps))
+
+    return np.where(index >= 0, downtime_before[interval] + partial_downtime, 0)
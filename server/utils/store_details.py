@@ -1,74 +1,50 @@
-from functools import lru_cache
-import traceback
+from itertools import chain, groupby
+from operator import itemgetter
+from typing import Iterator, Optional, Tuple
 from fastapi import Depends
 
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import asc, or_, and_
+from sqlalchemy import asc, func, and_, select
 
-from server.database import SessionLocal
-from server.models.store import BusinessHours, RestaurantTimezone, RestaurantStatus
+from server.models.store import RestaurantStatus
+from server.utils.business_hours import get_report_span
+from server.utils.metrics import ReportTimer
+from server.utils.observations import load_observation_columns
 
 
-@lru_cache(maxsize=None)  # (None means unlimited cache size)
-def get_store_data() -> dict:
+async def get_last_observation_id(db: AsyncSession) -> int:
+    return (await db.execute(select(func.max(RestaurantStatus.observation_id)))).scalar() or 0
+
+def get_observation_filter(report_intervals: dict):
     '''
-    cache store business hours and timezones in dictionary, so these data can be reused for every `trigger_report/` api call
+    single timestamp range from the earliest start to the latest end of report_intervals instead of one range per interval,
+    so observations are read with one range scan of (store_id, timestamp_utc) index (and only partitions of those weeks).
+    observations between intervals only end downtime of the previous observation, calculations clip downtime to every interval
     '''
-    try:
-        db: Session = SessionLocal()
-        
-        business_hours = db.query(BusinessHours).all()
-        timezones = db.query(RestaurantTimezone).all()
-
-        # store timezones and business_hours in dictionary for faster access
-        timezones_dict = {}
-        # format {store_id: timezone_str}
+    span_start, span_end = get_report_span(report_intervals)
 
-        for store_timezone in timezones:
-            store_id, timezone_str = store_timezone.store_id, store_timezone.timezone_str
+    return and_(
+        RestaurantStatus.timestamp_utc >= span_start,
+        RestaurantStatus.timestamp_utc <= span_end
+    )
 
-            timezones_dict[store_id] = timezone_str
-
-        business_hours_dict = {}  
-        # format {store_id: {day_of_week: (start_time_local, end_time_local)}}
+def get_restaurant_status(db: Session, report_intervals: dict, columnar: bool = False, batch_size: int = 10000, store_id_range: Optional[tuple] = None):
+    '''
+    loads all observations within report_intervals, `columnar` returns `ObservationColumns` arrays (converted batch by batch while rows are fetched)
+    instead of {store_id: [(timestamp_utc, status), ...]} dictionary. `store_id_range` (first_store_id, last_store_id) limits columnar observations to these stores
+    '''
+    if columnar:
+        query = get_observation_query(report_intervals, store_id_range).execution_options(stream_results=True, yield_per=batch_size)
+        observations = db.execute(query)
 
-        for business_hour in business_hours:
-            store_id = business_hour.store_id
-            day_of_week = business_hour.day_of_week
-            start_time_local = business_hour.start_time_local
-            end_time_local = business_hour.end_time_local
-            
-            if store_id not in business_hours_dict:
-                business_hours_dict[store_id] = {}
-
-            business_hours_dict[store_id][day_of_week] = (start_time_local, end_time_local)
-
-        return {
-            "business_hours": business_hours_dict,
-            "timezones": timezones_dict
-        }
-    except Exception as e:
-        print(e)
-        print(traceback.format_exc())
-    finally:
-        db.close()
+        try:
+            return load_observation_columns(observations.partitions())
+        finally:
+            observations.close()
 
-def get_restaurant_status(db: Session, report_intervals: dict) -> dict:
     restaurant_status = db.query(RestaurantStatus).filter(
-            or_(
-                and_(
-                    RestaurantStatus.timestamp_utc >= report_intervals['last_hour_start'],
-                    RestaurantStatus.timestamp_utc <= report_intervals['last_hour_end']
-                ),
-                and_(
-                    RestaurantStatus.timestamp_utc >= report_intervals['last_day_start'],
-                    RestaurantStatus.timestamp_utc <= report_intervals['last_day_end']
-                ),
-                and_(
-                    RestaurantStatus.timestamp_utc >= report_intervals['last_week_start'],
-                    RestaurantStatus.timestamp_utc <= report_intervals['last_week_end']
-                ),
-            )
+            get_observation_filter(report_intervals)
         ).order_by(
             asc(RestaurantStatus.store_id), 
             asc(RestaurantStatus.timestamp_utc)
@@ -88,4 +64,76 @@ def get_restaurant_status(db: Session, report_intervals: dict) -> dict:
             
         stores[store_id].append((timestamp_utc, status))
     
-    return stores
\ No newline at end of file
+    return stores
+
+def get_store_ids(db: Session, report_intervals: dict) -> list:
+    '''
+    returns sorted ids of stores having observations within report_intervals
+    '''
+    query = select(
+            RestaurantStatus.store_id
+        ).where(
+            get_observation_filter(report_intervals)
+        ).distinct().order_by(
+            asc(RestaurantStatus.store_id)
+        )
+
+    return db.execute(query).scalars().all()
+
+def get_observation_query(report_intervals: dict, store_id_range: Optional[tuple] = None, max_observation_id: Optional[int] = None):
+    '''
+    (store_id, timestamp_utc, status) of observations within report_intervals in (store_id, timestamp_utc) order.
+    `store_id_range` (first_store_id, last_store_id) limits observations to stores of a single shard,
+    `max_observation_id` leaves out observations added after report watermark was taken
+    '''
+    observation_filter = get_observation_filter(report_intervals)
+
+    if max_observation_id is not None:
+        observation_filter = and_(RestaurantStatus.observation_id <= max_observation_id, observation_filter)
+
+    if store_id_range:
+        observation_filter = and_(
+            RestaurantStatus.store_id >= store_id_range[0],
+            RestaurantStatus.store_id <= store_id_range[1],
+            observation_filter
+        )
+
+    return select(
+            RestaurantStatus.store_id,
+            RestaurantStatus.timestamp_utc,
+            RestaurantStatus.status
+        ).where(
+            observation_filter
+        ).order_by(
+            asc(RestaurantStatus.store_id),
+            asc(RestaurantStatus.timestamp_utc)
+        )
+
+def group_observations(observations) -> Iterator[Tuple[int, list]]:
+    '''
+    groups (store_id, timestamp_utc, status) rows sorted by store_id into (store_id, [(timestamp_utc, status), ...])
+    '''
+    for store_id, store_observations in groupby(observations, key=itemgetter(0)):
+        yield store_id, [(timestamp_utc, status) for _, timestamp_utc, status in store_observations]
+
+def stream_restaurant_status(db: Session, report_intervals: dict, batch_size: int = 10000, store_id_range: Optional[tuple] = None, timer: Optional[ReportTimer] = None, max_observation_id: Optional[int] = None) -> Iterator[Tuple[int, list]]:
+    '''
+    yields observations one store at a time as (store_id, [(timestamp_utc, status), ...]) in (store_id, timestamp_utc) order.
+    rows are fetched through a server-side cursor in batches of `batch_size`, so only the current store is held in memory.
+    `timer` gets time spent executing query and fetching batches as `query` phase
+    '''
+    query = get_observation_query(report_intervals, store_id_range, max_observation_id).execution_options(stream_results=True, yield_per=batch_size)
+
+    if timer:
+        with timer.timed('query'):
+            observations = db.execute(query)
+
+        rows = chain.from_iterable(timer.iter_timed(observations.partitions(), 'query'))
+    else:
+        observations = db.execute(query)
+        rows = observations
+
+    try:
+        yield from group_observations(rows)
+    finally:
+        observations.close()
@@ -0,0 +1,348 @@
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import traceback
+from datetime import time as local_time
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from server.database import SessionLocal
+from server.models.store import BusinessHours, DatabaseIdentity, DatasetVersion, RestaurantTimezone
+from server.utils.business_hours import default_timezone
+
+
+# datasets which are versioned in `dataset_versions` whenever they are reloaded
+dataset_names = ['business_hours', 'timezones']
+
+# metadata is reloaded when it is older than this even if dataset versions did not change (e.g. rows edited by hand)
+metadata_ttl_seconds = float(os.environ.get('METADATA_TTL_SECONDS', 3600))
+
+# how often dataset versions are checked by api process
+metadata_check_seconds = float(os.environ.get('METADATA_CHECK_SECONDS', 30))
+
+# metadata loaded from database is written here, restarted processes memory map it instead of reading all business hours and timezones.
+# defaults to a file per database in temp dir
+metadata_snapshot_path = os.environ.get('METADATA_SNAPSHOT')
+
+# start of snapshot file, changed whenever snapshot layout changes
+snapshot_magic = b'STOREMD1'
+
+# arrays of `StoreMetadata` in snapshot order
+snapshot_arrays = ['store_ids', 'opens', 'closes', 'timezone_ids']
+
+days_in_week = 7
+
+# weekday without business hours, store is open all day
+no_business_hours = -1
+
+
+class StoreMetadata:
+    '''
+    snapshot of business hours and timezones of all stores, never changed once loaded. stores are rows of arrays in `store_ids` order,
+    business hours are local seconds of day (int32) per weekday and timezones are interned into `timezones`, so 100k stores take a few MB
+    instead of dicts of datetime tuples. `versions` are dataset versions snapshot was loaded at
+    '''
+
+    def __init__(self, store_ids: np.ndarray, opens: np.ndarray, closes: np.ndarray, timezone_ids: np.ndarray, timezones: list, versions: dict, loaded_at: Optional[float] = None):
+        self.store_ids = store_ids
+        self.opens = opens
+        self.closes = closes
+        self.timezone_ids = timezone_ids
+        self.timezones = timezones
+        self.versions = versions
+        # monotonic time metadata was read from database, snapshot keeps time it was taken
+        self.loaded_at = time.monotonic() if loaded_at is None else loaded_at
+
+    def get_index(self, store_id: int) -> int:
+        '''
+        row of store, -1 when store has neither business hours nor timezone
+        '''
+        index = int(np.searchsorted(self.store_ids, store_id))
+
+        if index < len(self.store_ids) and self.store_ids[index] == store_id:
+            return index
+
+        return -1
+
+    def get_schedule_key(self, store_id: int) -> tuple:
+        '''
+        (timezone, opens, closes) of store, stores with equal keys share a compiled schedule
+        '''
+        index = self.get_index(store_id)
+
+        if index < 0:
+            return default_timezone, (), ()
+
+        timezone_id = self.timezone_ids[index]
+        store_timezone = self.timezones[timezone_id] if timezone_id >= 0 else default_timezone
+
+        return store_timezone, tuple(self.opens[index].tolist()), tuple(self.closes[index].tolist())
+
+    def get_timezone(self, store_id: int) -> str:
+        return self.get_schedule_key(store_id)[0]
+
+    def get_business_hours(self, store_id: int) -> dict:
+        '''
+        format {day_of_week: (start_time_local, end_time_local)}
+        '''
+        _, opens, closes = self.get_schedule_key(store_id)
+
+        return get_business_hours(opens, closes)
+
+    def is_expired(self) -> bool:
+        return time.monotonic() - self.loaded_at > metadata_ttl_seconds
+
+    @property
+    def nbytes(self) -> int:
+        return self.store_ids.nbytes + self.opens.nbytes + self.closes.nbytes + self.timezone_ids.nbytes
+
+
+def to_seconds(value: local_time) -> int:
+    return value.hour * 3600 + value.minute * 60 + value.second
+
+
+def to_local_time(seconds: int) -> local_time:
+    return local_time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def get_business_hours(opens: tuple, closes: tuple) -> dict:
+    '''
+    converts seconds of day per weekday back into {day_of_week: (start_time_local, end_time_local)}, weekdays without business hours are left out
+    '''
+    return {
+        day_of_week: (to_local_time(open_seconds), to_local_time(close_seconds))
+        for day_of_week, (open_seconds, close_seconds) in enumerate(zip(opens, closes))
+        if open_seconds != no_business_hours
+    }
+
+
+def get_dataset_versions(db: Session) -> dict:
+    '''
+    returns versions of business hours and timezones, format {name: version}
+    '''
+    versions = { name: 0 for name in dataset_names }
+
+    for dataset_version in db.query(DatasetVersion).all():
+        versions[dataset_version.name] = dataset_version.version
+
+    return versions
+
+
+def get_database_identity(db: Session) -> str:
+    '''
+    hash of database url and id written by `create_schema`, every database (another sqlite file, a copy of the same database) has its own identity,
+    so metadata snapshot of one database is never loaded for another one with equal dataset versions
+    '''
+    database_id = db.execute(select(DatabaseIdentity.database_id).where(DatabaseIdentity.id == 1)).scalar()
+    database_url = db.get_bind().url.render_as_string(hide_password=True)
+
+    return hashlib.sha256(f'{database_url} {database_id}'.encode()).hexdigest()[:16]
+
+
+def get_metadata_snapshot_path(database_identity: str) -> str:
+    return metadata_snapshot_path or os.path.join(tempfile.gettempdir(), f'store-monitoring-metadata-{database_identity}.bin')
+
+
+def load_store_metadata(db: Session) -> StoreMetadata:
+    versions = get_dataset_versions(db)
+
+    # stores can have more than one row per weekday, last loaded row is kept
+    business_hours = db.execute(
+        select(
+            BusinessHours.store_id,
+            BusinessHours.day_of_week,
+            BusinessHours.start_time_local,
+            BusinessHours.end_time_local
+        ).order_by(
+            BusinessHours.id
+        )
+    ).all()
+    timezones = db.execute(select(RestaurantTimezone.store_id, RestaurantTimezone.timezone_str)).all()
+
+    business_hours_store_ids = np.fromiter((row[0] for row in business_hours), dtype=np.int64, count=len(business_hours))
+    timezone_store_ids = np.fromiter((row[0] for row in timezones), dtype=np.int64, count=len(timezones))
+
+    store_ids = np.union1d(business_hours_store_ids, timezone_store_ids)
+
+    opens = np.full((len(store_ids), days_in_week), no_business_hours, dtype=np.int32)
+    closes = np.full((len(store_ids), days_in_week), no_business_hours, dtype=np.int32)
+
+    if business_hours:
+        index = np.searchsorted(store_ids, business_hours_store_ids)
+        day_of_week = np.fromiter((row[1] for row in business_hours), dtype=np.int64, count=len(business_hours))
+
+        opens[index, day_of_week] = [to_seconds(row[2]) for row in business_hours]
+        closes[index, day_of_week] = [to_seconds(row[3]) for row in business_hours]
+
+    # every distinct timezone string is kept once
+    timezone_names = {}
+    timezone_ids = np.full(len(store_ids), -1, dtype=np.int16)
+
+    if timezones:
+        timezone_ids[np.searchsorted(store_ids, timezone_store_ids)] = [
+            timezone_names.setdefault(timezone_str or default_timezone, len(timezone_names))
+            for _, timezone_str in timezones
+        ]
+
+    return StoreMetadata(store_ids, opens, closes, timezone_ids, list(timezone_names), versions)
+
+
+def dump_metadata_snapshot(metadata: StoreMetadata, database_identity: str, path: Optional[str] = None) -> None:
+    '''
+    writes metadata as magic, json header length, json header (database identity, versions, timezones, when it was read and dtype, shape and offset of every array)
+    and raw arrays at 8 byte aligned offsets, so they are memory mapped as they are. file is written aside and renamed, readers never see a partial snapshot
+    '''
+    path = path or get_metadata_snapshot_path(database_identity)
+    arrays = [np.ascontiguousarray(getattr(metadata, name)) for name in snapshot_arrays]
+
+    header = {
+        "database": database_identity,
+        "versions": metadata.versions,
+        "timezones": metadata.timezones,
+        # wall clock time, monotonic clock does not survive restart
+        "loaded_at": time.time() - (time.monotonic() - metadata.loaded_at),
+        "arrays": [],
+    }
+
+    # header length depends on offsets, so offsets are relative to the end of header
+    offset = 0
+
+    for name, array in zip(snapshot_arrays, arrays):
+        header["arrays"].append({ "name": name, "dtype": array.dtype.str, "shape": list(array.shape), "offset": offset })
+        offset += -(-array.nbytes // 8) * 8
+
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b' ' * (-(len(snapshot_magic) + 4 + len(header_bytes)) % 8)
+
+    partial_path = f'{path}.{os.getpid()}.partial'
+
+    with open(partial_path, 'wb') as snapshot_file:
+        snapshot_file.write(snapshot_magic)
+        snapshot_file.write(struct.pack('<I', len(header_bytes)))
+        snapshot_file.write(header_bytes)
+
+        for array in arrays:
+            snapshot_file.write(array.tobytes())
+            snapshot_file.write(b'\0' * (-array.nbytes % 8))
+
+    os.replace(partial_path, path)
+
+
+def load_metadata_snapshot(versions: dict, database_identity: str, path: Optional[str] = None) -> Optional[StoreMetadata]:
+    '''
+    memory maps arrays of metadata snapshot (read only, pages are read on first access). returns None when snapshot is missing or unreadable,
+    was taken from another database, at other dataset versions than `versions` or is older than `metadata_ttl_seconds`
+    '''
+    path = path or get_metadata_snapshot_path(database_identity)
+
+    try:
+        with open(path, 'rb') as snapshot_file:
+            if snapshot_file.read(len(snapshot_magic)) != snapshot_magic:
+                return None
+
+            header_length, = struct.unpack('<I', snapshot_file.read(4))
+            header = json.loads(snapshot_file.read(header_length))
+    except (OSError, ValueError, struct.error):
+        return None
+
+    age = time.time() - header["loaded_at"]
+
+    if header.get("database") != database_identity or header["versions"] != versions or age > metadata_ttl_seconds:
+        return None
+
+    data_offset = len(snapshot_magic) + 4 + header_length
+
+    arrays = [
+        np.memmap(path, dtype=np.dtype(array["dtype"]), mode='r', offset=data_offset + array["offset"], shape=tuple(array["shape"]))
+        if np.prod(array["shape"]) else np.empty(array["shape"], dtype=np.dtype(array["dtype"]))
+        for array in header["arrays"]
+    ]
+
+    return StoreMetadata(*arrays, header["timezones"], header["versions"], loaded_at=time.monotonic() - age)
+
+
+def dump_metadata_snapshot_safely(metadata: StoreMetadata, database_identity: str) -> None:
+    try:
+        dump_metadata_snapshot(metadata, database_identity)
+    except Exception as e:
+        # metadata is still used, next restart reads database again
+        print(e)
+        print(traceback.format_exc())
+
+
+current_metadata: Optional[StoreMetadata] = None
+
+# only one reload runs at a time
+metadata_lock = threading.Lock()
+
+
+def refresh_store_metadata(force: bool = False) -> StoreMetadata:
+    '''
+    reloads metadata when dataset versions changed or current snapshot expired, new snapshot replaces current one with a single assignment.
+    readers holding previous snapshot (e.g. running reports) keep using it. on-disk snapshot of current dataset versions (e.g. written before restart
+    or by another process) is memory mapped instead of reading business hours and timezones, metadata read from database is written as snapshot
+    '''
+    global current_metadata
+
+    with metadata_lock:
+        db: Session = SessionLocal()
+
+        try:
+            metadata = current_metadata
+            versions = get_dataset_versions(db)
+
+            if metadata is not None and not force and not metadata.is_expired() and versions == metadata.versions:
+                return metadata
+
+            database_identity = get_database_identity(db)
+            metadata = load_metadata_snapshot(versions, database_identity) if not force else None
+
+            if metadata is None:
+                metadata = load_store_metadata(db)
+                dump_metadata_snapshot_safely(metadata, database_identity)
+
+            current_metadata = metadata
+
+            return metadata
+        finally:
+            db.close()
+
+
+def get_store_data() -> StoreMetadata:
+    '''
+    current store metadata snapshot, loaded on first use. failed load raises instead of leaving empty metadata behind
+    '''
+    metadata = current_metadata
+
+    if metadata is None:
+        metadata = refresh_store_metadata()
+
+    return metadata
+
+
+def run_metadata_refresher(stop_event: threading.Event, check_seconds: float) -> None:
+    while not stop_event.wait(check_seconds):
+        try:
+            refresh_store_metadata()
+        except Exception as e:
+            # current snapshot stays in use until next successful reload
+            print(e)
+            print(traceback.format_exc())
+
+
+def start_metadata_refresher(check_seconds: float = metadata_check_seconds) -> threading.Event:
+    '''
+    checks dataset versions every `check_seconds` in a background thread, returned event stops it
+    '''
+    stop_event = threading.Event()
+
+    threading.Thread(target=run_metadata_refresher, args=(stop_event, check_seconds), name='store-metadata-refresher', daemon=True).start()
+
+    return stop_event